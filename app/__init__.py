@@ -5,7 +5,8 @@ Módulo de aplicación - Sistema de Rifas
 # Importar módulos para que sean accesibles desde 'app'
 from . import db
 from app import validators
+from app import bitmap, breaker, cache
 
 __version__ = "2.0"
 __author__ = "Yeimar Arley"
-__all__ = ['db', 'validators']
+__all__ = ['db', 'validators', 'bitmap', 'breaker', 'cache']
@@ -0,0 +1,131 @@
+"""
+Bitmap compartido de números tomados (un bit por número).
+
+Vive en un archivo mapeado en memoria (mmap), así todos los workers de
+gunicorn de la misma máquina ven el mismo estado. Es un caché: la base de
+datos sigue siendo la fuente de verdad y el bitmap se reconstruye desde
+ella al arrancar (ver db.rebuild_number_bitmap).
+
+El encabezado lleva además cuántos de los tomados son reservas de checkout
+sin confirmar, así los confirmados se cuentan en O(1) sin ir a la base.
+"""
+import struct
+import logging
+
+from app.shmem import MappedFile
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RFB2'
+# magic, tamaño del pool, números tomados, de ellos reservados, generación (cambia en cada escritura)
+HEADER = struct.Struct('<4sIIII')
+
+
+class NumberBitmap:
+    """Bitmap de 1..size respaldado por un archivo mmap compartido"""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._nbytes = size // 8 + 1  # el bit 0 no se usa
+        self._file = MappedFile(path, HEADER.size + self._nbytes, init=self._init_file)
+        self._mm = self._file.mm
+
+    def _init_file(self, mm, previous_size):
+        magic, stored_size = HEADER.unpack_from(mm, 0)[:2]
+        self.fresh = magic != MAGIC or stored_size != self.size
+        if self.fresh:
+            # Archivo nuevo, de otro tamaño o de otro formato: empezar en blanco
+            mm[:] = bytes(len(mm))
+            HEADER.pack_into(mm, 0, MAGIC, self.size, 0, 0, 0)
+
+    def _header(self):
+        return HEADER.unpack_from(self._mm, 0)
+
+    def _write_counts(self, count=None, reserved=None):
+        _, _, old_count, old_reserved, generation = self._header()
+        count = old_count if count is None else count
+        reserved = old_reserved if reserved is None else min(max(reserved, 0), count)
+        HEADER.pack_into(self._mm, 0, MAGIC, self.size, count, reserved, (generation + 1) & 0xFFFFFFFF)
+
+    def _check(self, number):
+        if not 1 <= number <= self.size:
+            raise ValueError(f"Número fuera de rango: {number}")
+
+    def is_set(self, number):
+        self._check(number)
+        return bool(self._mm[HEADER.size + (number >> 3)] & (1 << (number & 7)))
+
+    def count(self):
+        """Números tomados (O(1): se lee del encabezado)"""
+        return self._header()[2]
+
+    def free_count(self):
+        return self.size - self.count()
+
+    def reserved_count(self):
+        """De los tomados, cuántos son reservas sin confirmar (O(1))"""
+        return self._header()[3]
+
+    def add_reserved(self, delta):
+        """Suma `delta` (negativo al confirmar o liberar) al contador de reservados"""
+        with self._file.lock():
+            self._write_counts(reserved=self.reserved_count() + delta)
+
+    @property
+    def generation(self):
+        """Contador que cambia con cada escritura (útil como versión)"""
+        return self._header()[4]
+
+    def _update(self, numbers, value):
+        changed = 0
+        for number in numbers:
+            self._check(number)
+            pos = HEADER.size + (number >> 3)
+            bit = 1 << (number & 7)
+            current = self._mm[pos]
+            if bool(current & bit) != value:
+                self._mm[pos] = current | bit if value else current & ~bit
+                changed += 1
+        return changed
+
+    def set_many(self, numbers):
+        """Marca números como tomados"""
+        with self._file.lock():
+            changed = self._update(numbers, True)
+            self._write_counts(self.count() + changed)
+
+    def clear_many(self, numbers):
+        """Marca números como libres"""
+        with self._file.lock():
+            changed = self._update(numbers, False)
+            self._write_counts(self.count() - changed)
+
+    def load(self, numbers, reserved=0):
+        """Reemplaza todo el contenido con `numbers`, `reserved` de ellos reservados (reconstrucción)"""
+        with self._file.lock():
+            self._mm[HEADER.size:] = bytes(self._nbytes)
+            changed = self._update(numbers, True)
+            self._write_counts(changed, reserved)
+
+    def taken(self):
+        """Itera los números tomados (O(pool), solo para verificaciones)"""
+        data = self._mm[HEADER.size:]
+        for i, byte in enumerate(data):
+            if byte:
+                for b in range(8):
+                    if byte & (1 << b):
+                        yield i * 8 + b
+
+    def diff(self, numbers):
+        """Compara con el conjunto real: (faltan en el bitmap, sobran en el bitmap)"""
+        expected = set(numbers)
+        actual = set(self.taken())
+        return sorted(expected - actual), sorted(actual - expected)
+
+    def to_bytes(self):
+        """Copia de los bits (el byte 0 incluye el bit 0, que no se usa)"""
+        return bytes(self._mm[HEADER.size:])
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,93 @@
+"""
+Circuit breaker simple para dependencias externas (Postgres, APIs)
+"""
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """La dependencia está marcada como caída; se falla rápido"""
+
+
+class CircuitBreaker:
+    """
+    Abre el circuito tras `failure_threshold` fallos consecutivos.
+    Mientras está abierto, allow() retorna False; pasado `reset_timeout`
+    deja pasar una petición de prueba (half-open) que lo cierra o lo reabre.
+    """
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._last_error = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+        return self._state
+
+    def allow(self):
+        """Indica si se puede intentar una llamada a la dependencia"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN:
+                # Solo una llamada de prueba; las demás siguen fallando rápido
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info(f"✅ Circuito '{self.name}' cerrado")
+            self._state = CLOSED
+            self._failures = 0
+            self._opened_at = None
+            self._last_error = None
+
+    def record_failure(self, error=None):
+        """Registra un fallo; retorna True si el circuito acaba de abrirse"""
+        with self._lock:
+            self._failures += 1
+            self._last_error = str(error) if error else None
+            if self._state != OPEN and (self._state == HALF_OPEN or self._failures >= self.failure_threshold):
+                was_closed = self._state == CLOSED
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                logger.warning(f"⚠️ Circuito '{self.name}' abierto tras {self._failures} fallos: {error}")
+                return was_closed
+            if self._state == OPEN:
+                self._opened_at = time.monotonic()
+            return False
+
+    def snapshot(self):
+        """Estado serializable para endpoints de monitoreo"""
+        with self._lock:
+            state = self._current_state()
+            return {
+                'name': self.name,
+                'state': state,
+                'failures': self._failures,
+                'open_for_seconds': round(time.monotonic() - self._opened_at, 1) if self._opened_at else None,
+                'last_error': self._last_error,
+            }
@@ -0,0 +1,83 @@
+"""
+Caché en memoria por proceso con vencimiento (TTL).
+
+Cada worker de gunicorn tiene la suya. Los misses concurrentes de una misma
+clave se colapsan: un solo hilo ejecuta la carga y los demás esperan su
+resultado en vez de repetir la consulta.
+"""
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    Guarda valores por clave durante `ttl` segundos. Opcionalmente cada
+    valor lleva una `version` (p. ej. la generación del bitmap compartido):
+    si cambia, el valor se considera vencido aunque no haya pasado el TTL.
+    """
+
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = ttl
+        self._entries = {}
+        self._epochs = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key_lock(self, key):
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def _fresh(self, key, version):
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.monotonic() and entry[2] == version:
+            return entry
+        return None
+
+    def get(self, key, loader, version=None):
+        """Retorna el valor de `key`, cargándolo con `loader()` si venció"""
+        entry = self._fresh(key, version)
+        if entry:
+            self.hits += 1
+            return entry[0]
+
+        with self._key_lock(key):
+            # Otro hilo pudo cargarlo mientras esperábamos el lock
+            entry = self._fresh(key, version)
+            if entry:
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            epoch = self._epochs.get(key, 0)
+            value = loader()
+            # Si se invalidó durante la carga, el valor ya nació viejo
+            if self._epochs.get(key, 0) == epoch:
+                self._entries[key] = (value, time.monotonic() + self.ttl, version)
+            return value
+
+    def invalidate(self, key=None):
+        """Descarta `key` (o todas las claves)"""
+        with self._lock:
+            keys = list(self._entries) if key is None else [key]
+            for k in keys:
+                self._entries.pop(k, None)
+                self._epochs[k] = self._epochs.get(k, 0) + 1
+
+    def snapshot(self):
+        """Estadísticas serializables para endpoints de monitoreo"""
+        return {
+            'name': self.name,
+            'ttl': self.ttl,
+            'keys': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,79 @@
+"""
+Log de captura de webhooks: comprimido (gzip) y de solo anexar.
+
+Con WEBHOOK_CAPTURE_PATH configurado, cada POST a /webhooks/mercadopago y
+/confirmation se guarda tal como llegó (ruta, query, headers relevantes y
+cuerpo) para reproducirlo después con scripts/webhook_harness.py. Cada
+registro es un miembro gzip independiente escrito con O_APPEND bajo flock,
+así varios workers comparten el archivo y un corte a mitad de escritura no
+daña los registros anteriores. Contiene datos personales de los pagadores:
+el archivo se crea con permisos 0600.
+
+    log = CaptureLog('/var/log/rifa/webhooks.log.gz')
+    log.append(request_record(request))
+    for record in read_records('/var/log/rifa/webhooks.log.gz'): ...
+"""
+import os
+import gzip
+import json
+import time
+import zlib
+import threading
+import logging
+
+from app.shmem import flock
+
+logger = logging.getLogger(__name__)
+
+CAPTURED_PATHS = ('/webhooks/mercadopago', '/confirmation')
+# Headers necesarios para reproducir la notificación (firmas incluidas)
+CAPTURED_HEADERS = ('Content-Type', 'User-Agent', 'X-Signature', 'X-Request-Id')
+
+
+def request_record(request):
+    """Registro serializable de una petición de Flask"""
+    return {
+        'ts': time.time(),
+        'method': request.method,
+        'path': request.path,
+        'query': request.query_string.decode('latin-1'),
+        'headers': {name: request.headers[name] for name in CAPTURED_HEADERS if name in request.headers},
+        'body': request.get_data(as_text=True),
+    }
+
+
+class CaptureLog:
+    """Archivo gzip de solo anexar compartido por los procesos de la máquina"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def _file(self):
+        # Reabrir tras un fork: cada proceso usa su propio descriptor
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            self._pid = os.getpid()
+        return self._fd
+
+    def append(self, record):
+        data = gzip.compress((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+        with self._lock:
+            fd = self._file()
+            with flock(fd):
+                os.write(fd, data)
+            self.written += 1
+
+
+def read_records(path):
+    """Genera los registros del log en orden; ignora un último registro truncado"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.endswith('\n'):
+                    yield json.loads(line)
+        except (EOFError, zlib.error, gzip.BadGzipFile) as e:
+            logger.warning(f"⚠️ Log de captura truncado en {path}: {e}")
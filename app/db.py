@@ -2,9 +2,19 @@ import os
 import psycopg 
 import sqlite3
 import logging
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool, PoolTimeout
 from urllib.parse import urlparse
 
+from app.bitmap import NumberBitmap
+from app.breaker import CircuitBreaker
+
 logger = logging.getLogger(__name__)
 
 # Configuración de base de datos
@@ -14,40 +24,285 @@ DB_NAME = os.getenv('DB_NAME', 'rifa_db')
 DB_USER = os.getenv('DB_USER', 'rifa_user')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'rifa_password')
 
+# Configuración del pool de conexiones (uno por proceso de gunicorn).
+# Con workers gevent cada worker atiende hasta --worker-connections (2000) greenlets, así que el
+# tamaño del pool no sale de los hilos: es lo que Postgres aguanta por worker (4 workers x 10 = 40
+# conexiones). Los greenlets de más hacen fila en _db_slots, barata y con espera más larga que el
+# pool; los hilos de fondo y los trabajos de app/jobs.py hacen la misma fila.
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))            # espera máxima por una conexión
+DB_QUEUE_TIMEOUT = float(os.getenv('DB_QUEUE_TIMEOUT', '30'))          # espera máxima en la fila de _db_slots
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))         # espera máxima al abrir una conexión nueva
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))  # reciclar conexiones cada 30 min
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', '300'))
+
+# Backend: 'postgres', 'sqlite' o 'auto' (se decide una sola vez por proceso)
+DB_BACKEND = os.getenv('DB_BACKEND', 'auto').lower()
+DB_BREAKER_THRESHOLD = int(os.getenv('DB_BREAKER_THRESHOLD', '3'))
+DB_BREAKER_RESET = float(os.getenv('DB_BREAKER_RESET', '15'))  # segundos entre sondeos
+
+SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'rifa.db'))
+
+# Rifa por defecto (la original de 2000 números) y su tamaño
+DEFAULT_RAFFLE_ID = 1
+POOL_SIZE = 2000
+MAX_POOL_SIZE = 1_000_000
+
+# Búsqueda de compras del panel (ver app/search.py). El índice de trigramas
+# de Postgres se crea sobre esta misma expresión para que las consultas lo usen
+PURCHASE_SEARCH_SQL = (
+    "LOWER(COALESCE(full_name, '') || ' ' || COALESCE(email, '') || ' ' || "
+    "COALESCE(phone, '') || ' ' || COALESCE(document_number, ''))"
+)
+
+# Bitmaps de números tomados (uno por rifa) compartidos por los workers de esta máquina
+BITMAP_DIR = os.getenv('NUMBER_BITMAP_DIR', tempfile.gettempdir())
+
+# Reservas de checkout: minutos que se apartan los números y frecuencia del barrido
+RESERVATION_MINUTES = int(os.getenv('RESERVATION_MINUTES', '15'))
+RESERVATION_SWEEP_INTERVAL = float(os.getenv('RESERVATION_SWEEP_INTERVAL', '30'))
+RESERVATION_SWEEP_BATCH = int(os.getenv('RESERVATION_SWEEP_BATCH', '500'))
+# Números que un mismo cliente (IP) puede tener apartados a la vez
+MAX_HOLDS_PER_CLIENT = int(os.getenv('MAX_HOLDS_PER_CLIENT', '200'))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+_backend = None
+_backend_lock = threading.Lock()
+_pg_breaker = CircuitBreaker('postgres', failure_threshold=DB_BREAKER_THRESHOLD, reset_timeout=DB_BREAKER_RESET)
+# Un turno por conexión del pool. gunicorn aplica el monkey patch de gevent antes de cargar la app,
+# así que esperar aquí cede el greenlet en vez de bloquear el worker
+_db_slots = threading.BoundedSemaphore(max(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE))
+_probe_thread = None
+
+_bitmaps = {}
+_bitmaps_lock = threading.Lock()
+_raffles = {}
+
+_sweeper_thread = None
+_sweeper_pid = None
+
+
+class DatabaseUnavailable(Exception):
+    """Postgres está caído (circuito abierto): se falla rápido sin esperar timeouts"""
+
+
+def _postgres_conninfo():
+    """Cadena de conexión: DATABASE_URL o credenciales individuales"""
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        # psycopg 3 acepta directamente la URL
+        return database_url
+    return f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} sslmode=require"
+
 
 def get_postgres_connection():
     """Crea conexión a PostgreSQL con psycopg 3"""
     try:
-        # Opción 1: Usar DATABASE_URL si está disponible
-        database_url = os.getenv('DATABASE_URL')
-        if database_url:
-            # psycopg 3 acepta directamente la URL
-            return psycopg.connect(database_url, autocommit=False)
-        
-        # Opción 2: Usar credenciales individuales
-        conninfo = f"host={DB_HOST} port={DB_PORT} dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} sslmode=require"
-        return psycopg.connect(conninfo, autocommit=False)
-        
+        return psycopg.connect(_postgres_conninfo(), autocommit=False, connect_timeout=DB_CONNECT_TIMEOUT)
     except Exception as e:
         logger.error(f"Error conectando a PostgreSQL: {e}")
         raise
 
 
+def get_pool():
+    """Retorna el pool de conexiones del proceso actual (lo crea si no existe)"""
+    global _pool, _pool_pid
+
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # Conexión de prueba: falla rápido si Postgres no responde
+            get_postgres_connection().close()
+
+            # Tras un fork no se reutiliza el pool del proceso padre
+            pool = ConnectionPool(
+                _postgres_conninfo(),
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=max(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+                timeout=DB_POOL_TIMEOUT,
+                max_lifetime=DB_POOL_MAX_LIFETIME,
+                max_idle=DB_POOL_MAX_IDLE,
+                check=ConnectionPool.check_connection,
+                kwargs={'autocommit': False, 'connect_timeout': DB_CONNECT_TIMEOUT},
+                name=f"rifa-{pid}",
+                open=False,
+            )
+            try:
+                pool.open(wait=True, timeout=DB_POOL_TIMEOUT)
+            except Exception:
+                pool.close()
+                raise
+            _pool = pool
+            _pool_pid = pid
+            logger.info(
+                f"✅ Pool PostgreSQL abierto (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})"
+            )
+    return _pool
+
+
+def close_pool():
+    """Cierra el pool del proceso actual"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = None
+        _pool_pid = None
+
+
+def get_pool_stats():
+    """Estadísticas del pool para monitorear saturación"""
+    if _pool is None or _pool_pid != os.getpid():
+        return {'open': False, 'pid': os.getpid()}
+
+    stats = _pool.get_stats()
+    stats.update({
+        'open': True,
+        'pid': os.getpid(),
+        'min_size': _pool.min_size,
+        'max_size': _pool.max_size,
+    })
+    return stats
+
+
+def get_backend():
+    """
+    Retorna el backend activo ('postgres' o 'sqlite').
+    Se elige una sola vez por proceso: con DB_BACKEND fijo, o en modo 'auto'
+    usando Postgres si está configurado explícitamente o responde al sondeo.
+    Una vez elegido Postgres nunca se cae silenciosamente a SQLite.
+    """
+    global _backend
+    if _backend is not None:
+        return _backend
+
+    with _backend_lock:
+        if _backend is None:
+            if DB_BACKEND in ('postgres', 'sqlite'):
+                _backend = DB_BACKEND
+            elif os.getenv('DATABASE_URL') or os.getenv('DB_HOST'):
+                _backend = 'postgres'
+            else:
+                try:
+                    get_pool()
+                    _backend = 'postgres'
+                except Exception as e:
+                    logger.warning(f"⚠️ PostgreSQL no disponible, usando SQLite: {e}")
+                    _backend = 'sqlite'
+            logger.info(f"🗄️ Backend de base de datos: {_backend}")
+    return _backend
+
+
+def is_sqlite():
+    """True si el backend activo es SQLite"""
+    return get_backend() == 'sqlite'
+
+
+def get_backend_status():
+    """Backend activo, estado del circuito y del pool (para monitoreo)"""
+    return {
+        'backend': get_backend(),
+        'breaker': _pg_breaker.snapshot(),
+        'pool': get_pool_stats(),
+    }
+
+
+def _sqlite_connect():
+    return sqlite3.connect(SQLITE_PATH)
+
+
 def get_db_connection():
-    """Retorna conexión a Postgres o SQLite como fallback"""
+    """Retorna una conexión nueva (sin pool) al backend activo"""
+    if get_backend() == 'postgres':
+        return get_postgres_connection()
+    return _sqlite_connect()
+
+
+def _probe_postgres():
+    """Sondea Postgres en segundo plano hasta que vuelva a responder"""
+    while _pg_breaker.state != 'closed':
+        time.sleep(DB_BREAKER_RESET)
+        try:
+            get_postgres_connection().close()
+            _pg_breaker.record_success()
+            logger.info("✅ PostgreSQL respondió de nuevo")
+        except Exception as e:
+            _pg_breaker.record_failure(e)
+
+
+def _record_postgres_failure(error):
+    global _probe_thread
+    if _pg_breaker.record_failure(error) and (_probe_thread is None or not _probe_thread.is_alive()):
+        _probe_thread = threading.Thread(target=_probe_postgres, name='pg-probe', daemon=True)
+        _probe_thread.start()
+
+
+def _pool_saturated(pool):
+    """True si el pool ya tiene abiertas todas sus conexiones (esperar una no es una caída)"""
+    return pool is not None and pool.get_stats().get('pool_size', 0) >= pool.max_size
+
+
+@contextmanager
+def _connection():
+    """
+    Presta una conexión: del pool de Postgres o una nueva de SQLite.
+    Al circuito solo llegan los fallos al obtener o abrir la conexión; los
+    errores del bloque (deadlocks, conflictos de serialización, SQL) son del
+    llamador, y un PoolTimeout con el pool lleno es saturación, no caída.
+    En Postgres se espera turno en _db_slots antes de pedir la conexión.
+    """
+    if get_backend() == 'sqlite':
+        conn = _sqlite_connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+
+    if not _pg_breaker.allow():
+        raise DatabaseUnavailable("PostgreSQL no disponible (circuito abierto)")
+
+    if not _db_slots.acquire(timeout=DB_QUEUE_TIMEOUT):
+        raise PoolTimeout(f"Sin turno para la base de datos tras {DB_QUEUE_TIMEOUT:g}s")
+    pool = None
+    acquired = False
     try:
-        conn = get_postgres_connection()
-        logger.info("✅ Conectado a PostgreSQL")
-        return conn
-    except Exception as e:
-        logger.warning(f"⚠️ PostgreSQL no disponible, usando SQLite: {e}")
-        sqlite_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'rifa.db')
-        conn = sqlite3.connect(sqlite_path)
-        return conn
+        pool = get_pool()
+        with pool.connection() as conn:
+            acquired = True
+            _pg_breaker.record_success()
+            yield conn
+    except (psycopg.OperationalError, PoolTimeout) as e:
+        if not acquired and not (isinstance(e, PoolTimeout) and _pool_saturated(pool)):
+            _record_postgres_failure(e)
+        raise
+    finally:
+        _db_slots.release()
 
 
 def init_db():
-    """Inicializa las tablas de la base de datos"""
+    """Inicializa las tablas de la base de datos del backend activo"""
+    if get_backend() == 'postgres':
+        _init_postgres_schema()
+    else:
+        _init_sqlite_schema()
+    for raffle in get_raffles():
+        seed_number_pool(raffle['id'])
+        rebuild_number_bitmap(raffle['id'])
+        if get_raffle_stats(raffle['id'], packages=False) is None:
+            # Base de datos anterior a raffle_stats: calcularlas una vez
+            rebuild_raffle_stats(raffle['id'])
+
+
+def _init_postgres_schema():
+    """Crea las tablas e índices en PostgreSQL"""
     try:
         conn = get_postgres_connection()
         cur = conn.cursor()
@@ -74,15 +329,49 @@ def init_db():
                       transaction_id VARCHAR(255),
                       franchise VARCHAR(100),
                       response_code VARCHAR(50),
-                      confirmed_at TIMESTAMP)''')
+                      confirmed_at TIMESTAMP,
+                      raffle_id INTEGER NOT NULL DEFAULT 1)''')
         
-        # Tabla de números asignados
+        # Tabla de números asignados (la clave incluye la rifa)
         cur.execute('''CREATE TABLE IF NOT EXISTS assigned_numbers
-                     (number INTEGER PRIMARY KEY,
+                     (number INTEGER NOT NULL,
                       invoice_id VARCHAR(255),
                       assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                       reserved_until TIMESTAMP,
-                      is_confirmed BOOLEAN DEFAULT FALSE)''')
+                      is_confirmed BOOLEAN DEFAULT FALSE,
+                      raffle_id INTEGER NOT NULL DEFAULT 1,
+                      held_by VARCHAR(255),
+                      PRIMARY KEY (raffle_id, number))''')
+        
+        # Rifas: cada una con su pool de números y precio por número.
+        # next_position/tail_position son la cabeza y la cola de la permutación.
+        cur.execute('''CREATE TABLE IF NOT EXISTS raffles
+                     (id SERIAL PRIMARY KEY,
+                      name VARCHAR(255) NOT NULL,
+                      pool_size INTEGER NOT NULL,
+                      number_price DECIMAL(10,2) NOT NULL,
+                      status VARCHAR(50) DEFAULT 'active',
+                      next_position INTEGER NOT NULL DEFAULT 1,
+                      tail_position INTEGER NOT NULL DEFAULT 0,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        cur.execute('''INSERT INTO raffles (id, name, pool_size, number_price)
+                       VALUES (1, 'Rifa 5 Millones', 2000, 6250)
+                       ON CONFLICT (id) DO NOTHING''')
+        cur.execute('''SELECT setval(pg_get_serial_sequence('raffles', 'id'), (SELECT MAX(id) FROM raffles))''')
+        
+        # Migración a multi-rifa de tablas creadas antes de existir raffle_id
+        cur.execute('''ALTER TABLE purchases ADD COLUMN IF NOT EXISTS raffle_id INTEGER NOT NULL DEFAULT 1''')
+        cur.execute('''ALTER TABLE assigned_numbers ADD COLUMN IF NOT EXISTS raffle_id INTEGER NOT NULL DEFAULT 1''')
+        cur.execute('''ALTER TABLE assigned_numbers ADD COLUMN IF NOT EXISTS held_by VARCHAR(255)''')
+        cur.execute('''DO $$
+                       BEGIN
+                           IF (SELECT COUNT(*) FROM information_schema.key_column_usage
+                               WHERE table_name = 'assigned_numbers'
+                                 AND constraint_name = 'assigned_numbers_pkey') = 1 THEN
+                               ALTER TABLE assigned_numbers DROP CONSTRAINT assigned_numbers_pkey;
+                               ALTER TABLE assigned_numbers ADD PRIMARY KEY (raffle_id, number);
+                           END IF;
+                       END $$''')
         
         # Tabla de configuración de números benditos
         cur.execute('''CREATE TABLE IF NOT EXISTS blessed_numbers_config
@@ -119,90 +408,381 @@ def init_db():
         cur.execute('''CREATE INDEX IF NOT EXISTS idx_purchases_created_at ON purchases(created_at)''')
         cur.execute('''CREATE INDEX IF NOT EXISTS idx_assigned_invoice ON assigned_numbers(invoice_id)''')
         cur.execute('''CREATE INDEX IF NOT EXISTS idx_assigned_confirmed ON assigned_numbers(is_confirmed)''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_assigned_reserved ON assigned_numbers(reserved_until) WHERE is_confirmed = FALSE''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_assigned_held_by ON assigned_numbers(held_by) WHERE is_confirmed = FALSE''')
         cur.execute('''CREATE INDEX IF NOT EXISTS idx_admin_email ON admin_users(email)''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_purchases_raffle ON purchases(raffle_id)''')
+        # Paginación por keyset del panel: (created_at, id) dentro de la rifa
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_purchases_raffle_created ON purchases(raffle_id, created_at, id)''')
+        
+        # Pool de números por rifa en una permutación aleatoria (position):
+        # se consume desde raffles.next_position, así reclamar k números cuesta
+        # O(k) sin importar el tamaño del pool
+        cur.execute('''CREATE TABLE IF NOT EXISTS number_pool
+                     (raffle_id INTEGER NOT NULL DEFAULT 1,
+                      number INTEGER NOT NULL,
+                      position INTEGER NOT NULL,
+                      invoice_id VARCHAR(255),
+                      claimed_at TIMESTAMP,
+                      PRIMARY KEY (raffle_id, number))''')
+        cur.execute('''ALTER TABLE number_pool ADD COLUMN IF NOT EXISTS raffle_id INTEGER NOT NULL DEFAULT 1''')
+        cur.execute('''DO $$
+                       BEGIN
+                           IF (SELECT COUNT(*) FROM information_schema.key_column_usage
+                               WHERE table_name = 'number_pool'
+                                 AND constraint_name = 'number_pool_pkey') = 1 THEN
+                               ALTER TABLE number_pool DROP CONSTRAINT number_pool_pkey;
+                               ALTER TABLE number_pool ADD PRIMARY KEY (raffle_id, number);
+                           END IF;
+                       END $$''')
+        cur.execute('''DROP INDEX IF EXISTS idx_number_pool_free''')
+        cur.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_number_pool_position ON number_pool(raffle_id, position)''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_number_pool_invoice ON number_pool(invoice_id)''')
+        
+        # Agregados por rifa, mantenidos en la misma transacción que confirma
+        # o elimina una compra (ver _apply_purchase_stats)
+        cur.execute('''CREATE TABLE IF NOT EXISTS raffle_stats
+                     (raffle_id INTEGER PRIMARY KEY,
+                      confirmed_numbers INTEGER NOT NULL DEFAULT 0,
+                      confirmed_purchases INTEGER NOT NULL DEFAULT 0,
+                      revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+                      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS raffle_package_stats
+                     (raffle_id INTEGER NOT NULL,
+                      amount DECIMAL(10,2) NOT NULL,
+                      purchases INTEGER NOT NULL DEFAULT 0,
+                      PRIMARY KEY (raffle_id, amount))''')
+        
+        # Cola de trabajos durable (ver app/jobs.py)
+        cur.execute('''CREATE TABLE IF NOT EXISTS jobs
+                     (id SERIAL PRIMARY KEY,
+                      kind VARCHAR(50) NOT NULL,
+                      payload TEXT NOT NULL,
+                      status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                      attempts INTEGER NOT NULL DEFAULT 0,
+                      max_attempts INTEGER NOT NULL DEFAULT 8,
+                      run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                      locked_until TIMESTAMP,
+                      last_error TEXT,
+                      dedupe_key VARCHAR(255),
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(kind, run_at) WHERE status IN ('pending', 'running')''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_jobs_dedupe_key ON jobs(dedupe_key)''')
+        # Un solo trabajo activo por dedupe_key (enqueue inserta con ON CONFLICT / OR IGNORE).
+        # Los duplicados que dejó el índice anterior, no único, van a dead-letter
+        cur.execute('''DROP INDEX IF EXISTS idx_jobs_dedupe''')
+        cur.execute('''UPDATE jobs SET status = 'dead', locked_until = NULL,
+                              last_error = 'Duplicado de un trabajo activo con la misma dedupe_key'
+                       WHERE status IN ('pending', 'running') AND dedupe_key IS NOT NULL
+                         AND id > (SELECT MIN(active.id) FROM jobs active
+                                   WHERE active.dedupe_key = jobs.dedupe_key AND active.status IN ('pending', 'running'))''')
+        cur.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe_active ON jobs(dedupe_key) WHERE status IN ('pending', 'running')''')
+        
+        # Notificaciones de pasarelas ya procesadas (ver app/idempotency.py)
+        cur.execute('''CREATE TABLE IF NOT EXISTS processed_events
+                     (gateway VARCHAR(50) NOT NULL,
+                      event_id VARCHAR(255) NOT NULL,
+                      status VARCHAR(20) NOT NULL DEFAULT 'processing',
+                      claimed_at TIMESTAMP NOT NULL,
+                      completed_at TIMESTAMP,
+                      PRIMARY KEY (gateway, event_id))''')
+        
+        # Bandeja de salida de emails (ver app/mailer.py)
+        cur.execute('''CREATE TABLE IF NOT EXISTS email_outbox
+                     (id SERIAL PRIMARY KEY,
+                      kind VARCHAR(50) NOT NULL,
+                      ref VARCHAR(255),
+                      to_email VARCHAR(255) NOT NULL,
+                      to_name VARCHAR(255),
+                      subject TEXT NOT NULL,
+                      html_content TEXT NOT NULL,
+                      text_content TEXT,
+                      status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                      attempts INTEGER NOT NULL DEFAULT 0,
+                      run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                      locked_until TIMESTAMP,
+                      message_id VARCHAR(255),
+                      last_error TEXT,
+                      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                      sent_at TIMESTAMP)''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_email_outbox_ready ON email_outbox(run_at) WHERE status IN ('pending', 'sending')''')
+        cur.execute('''CREATE INDEX IF NOT EXISTS idx_email_outbox_ref ON email_outbox(kind, ref)''')
+        
+        # Búsqueda del panel (/database): trigramas sobre los datos del
+        # comprador; los números se buscan por la clave de assigned_numbers.
+        # Sin permiso para pg_trgm la búsqueda sigue funcionando con LIKE
+        cur.execute('''DROP INDEX IF EXISTS idx_purchases_numbers''')
+        cur.execute('SAVEPOINT search_trgm')
+        try:
+            cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cur.execute(f'''CREATE INDEX IF NOT EXISTS idx_purchases_search_trgm
+                            ON purchases USING GIN (({PURCHASE_SEARCH_SQL}) gin_trgm_ops)''')
+            cur.execute('RELEASE SAVEPOINT search_trgm')
+        except Exception as e:
+            cur.execute('ROLLBACK TO SAVEPOINT search_trgm')
+            logger.warning(f'⚠️ pg_trgm no disponible, la búsqueda de compras no usará índice: {e}')
         
         conn.commit()
         cur.close()
         conn.close()
         logger.info('✅ Tablas PostgreSQL inicializadas correctamente')
-        return
         
     except Exception as e:
-        logger.warning(f'⚠️ No se pudo inicializar PostgreSQL, usando SQLite: {e}')
+        logger.error(f'❌ Error inicializando PostgreSQL: {e}')
+        raise
+
+
+def _sqlite_columns(sc, table):
+    return [row[1] for row in sc.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def _sqlite_create_keyed_by_raffle(sc, table, create_sql):
+    """
+    Crea `table` con clave (raffle_id, number). SQLite no permite cambiar la
+    clave primaria, así que una tabla anterior a multi-rifa se reconstruye
+    copiando sus filas (quedan en la rifa 1).
+    """
+    columns = _sqlite_columns(sc, table)
+    if columns and 'raffle_id' not in columns:
+        sc.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+        sc.execute(create_sql)
+        column_list = ', '.join(columns)
+        sc.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {table}_old")
+        sc.execute(f"DROP TABLE {table}_old")
+        logger.info(f"✅ Tabla {table} migrada a multi-rifa")
+    else:
+        sc.execute(create_sql)
+
+
+PURCHASE_SEARCH_COLUMNS = "rowid, full_name, email, phone, document_number"
+
+
+def _sqlite_search_values(row):
+    """Valores indexados de `row` (new/old)"""
+    return f"{row}.id, {row}.full_name, {row}.email, {row}.phone, {row}.document_number"
+
+
+def _sqlite_create_purchase_search(sc):
+    """
+    Crea purchases_search (FTS5 sin contenido, tokenizer trigram) y los
+    triggers que lo mantienen al insertar, editar y borrar compras. Si la
+    tabla es nueva se llena con las compras existentes. Los números no se
+    indexan aquí: se buscan por la clave de assigned_numbers.
+    """
+    existing = sc.execute("SELECT sql FROM sqlite_master WHERE name = 'purchases_search'").fetchone()
+    if existing and 'numbers' in existing[0]:
+        for trigger in ('insert', 'delete', 'update'):
+            sc.execute(f"DROP TRIGGER IF EXISTS purchases_search_{trigger}")
+        sc.execute("DROP TABLE purchases_search")
+        existing = None
+    try:
+        sc.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS purchases_search
+                      USING fts5(full_name, email, phone, document_number, content='', tokenize='trigram')''')
+    except sqlite3.OperationalError as e:
+        logger.warning(f'⚠️ SQLite sin FTS5/trigram, la búsqueda de compras no usará índice: {e}')
+        return
+    
+    insert_new = f"INSERT INTO purchases_search ({PURCHASE_SEARCH_COLUMNS}) VALUES ({_sqlite_search_values('new')});"
+    delete_old = (f"INSERT INTO purchases_search (purchases_search, {PURCHASE_SEARCH_COLUMNS}) "
+                  f"VALUES ('delete', {_sqlite_search_values('old')});")
+    sc.execute(f'''CREATE TRIGGER IF NOT EXISTS purchases_search_insert AFTER INSERT ON purchases
+                   BEGIN {insert_new} END''')
+    sc.execute(f'''CREATE TRIGGER IF NOT EXISTS purchases_search_delete AFTER DELETE ON purchases
+                   BEGIN {delete_old} END''')
+    sc.execute(f'''CREATE TRIGGER IF NOT EXISTS purchases_search_update
+                   AFTER UPDATE OF full_name, email, phone, document_number ON purchases
+                   BEGIN {delete_old} {insert_new} END''')
+    if not existing:
+        sc.execute(f'''INSERT INTO purchases_search ({PURCHASE_SEARCH_COLUMNS})
+                       SELECT {_sqlite_search_values('purchases')} FROM purchases''')
+
+
+def _init_sqlite_schema():
+    """Crea las tablas en SQLite"""
+    sqlite_path = SQLITE_PATH
+    try:
+        sconn = sqlite3.connect(sqlite_path)
+        sc = sconn.cursor()
         
-        # Fallback a SQLite
-        sqlite_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'rifa.db')
-        try:
-            sconn = sqlite3.connect(sqlite_path)
-            sc = sconn.cursor()
-            
-            # Tabla de compras
-            sc.execute('''CREATE TABLE IF NOT EXISTS purchases
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           invoice_id TEXT UNIQUE NOT NULL,
-                           amount REAL NOT NULL,
-                           email TEXT NOT NULL,
-                           numbers TEXT NOT NULL,
-                           status TEXT DEFAULT 'pending',
-                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                           updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                           deleted_at TIMESTAMP,
-                           notes TEXT,
-                           full_name TEXT,
-                           document_type TEXT,
-                           document_number TEXT,
-                           phone TEXT,
-                           address TEXT,
-                           payment_method TEXT,
-                           bank_name TEXT,
-                           transaction_id TEXT,
-                           franchise TEXT,
-                           response_code TEXT,
-                           confirmed_at TIMESTAMP)''')
-            
-            # Tabla de números asignados
-            sc.execute('''CREATE TABLE IF NOT EXISTS assigned_numbers
-                          (number INTEGER PRIMARY KEY,
-                           invoice_id TEXT,
-                           assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                           reserved_until TIMESTAMP,
-                           is_confirmed INTEGER DEFAULT 0)''')
-            
-            # Tabla de configuración de números benditos
-            sc.execute('''CREATE TABLE IF NOT EXISTS blessed_numbers_config
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           visible INTEGER DEFAULT 0,
-                           scheduled_date TEXT,
-                           numbers TEXT,
-                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                           updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-            
-            # Tabla de usuarios admin
-            sc.execute('''CREATE TABLE IF NOT EXISTS admin_users
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           email TEXT UNIQUE NOT NULL,
-                           password_hash TEXT NOT NULL,
-                           is_active INTEGER DEFAULT 1,
-                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                           updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-            
-            # Tabla de auditoría
-            sc.execute('''CREATE TABLE IF NOT EXISTS audit_log
-                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                           admin_user_id INTEGER,
-                           action TEXT,
-                           table_name TEXT,
-                           record_id INTEGER,
-                           old_values TEXT,
-                           new_values TEXT,
-                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-            
-            sconn.commit()
-            sconn.close()
-            logger.info('✅ Base de datos SQLite inicializada en: %s', sqlite_path)
-            
-        except Exception as e2:
-            logger.error(f'❌ Error inicializando SQLite: {e2}')
+        # Tabla de compras
+        sc.execute('''CREATE TABLE IF NOT EXISTS purchases
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       invoice_id TEXT UNIQUE NOT NULL,
+                       amount REAL NOT NULL,
+                       email TEXT NOT NULL,
+                       numbers TEXT NOT NULL,
+                       status TEXT DEFAULT 'pending',
+                       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       deleted_at TIMESTAMP,
+                       notes TEXT,
+                       full_name TEXT,
+                       document_type TEXT,
+                       document_number TEXT,
+                       phone TEXT,
+                       address TEXT,
+                       payment_method TEXT,
+                       bank_name TEXT,
+                       transaction_id TEXT,
+                       franchise TEXT,
+                       response_code TEXT,
+                       confirmed_at TIMESTAMP,
+                       raffle_id INTEGER NOT NULL DEFAULT 1)''')
+        if 'raffle_id' not in _sqlite_columns(sc, 'purchases'):
+            sc.execute('''ALTER TABLE purchases ADD COLUMN raffle_id INTEGER NOT NULL DEFAULT 1''')
+        
+        # Tabla de números asignados (la clave incluye la rifa)
+        _sqlite_create_keyed_by_raffle(sc, 'assigned_numbers', '''CREATE TABLE IF NOT EXISTS assigned_numbers
+                      (number INTEGER NOT NULL,
+                       invoice_id TEXT,
+                       assigned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       reserved_until TIMESTAMP,
+                       is_confirmed INTEGER DEFAULT 0,
+                       raffle_id INTEGER NOT NULL DEFAULT 1,
+                       held_by TEXT,
+                       PRIMARY KEY (raffle_id, number))''')
+        if 'held_by' not in _sqlite_columns(sc, 'assigned_numbers'):
+            sc.execute('''ALTER TABLE assigned_numbers ADD COLUMN held_by TEXT''')
+        
+        # Rifas
+        sc.execute('''CREATE TABLE IF NOT EXISTS raffles
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       name TEXT NOT NULL,
+                       pool_size INTEGER NOT NULL,
+                       number_price REAL NOT NULL,
+                       status TEXT DEFAULT 'active',
+                       next_position INTEGER NOT NULL DEFAULT 1,
+                       tail_position INTEGER NOT NULL DEFAULT 0,
+                       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        sc.execute('''INSERT OR IGNORE INTO raffles (id, name, pool_size, number_price)
+                      VALUES (1, 'Rifa 5 Millones', 2000, 6250)''')
+        
+        # Tabla de configuración de números benditos
+        sc.execute('''CREATE TABLE IF NOT EXISTS blessed_numbers_config
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       visible INTEGER DEFAULT 0,
+                       scheduled_date TEXT,
+                       numbers TEXT,
+                       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        
+        # Tabla de usuarios admin
+        sc.execute('''CREATE TABLE IF NOT EXISTS admin_users
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       email TEXT UNIQUE NOT NULL,
+                       password_hash TEXT NOT NULL,
+                       is_active INTEGER DEFAULT 1,
+                       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        
+        # Tabla de auditoría
+        sc.execute('''CREATE TABLE IF NOT EXISTS audit_log
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       admin_user_id INTEGER,
+                       action TEXT,
+                       table_name TEXT,
+                       record_id INTEGER,
+                       old_values TEXT,
+                       new_values TEXT,
+                       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        
+        # Pool de números por rifa en orden aleatorio
+        _sqlite_create_keyed_by_raffle(sc, 'number_pool', '''CREATE TABLE IF NOT EXISTS number_pool
+                      (raffle_id INTEGER NOT NULL DEFAULT 1,
+                       number INTEGER NOT NULL,
+                       position INTEGER NOT NULL,
+                       invoice_id TEXT,
+                       claimed_at TIMESTAMP,
+                       PRIMARY KEY (raffle_id, number))''')
+        sc.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_number_pool_position ON number_pool(raffle_id, position)''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_number_pool_invoice ON number_pool(invoice_id)''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_assigned_invoice ON assigned_numbers(invoice_id)''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_assigned_reserved ON assigned_numbers(reserved_until) WHERE is_confirmed = 0''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_assigned_held_by ON assigned_numbers(held_by) WHERE is_confirmed = 0''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_purchases_raffle ON purchases(raffle_id)''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_purchases_raffle_created ON purchases(raffle_id, created_at, id)''')
+        
+        # Agregados por rifa
+        sc.execute('''CREATE TABLE IF NOT EXISTS raffle_stats
+                      (raffle_id INTEGER PRIMARY KEY,
+                       confirmed_numbers INTEGER NOT NULL DEFAULT 0,
+                       confirmed_purchases INTEGER NOT NULL DEFAULT 0,
+                       revenue REAL NOT NULL DEFAULT 0,
+                       updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        sc.execute('''CREATE TABLE IF NOT EXISTS raffle_package_stats
+                      (raffle_id INTEGER NOT NULL,
+                       amount REAL NOT NULL,
+                       purchases INTEGER NOT NULL DEFAULT 0,
+                       PRIMARY KEY (raffle_id, amount))''')
+        
+        # Cola de trabajos durable
+        sc.execute('''CREATE TABLE IF NOT EXISTS jobs
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       kind TEXT NOT NULL,
+                       payload TEXT NOT NULL,
+                       status TEXT NOT NULL DEFAULT 'pending',
+                       attempts INTEGER NOT NULL DEFAULT 0,
+                       max_attempts INTEGER NOT NULL DEFAULT 8,
+                       run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                       locked_until TIMESTAMP,
+                       last_error TEXT,
+                       dedupe_key TEXT,
+                       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(kind, run_at) WHERE status IN ('pending', 'running')''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_jobs_dedupe_key ON jobs(dedupe_key)''')
+        # Un solo trabajo activo por dedupe_key (enqueue inserta con ON CONFLICT / OR IGNORE).
+        # Los duplicados que dejó el índice anterior, no único, van a dead-letter
+        sc.execute('''DROP INDEX IF EXISTS idx_jobs_dedupe''')
+        sc.execute('''UPDATE jobs SET status = 'dead', locked_until = NULL,
+                              last_error = 'Duplicado de un trabajo activo con la misma dedupe_key'
+                       WHERE status IN ('pending', 'running') AND dedupe_key IS NOT NULL
+                         AND id > (SELECT MIN(active.id) FROM jobs active
+                                   WHERE active.dedupe_key = jobs.dedupe_key AND active.status IN ('pending', 'running'))''')
+        sc.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe_active ON jobs(dedupe_key) WHERE status IN ('pending', 'running')''')
+        
+        # Notificaciones de pasarelas ya procesadas
+        sc.execute('''CREATE TABLE IF NOT EXISTS processed_events
+                      (gateway TEXT NOT NULL,
+                       event_id TEXT NOT NULL,
+                       status TEXT NOT NULL DEFAULT 'processing',
+                       claimed_at TIMESTAMP NOT NULL,
+                       completed_at TIMESTAMP,
+                       PRIMARY KEY (gateway, event_id))''')
+        
+        # Bandeja de salida de emails
+        sc.execute('''CREATE TABLE IF NOT EXISTS email_outbox
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                       kind TEXT NOT NULL,
+                       ref TEXT,
+                       to_email TEXT NOT NULL,
+                       to_name TEXT,
+                       subject TEXT NOT NULL,
+                       html_content TEXT NOT NULL,
+                       text_content TEXT,
+                       status TEXT NOT NULL DEFAULT 'pending',
+                       attempts INTEGER NOT NULL DEFAULT 0,
+                       run_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                       locked_until TIMESTAMP,
+                       message_id TEXT,
+                       last_error TEXT,
+                       created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       sent_at TIMESTAMP)''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_email_outbox_ready ON email_outbox(run_at) WHERE status IN ('pending', 'sending')''')
+        sc.execute('''CREATE INDEX IF NOT EXISTS idx_email_outbox_ref ON email_outbox(kind, ref)''')
+        
+        # Búsqueda del panel: índice FTS5 de trigramas sincronizado por triggers
+        _sqlite_create_purchase_search(sc)
+        
+        sconn.commit()
+        sconn.close()
+        logger.info('✅ Base de datos SQLite inicializada en: %s', sqlite_path)
+        
+    except Exception as e2:
+        logger.error(f'❌ Error inicializando SQLite: {e2}')
 
 
 def _is_sqlite_conn(conn):
@@ -210,70 +790,151 @@ def _is_sqlite_conn(conn):
     return isinstance(conn, sqlite3.Connection)
 
 
-def run_query(query, params=None, fetchone=False, fetchall=False, commit=False):
-    """Ejecuta una query SQL en Postgres o SQLite"""
-    conn = None
-    cur = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+class Transaction:
+    """Unidad de trabajo: todas las sentencias usan la misma conexión y transacción"""
 
-        q = query
-        p = params or ()
-        
-        # psycopg 3 usa placeholders %s igual que psycopg2
-        # Convertir solo para SQLite
-        if _is_sqlite_conn(conn):
-            q = query.replace('%s', '?')
+    def __init__(self, conn):
+        self.conn = conn
+        self.is_sqlite = _is_sqlite_conn(conn)
+        self._after_commit = []
 
-        cur.execute(q, p)
+    def on_commit(self, callback):
+        """Ejecuta `callback` solo si la transacción se confirma"""
+        self._after_commit.append(callback)
 
-        result = None
-        if commit:
-            conn.commit()
-        if fetchone:
-            result = cur.fetchone()
-        elif fetchall:
-            result = cur.fetchall()
+    def _sql(self, query):
+        # psycopg usa %s; SQLite usa ?
+        return query.replace('%s', '?') if self.is_sqlite else query
 
-        return result
-        
-    except Exception as e:
-        logger.error(f"Error ejecutando query: {e}")
-        if conn:
-            conn.rollback()
-        raise
-        
-    finally:
+    def execute(self, query, params=None, fetchone=False, fetchall=False):
+        """Ejecuta una sentencia; retorna la fila, las filas o el rowcount"""
+        cur = self.conn.cursor()
+        try:
+            cur.execute(self._sql(query), params or ())
+            if fetchone:
+                return cur.fetchone()
+            if fetchall:
+                return cur.fetchall()
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    def executemany(self, query, params_seq):
+        """Ejecuta la misma sentencia para cada tupla de parámetros"""
+        params_seq = list(params_seq)
+        if not params_seq:
+            return 0
+        cur = self.conn.cursor()
         try:
-            if cur:
-                cur.close()
+            cur.executemany(self._sql(query), params_seq)
+            return cur.rowcount
+        finally:
+            cur.close()
+
+    @contextmanager
+    def savepoint(self, name='sp'):
+        """Bloque que puede fallar sin abortar toda la transacción"""
+        self.execute(f"SAVEPOINT {name}")
+        try:
+            yield self
         except Exception:
-            pass
+            self.execute(f"ROLLBACK TO SAVEPOINT {name}")
+            raise
+        else:
+            self.execute(f"RELEASE SAVEPOINT {name}")
+
+
+@contextmanager
+def transaction():
+    """
+    Abre una transacción: commit al salir del bloque, rollback si hay excepción.
+
+        with db.transaction() as tx:
+            tx.execute("INSERT ...", params)
+            tx.executemany("INSERT ...", rows)
+    """
+    with _connection() as conn:
+        if _is_sqlite_conn(conn):
+            # Tomar el lock de escritura desde el inicio evita deadlocks entre workers
+            conn.isolation_level = None
+            conn.execute("BEGIN IMMEDIATE")
+        tx = Transaction(conn)
         try:
-            if conn:
-                conn.close()
+            yield tx
+            conn.commit()
         except Exception:
-            pass
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+
+    for callback in tx._after_commit:
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Error en callback post-commit: {e}")
 
 
-def count_assigned_numbers():
-    """Cuenta números asignados confirmados"""
+def run_query(query, params=None, fetchone=False, fetchall=False, commit=False):
+    """Ejecuta una query SQL en Postgres o SQLite"""
+    with _connection() as conn:
+        cur = None
+        try:
+            cur = conn.cursor()
+
+            q = query
+            p = params or ()
+            
+            # psycopg 3 usa placeholders %s igual que psycopg2
+            # Convertir solo para SQLite
+            if _is_sqlite_conn(conn):
+                q = query.replace('%s', '?')
+
+            cur.execute(q, p)
+
+            result = None
+            if fetchone:
+                result = cur.fetchone()
+            elif fetchall:
+                result = cur.fetchall()
+            if commit:
+                conn.commit()
+
+            return result
+            
+        except Exception as e:
+            logger.error(f"Error ejecutando query: {e}")
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+            
+        finally:
+            try:
+                if cur:
+                    cur.close()
+            except Exception:
+                pass
+
+
+def count_assigned_numbers(raffle_id=DEFAULT_RAFFLE_ID):
+    """Cuenta números asignados confirmados (tomados menos reservados, ambos del encabezado del bitmap)"""
     try:
-        conn = get_db_connection()
-        
-        if _is_sqlite_conn(conn):
-            # SQLite usa INTEGER (0 o 1)
-            row = run_query(
-                "SELECT COUNT(*) FROM assigned_numbers WHERE is_confirmed = 1", 
-                fetchone=True
-            )
-        else:
-            # PostgreSQL usa BOOLEAN
-            row = run_query(
-                "SELECT COUNT(*) FROM assigned_numbers WHERE is_confirmed = TRUE", 
-                fetchone=True
-            )
+        bitmap = get_number_bitmap(raffle_id)
+        return bitmap.count() - bitmap.reserved_count()
+    except Exception as e:
+        logger.warning(f"⚠️ Bitmap no disponible, contando en la base de datos: {e}")
+
+    try:
+        # SQLite usa INTEGER (0 o 1), PostgreSQL usa BOOLEAN
+        confirmed = '1' if is_sqlite() else 'TRUE'
+        row = run_query(
+            f"SELECT COUNT(*) FROM assigned_numbers WHERE raffle_id = %s AND is_confirmed = {confirmed}", 
+            params=(raffle_id,),
+            fetchone=True
+        )
         
         if not row:
             return 0
@@ -285,6 +946,771 @@ def count_assigned_numbers():
         return 0
 
 
+def count_reserved_numbers(raffle_id=DEFAULT_RAFFLE_ID):
+    """
+    Cuenta en la base de datos los números apartados por checkouts sin
+    confirmar. Para conteos frecuentes está el contador del bitmap
+    (reserved_count), que esto verifica y reconstruye.
+    """
+    confirmed = '0' if is_sqlite() else 'FALSE'
+    row = run_query(
+        f"SELECT COUNT(*) FROM assigned_numbers WHERE raffle_id = %s AND is_confirmed = {confirmed}",
+        params=(raffle_id,),
+        fetchone=True
+    )
+    return int(row[0]) if row else 0
+
+
+# ==================== RIFAS ====================
+
+RAFFLE_COLUMNS = "id, name, pool_size, number_price, status, created_at"
+
+
+def _raffle_from_row(row):
+    return {
+        'id': int(row[0]),
+        'name': row[1],
+        'pool_size': int(row[2]),
+        'number_price': float(row[3]),
+        'status': row[4],
+        'created_at': str(row[5]) if row[5] else None,
+    }
+
+
+def get_raffles(status=None):
+    """Lista las rifas (opcionalmente filtradas por estado)"""
+    if status:
+        rows = run_query(f"SELECT {RAFFLE_COLUMNS} FROM raffles WHERE status = %s ORDER BY id",
+                         params=(status,), fetchall=True) or []
+    else:
+        rows = run_query(f"SELECT {RAFFLE_COLUMNS} FROM raffles ORDER BY id", fetchall=True) or []
+    raffles = [_raffle_from_row(r) for r in rows]
+    for raffle in raffles:
+        _raffles[raffle['id']] = raffle
+    return raffles
+
+
+def get_raffle(raffle_id=DEFAULT_RAFFLE_ID):
+    """Obtiene una rifa; se cachea por proceso (pool_size y precio no cambian)"""
+    raffle_id = int(raffle_id)
+    raffle = _raffles.get(raffle_id)
+    if raffle is None:
+        row = run_query(f"SELECT {RAFFLE_COLUMNS} FROM raffles WHERE id = %s",
+                        params=(raffle_id,), fetchone=True)
+        if not row:
+            return None
+        raffle = _raffle_from_row(row)
+        _raffles[raffle_id] = raffle
+    return raffle
+
+
+def get_pool_size(raffle_id=DEFAULT_RAFFLE_ID):
+    """Cantidad de números de la rifa (POOL_SIZE si no existe)"""
+    try:
+        raffle = get_raffle(raffle_id)
+    except Exception as e:
+        logger.error(f"Error obteniendo rifa {raffle_id}: {e}")
+        raffle = None
+    return raffle['pool_size'] if raffle else POOL_SIZE
+
+
+def create_raffle(name, pool_size, number_price):
+    """Crea una rifa nueva y siembra su pool de números"""
+    pool_size = int(pool_size)
+    if not 1 <= pool_size <= MAX_POOL_SIZE:
+        raise ValueError(f"El tamaño del pool debe estar entre 1 y {MAX_POOL_SIZE}")
+
+    with transaction() as tx:
+        if tx.is_sqlite:
+            tx.execute("INSERT INTO raffles (name, pool_size, number_price) VALUES (%s, %s, %s)",
+                       params=(name, pool_size, number_price))
+            raffle_id = tx.execute("SELECT last_insert_rowid()", fetchone=True)[0]
+        else:
+            raffle_id = tx.execute("""
+                INSERT INTO raffles (name, pool_size, number_price) VALUES (%s, %s, %s) RETURNING id
+            """, params=(name, pool_size, number_price), fetchone=True)[0]
+
+    seed_number_pool(raffle_id)
+    rebuild_number_bitmap(raffle_id)
+    rebuild_raffle_stats(raffle_id)
+    logger.info(f"✅ Rifa creada: {raffle_id} - {name} ({pool_size} números)")
+    return int(raffle_id)
+
+
+# ==================== POOL DE NÚMEROS ====================
+
+class NumbersUnavailable(ValueError):
+    """No quedan suficientes números libres en el pool"""
+
+
+class ReservationUnderpaid(ValueError):
+    """El pago aprobado no cubre los números elegidos de la reserva"""
+
+
+class TooManyHolds(ValueError):
+    """El cliente ya tiene apartados MAX_HOLDS_PER_CLIENT números sin pagar"""
+
+
+class NumbersTaken(NumbersUnavailable):
+    """Algunos de los números elegidos por el cliente ya están tomados"""
+
+    def __init__(self, numbers):
+        self.numbers = sorted(numbers)
+        super().__init__(f"Números no disponibles: {self.numbers}")
+
+
+def seed_number_pool(raffle_id=DEFAULT_RAFFLE_ID):
+    """
+    Llena number_pool con 1..pool_size de la rifa en una permutación aleatoria.
+    Es idempotente: no toca números existentes y marca como tomados los que
+    ya están en assigned_numbers. Deja raffles.tail_position al final de la
+    permutación.
+    """
+    total = get_pool_size(raffle_id)
+    try:
+        row = run_query("SELECT COUNT(*) FROM number_pool WHERE raffle_id = %s",
+                        params=(raffle_id,), fetchone=True)
+        if row and int(row[0]) >= total:
+            # Pool sembrado antes de existir raffles: solo falta la cola
+            run_query("""
+                UPDATE raffles
+                SET tail_position = (SELECT MAX(position) FROM number_pool WHERE raffle_id = %s)
+                WHERE id = %s AND tail_position = 0
+            """, params=(raffle_id, raffle_id), commit=True)
+            return 0
+
+        with transaction() as tx:
+            if tx.is_sqlite:
+                start = tx.execute("SELECT COALESCE(MAX(position), 0) FROM number_pool WHERE raffle_id = %s",
+                                   params=(raffle_id,), fetchone=True)[0]
+                existing = {r[0] for r in tx.execute("SELECT number FROM number_pool WHERE raffle_id = %s",
+                                                     params=(raffle_id,), fetchall=True)}
+                order = [n for n in range(1, total + 1) if n not in existing]
+                random.shuffle(order)
+                tx.executemany(
+                    "INSERT INTO number_pool (raffle_id, number, position) VALUES (%s, %s, %s)",
+                    [(raffle_id, number, start + i) for i, number in enumerate(order, start=1)]
+                )
+            else:
+                tx.execute("""
+                    INSERT INTO number_pool (raffle_id, number, position)
+                    SELECT %s, n, (SELECT COALESCE(MAX(position), 0) FROM number_pool WHERE raffle_id = %s)
+                                  + row_number() OVER (ORDER BY random())
+                    FROM generate_series(1, %s) AS n
+                    WHERE NOT EXISTS (SELECT 1 FROM number_pool p WHERE p.raffle_id = %s AND p.number = n)
+                """, params=(raffle_id, raffle_id, total, raffle_id))
+
+            tx.execute("""
+                UPDATE raffles
+                SET tail_position = (SELECT COALESCE(MAX(position), 0) FROM number_pool WHERE raffle_id = %s)
+                WHERE id = %s
+            """, params=(raffle_id, raffle_id))
+
+            # Números vendidos antes de existir el pool
+            tx.execute("""
+                UPDATE number_pool
+                SET invoice_id = (SELECT a.invoice_id FROM assigned_numbers a
+                                  WHERE a.raffle_id = number_pool.raffle_id AND a.number = number_pool.number),
+                    claimed_at = CURRENT_TIMESTAMP
+                WHERE raffle_id = %s
+                  AND invoice_id IS NULL
+                  AND number IN (SELECT number FROM assigned_numbers WHERE raffle_id = %s)
+            """, params=(raffle_id, raffle_id))
+
+        logger.info(f"✅ Pool de números listo para rifa {raffle_id} (1..{total})")
+        return total
+    except Exception as e:
+        logger.error(f"Error sembrando pool de números de la rifa {raffle_id}: {e}")
+        return 0
+
+
+def claim_numbers(tx, count, invoice_id, raffle_id=DEFAULT_RAFFLE_ID):
+    """
+    Reclama `count` números libres al azar para `invoice_id` dentro de `tx`.
+
+    El pool de cada rifa es una permutación aleatoria; raffles.next_position
+    es un cursor sobre ella. Avanzar el cursor bloquea la fila de la rifa
+    hasta el commit, así dos compras concurrentes nunca reciben la misma
+    ventana, y el costo es O(k) sin importar el tamaño del pool. Las
+    posiciones ya tomadas (p. ej. números elegidos por el cliente) se saltan.
+    """
+    if count <= 0:
+        return []
+
+    numbers = []
+    while len(numbers) < count:
+        need = count - len(numbers)
+        if tx.is_sqlite:
+            # BEGIN IMMEDIATE ya serializa a los escritores
+            start, tail = tx.execute(
+                "SELECT next_position, tail_position FROM raffles WHERE id = %s",
+                params=(raffle_id,), fetchone=True
+            )
+            tx.execute("UPDATE raffles SET next_position = next_position + %s WHERE id = %s",
+                       params=(need, raffle_id))
+        else:
+            start, tail = tx.execute("""
+                UPDATE raffles SET next_position = next_position + %s
+                WHERE id = %s
+                RETURNING next_position - %s, tail_position
+            """, params=(need, raffle_id, need), fetchone=True)
+
+        if start > tail:
+            raise NumbersUnavailable("Not enough numbers available")
+
+        window = (raffle_id, start, start + need)
+        if tx.is_sqlite:
+            rows = tx.execute("""
+                SELECT number FROM number_pool
+                WHERE raffle_id = %s AND position >= %s AND position < %s AND invoice_id IS NULL
+            """, params=window, fetchall=True)
+            tx.executemany(
+                "UPDATE number_pool SET invoice_id = %s, claimed_at = CURRENT_TIMESTAMP WHERE raffle_id = %s AND number = %s",
+                [(invoice_id, raffle_id, r[0]) for r in rows]
+            )
+        else:
+            rows = tx.execute("""
+                UPDATE number_pool
+                SET invoice_id = %s, claimed_at = CURRENT_TIMESTAMP
+                WHERE raffle_id = %s AND position >= %s AND position < %s AND invoice_id IS NULL
+                RETURNING number
+            """, params=(invoice_id,) + window, fetchall=True)
+
+        numbers.extend(int(r[0]) for r in rows)
+
+    numbers.sort()
+    tx.on_commit(lambda: get_number_bitmap(raffle_id).set_many(numbers))
+    return numbers
+
+
+def claim_chosen_numbers(tx, numbers, invoice_id, raffle_id=DEFAULT_RAFFLE_ID):
+    """
+    Reclama números específicos para `invoice_id` dentro de `tx`.
+    Cada número se busca por la clave (raffle_id, number), así el conflicto
+    se detecta en O(k). Lanza NumbersTaken con los que ya estaban tomados.
+    """
+    numbers = sorted(set(numbers))
+    placeholders = ', '.join(['%s'] * len(numbers))
+    # Bloquear en orden evita deadlocks entre elecciones que se cruzan
+    lock = '' if tx.is_sqlite else ' FOR UPDATE'
+    rows = tx.execute(f"""
+        SELECT number FROM number_pool
+        WHERE raffle_id = %s AND number IN ({placeholders}) AND invoice_id IS NULL
+        ORDER BY number{lock}
+    """, params=(raffle_id, *numbers), fetchall=True)
+    free = {int(r[0]) for r in rows}
+    taken = [n for n in numbers if n not in free]
+    if taken:
+        raise NumbersTaken(taken)
+
+    tx.executemany(
+        "UPDATE number_pool SET invoice_id = %s, claimed_at = CURRENT_TIMESTAMP WHERE raffle_id = %s AND number = %s",
+        [(invoice_id, raffle_id, number) for number in numbers]
+    )
+    tx.on_commit(lambda: get_number_bitmap(raffle_id).set_many(numbers))
+    return numbers
+
+
+def release_numbers(tx, invoice_id):
+    """
+    Devuelve al pool los números de una compra (dentro de `tx`).
+    Se reencolan al final de la permutación de su rifa.
+    """
+    rows = tx.execute(
+        "SELECT raffle_id, number FROM number_pool WHERE invoice_id = %s ORDER BY raffle_id, position",
+        params=(invoice_id,), fetchall=True
+    )
+    _requeue_numbers(tx, rows)
+    return len(rows)
+
+
+def _requeue_numbers(tx, rows):
+    """Libera filas (raffle_id, number) del pool y las pone al final de su rifa"""
+    by_raffle = {}
+    for raffle_id, number in rows:
+        by_raffle.setdefault(int(raffle_id), []).append(int(number))
+
+    # Rifas en orden: dos liberaciones que tocan varias no se bloquean en cruz
+    for raffle_id, numbers in sorted(by_raffle.items()):
+        # Reservar el tramo de posiciones en la misma sentencia que mueve la
+        # cola: dos liberaciones concurrentes no pueden calcular el mismo
+        # tramo (el UPDATE bloquea la fila de la rifa hasta el commit).
+        # En SQLite BEGIN IMMEDIATE ya serializa a los escritores.
+        if tx.is_sqlite:
+            tail = tx.execute("SELECT tail_position FROM raffles WHERE id = %s",
+                              params=(raffle_id,), fetchone=True)[0]
+            tx.execute("UPDATE raffles SET tail_position = tail_position + %s WHERE id = %s",
+                       params=(len(numbers), raffle_id))
+        else:
+            tail = tx.execute(
+                "UPDATE raffles SET tail_position = tail_position + %s WHERE id = %s RETURNING tail_position - %s",
+                params=(len(numbers), raffle_id, len(numbers)), fetchone=True
+            )[0]
+        tx.executemany(
+            "UPDATE number_pool SET invoice_id = NULL, claimed_at = NULL, position = %s WHERE raffle_id = %s AND number = %s",
+            [(tail + i, raffle_id, number) for i, number in enumerate(numbers, start=1)]
+        )
+        tx.on_commit(lambda r=raffle_id, n=numbers: get_number_bitmap(r).clear_many(n))
+
+
+# ==================== RESERVAS ====================
+
+def reserve_numbers(count, invoice_id, raffle_id=DEFAULT_RAFFLE_ID, minutes=None, numbers=None, held_by=None):
+    """
+    Aparta números para un checkout durante `minutes` minutos: `count` al
+    azar, o los `numbers` elegidos por el cliente.
+    Quedan en assigned_numbers sin confirmar (is_confirmed = FALSE) con
+    reserved_until; el pago los confirma y el barrido libera los vencidos.
+    Con `held_by` (el cliente que pide) se limita a MAX_HOLDS_PER_CLIENT los
+    números que ese cliente tiene apartados a la vez.
+    Retorna (números, reserved_until). Lanza NumbersUnavailable si no alcanzan
+    (NumbersTaken si alguno de los elegidos ya está tomado) y TooManyHolds si
+    el cliente superaría su límite.
+    """
+    if numbers is not None:
+        # Rechazo rápido con el bitmap compartido, sin tocar la base de datos
+        bitmap = get_number_bitmap(raffle_id)
+        taken = [n for n in numbers if bitmap.is_set(n)]
+        if taken:
+            raise NumbersTaken(taken)
+
+    now = datetime.now()
+    reserved_until = now + timedelta(minutes=minutes or RESERVATION_MINUTES)
+    with transaction() as tx:
+        if held_by:
+            _check_holds(tx, held_by, len(numbers) if numbers is not None else count, now)
+        if numbers is not None:
+            numbers = claim_chosen_numbers(tx, numbers, invoice_id, raffle_id)
+        else:
+            numbers = claim_numbers(tx, count, invoice_id, raffle_id)
+        tx.executemany(
+            "INSERT INTO assigned_numbers (raffle_id, number, invoice_id, reserved_until, is_confirmed, held_by) "
+            "VALUES (%s, %s, %s, %s, FALSE, %s)",
+            [(raffle_id, number, invoice_id, reserved_until, held_by) for number in numbers]
+        )
+        _track_reserved(tx, raffle_id, len(numbers))
+    logger.info(f"🕒 {len(numbers)} números reservados para {invoice_id} hasta {reserved_until:%H:%M:%S}")
+    return numbers, reserved_until
+
+
+def _check_holds(tx, held_by, count, now):
+    """Lanza TooManyHolds si `held_by` pasaría de MAX_HOLDS_PER_CLIENT números apartados vigentes"""
+    if not tx.is_sqlite:
+        # Serializa las reservas del mismo cliente (en SQLite ya lo hace BEGIN IMMEDIATE)
+        tx.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", params=(held_by,), fetchone=True)
+    held = tx.execute(
+        "SELECT COUNT(*) FROM assigned_numbers WHERE held_by = %s AND is_confirmed = FALSE AND reserved_until > %s",
+        params=(held_by, now), fetchone=True
+    )[0]
+    if held + count > MAX_HOLDS_PER_CLIENT:
+        raise TooManyHolds(f"{held_by} ya tiene {held} números apartados (máximo {MAX_HOLDS_PER_CLIENT})")
+
+
+def get_reservation(invoice_id):
+    """Reserva vigente de `invoice_id`: dict con raffle_id, numbers y reserved_until, o None"""
+    confirmed = '0' if is_sqlite() else 'FALSE'
+    rows = run_query(f"""
+        SELECT raffle_id, number, reserved_until FROM assigned_numbers
+        WHERE invoice_id = %s AND is_confirmed = {confirmed}
+        ORDER BY number
+    """, params=(invoice_id,), fetchall=True) or []
+    if not rows:
+        return None
+    return {
+        'invoice_id': invoice_id,
+        'raffle_id': int(rows[0][0]),
+        'numbers': [int(r[1]) for r in rows],
+        'reserved_until': str(rows[0][2]),
+    }
+
+
+def confirm_reservation(tx, reservation_id, invoice_id=None, max_count=None):
+    """
+    Convierte la reserva `reservation_id` en asignación confirmada de
+    `invoice_id` (por defecto el mismo id) dentro de `tx`. Con `max_count`
+    (los números que cubre el pago) los apartados de más vuelven al pool.
+    Retorna los números confirmados, o [] si la reserva no existe o ya fue
+    liberada.
+    """
+    invoice_id = invoice_id or reservation_id
+    lock = '' if tx.is_sqlite else ' FOR UPDATE'
+    rows = tx.execute(
+        f"SELECT raffle_id, number FROM assigned_numbers WHERE invoice_id = %s AND is_confirmed = FALSE ORDER BY number{lock}",
+        params=(reservation_id,), fetchall=True
+    )
+    if not rows:
+        return []
+    # Confirmados o devueltos al pool, ninguno sigue apartado
+    _track_reserved(tx, rows[0][0], -len(rows))
+
+    if max_count is not None and len(rows) > max_count:
+        excess = rows[max_count:]
+        rows = rows[:max_count]
+        logger.warning(f"⚠️ Reserva {reservation_id}: el pago cubre {max_count} números, "
+                       f"se liberan {len(excess)} apartados de más")
+        tx.executemany(
+            "DELETE FROM assigned_numbers WHERE raffle_id = %s AND number = %s AND is_confirmed = FALSE",
+            excess
+        )
+        _requeue_numbers(tx, excess)
+
+    tx.execute("""
+        UPDATE assigned_numbers
+        SET is_confirmed = TRUE, reserved_until = NULL, invoice_id = %s
+        WHERE invoice_id = %s AND is_confirmed = FALSE
+    """, params=(invoice_id, reservation_id))
+    if invoice_id != reservation_id:
+        tx.execute("UPDATE number_pool SET invoice_id = %s WHERE invoice_id = %s",
+                   params=(invoice_id, reservation_id))
+
+    return sorted(int(r[1]) for r in rows)
+
+
+def _drop_reservations(tx, condition, params):
+    """Borra reservas sin confirmar que cumplen `condition` y libera sus números"""
+    lock = '' if tx.is_sqlite else ' FOR UPDATE SKIP LOCKED'
+    rows = tx.execute(
+        f"SELECT raffle_id, number FROM assigned_numbers WHERE is_confirmed = FALSE AND {condition}{lock}",
+        params=params, fetchall=True
+    )
+    tx.executemany(
+        "DELETE FROM assigned_numbers WHERE raffle_id = %s AND number = %s AND is_confirmed = FALSE",
+        rows
+    )
+    _requeue_numbers(tx, rows)
+    released = {}
+    for raffle_id, _ in rows:
+        released[raffle_id] = released.get(raffle_id, 0) + 1
+    for raffle_id, count in released.items():
+        _track_reserved(tx, raffle_id, -count)
+    return len(rows)
+
+
+def _track_reserved(tx, raffle_id, delta):
+    """Ajusta el contador de reservados del bitmap de la rifa cuando `tx` confirma"""
+    if delta:
+        tx.on_commit(lambda r=int(raffle_id): get_number_bitmap(r).add_reserved(delta))
+
+
+def confirm_assigned_numbers(tx, invoice_id):
+    """Marca confirmados los números de `invoice_id` (los que seguían apartados dejan de contar como reserva)"""
+    rows = tx.execute(
+        "SELECT raffle_id, COUNT(*) FROM assigned_numbers WHERE invoice_id = %s AND is_confirmed = FALSE GROUP BY raffle_id",
+        params=(invoice_id,), fetchall=True
+    ) or []
+    tx.execute("UPDATE assigned_numbers SET is_confirmed = TRUE WHERE invoice_id = %s", params=(invoice_id,))
+    for raffle_id, count in rows:
+        _track_reserved(tx, raffle_id, -int(count))
+
+
+def delete_assigned_numbers(tx, invoice_id):
+    """Borra los números de `invoice_id` de assigned_numbers, confirmados o apartados"""
+    rows = tx.execute(
+        "SELECT raffle_id, COUNT(*) FROM assigned_numbers WHERE invoice_id = %s AND is_confirmed = FALSE GROUP BY raffle_id",
+        params=(invoice_id,), fetchall=True
+    ) or []
+    tx.execute("DELETE FROM assigned_numbers WHERE invoice_id = %s", params=(invoice_id,))
+    for raffle_id, count in rows:
+        _track_reserved(tx, raffle_id, -int(count))
+
+
+def cancel_reservation(invoice_id):
+    """Libera de inmediato una reserva (p. ej. si falló crear el pago)"""
+    try:
+        with transaction() as tx:
+            return _drop_reservations(tx, "invoice_id = %s", (invoice_id,))
+    except Exception as e:
+        logger.error(f"Error cancelando reserva {invoice_id}: {e}")
+        return 0
+
+
+def release_expired_reservations(batch=None):
+    """Libera en lotes las reservas vencidas; retorna cuántos números volvieron al pool"""
+    batch = batch or RESERVATION_SWEEP_BATCH
+    released = 0
+    while True:
+        with transaction() as tx:
+            count = _drop_reservations(tx, "reserved_until < %s LIMIT %s", (datetime.now(), batch))
+        released += count
+        if count < batch:
+            break
+    if released:
+        logger.info(f"🧹 {released} números de reservas vencidas liberados")
+    return released
+
+
+def _sweep_reservations():
+    while True:
+        time.sleep(RESERVATION_SWEEP_INTERVAL)
+        try:
+            release_expired_reservations()
+        except Exception as e:
+            logger.error(f"Error liberando reservas vencidas: {e}")
+
+
+def start_reservation_sweeper():
+    """Inicia (una vez por proceso) el hilo que libera reservas vencidas"""
+    global _sweeper_thread, _sweeper_pid
+    if _sweeper_pid == os.getpid() and _sweeper_thread.is_alive():
+        return
+    _sweeper_thread = threading.Thread(target=_sweep_reservations, name='reservation-sweeper', daemon=True)
+    _sweeper_thread.start()
+    _sweeper_pid = os.getpid()
+
+
+def get_number_bitmap(raffle_id=DEFAULT_RAFFLE_ID):
+    """Bitmap compartido de números tomados de una rifa (una instancia por proceso)"""
+    path = os.path.join(BITMAP_DIR, f"rifa_numbers_{int(raffle_id)}.bitmap")
+    key = (path, os.getpid())
+    bitmap = _bitmaps.get(key)
+    if bitmap is None:
+        with _bitmaps_lock:
+            bitmap = _bitmaps.get(key)
+            if bitmap is None:
+                bitmap = NumberBitmap(path, get_pool_size(raffle_id))
+                _bitmaps[key] = bitmap
+    return bitmap
+
+
+def _taken_numbers_from_db(raffle_id):
+    rows = run_query(
+        "SELECT number FROM number_pool WHERE raffle_id = %s AND invoice_id IS NOT NULL",
+        params=(raffle_id,), fetchall=True
+    ) or []
+    return [int(r[0]) for r in rows]
+
+
+def rebuild_number_bitmap(raffle_id=DEFAULT_RAFFLE_ID):
+    """Reconstruye el bitmap de una rifa desde la base de datos (al arrancar)"""
+    try:
+        numbers = _taken_numbers_from_db(raffle_id)
+        get_number_bitmap(raffle_id).load(numbers, count_reserved_numbers(raffle_id))
+        logger.info(f"✅ Bitmap de la rifa {raffle_id} reconstruido: {len(numbers)} tomados")
+        return True
+    except Exception as e:
+        logger.error(f"Error reconstruyendo bitmap de la rifa {raffle_id}: {e}")
+        return False
+
+
+def check_number_bitmap(raffle_id=DEFAULT_RAFFLE_ID, repair=False):
+    """Verifica que el bitmap coincida con la base de datos; opcionalmente lo repara"""
+    numbers = _taken_numbers_from_db(raffle_id)
+    reserved = count_reserved_numbers(raffle_id)
+    bitmap = get_number_bitmap(raffle_id)
+    missing, extra = bitmap.diff(numbers)
+    consistent = not missing and not extra and bitmap.reserved_count() == reserved
+    if not consistent:
+        logger.warning(f"⚠️ Bitmap de la rifa {raffle_id} inconsistente: faltan {len(missing)}, sobran {len(extra)}, "
+                       f"reservados {bitmap.reserved_count()} de {reserved}")
+        if repair:
+            bitmap.load(numbers, reserved)
+    return {
+        'raffle_id': raffle_id,
+        'consistent': consistent,
+        'db_taken': len(numbers),
+        'bitmap_taken': bitmap.count(),
+        'missing_in_bitmap': missing[:100],
+        'extra_in_bitmap': extra[:100],
+        'repaired': bool(repair and not consistent),
+    }
+
+
+# ==================== ESTADÍSTICAS POR RIFA ====================
+
+# Cantidad de números de una compra a partir de su columna `numbers`
+# ("1,2,3"); la misma fórmula sirve en Postgres y SQLite
+NUMBERS_COUNT_SQL = "CASE WHEN numbers <> '' THEN LENGTH(numbers) - LENGTH(REPLACE(numbers, ',', '')) + 1 ELSE 0 END"
+
+
+def _numbers_count(numbers):
+    return numbers.count(',') + 1 if numbers else 0
+
+
+def _add_raffle_stats(tx, raffle_id, numbers, purchases, revenue, amount):
+    """Suma los deltas a raffle_stats y al contador del paquete `amount`"""
+    tx.execute("""
+        INSERT INTO raffle_stats (raffle_id, confirmed_numbers, confirmed_purchases, revenue)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (raffle_id) DO UPDATE SET
+            confirmed_numbers = raffle_stats.confirmed_numbers + excluded.confirmed_numbers,
+            confirmed_purchases = raffle_stats.confirmed_purchases + excluded.confirmed_purchases,
+            revenue = raffle_stats.revenue + excluded.revenue,
+            updated_at = CURRENT_TIMESTAMP
+    """, params=(raffle_id, numbers, purchases, revenue))
+    tx.execute("""
+        INSERT INTO raffle_package_stats (raffle_id, amount, purchases)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (raffle_id, amount) DO UPDATE SET
+            purchases = raffle_package_stats.purchases + excluded.purchases
+    """, params=(raffle_id, amount, purchases))
+
+
+def _apply_purchase_stats(tx, invoice_id, sign):
+    """Suma (sign=1) o resta (sign=-1) la compra `invoice_id` si está confirmada"""
+    lock = '' if tx.is_sqlite else ' FOR UPDATE'
+    row = tx.execute(
+        f"SELECT raffle_id, amount, numbers, status FROM purchases WHERE invoice_id = %s{lock}",
+        params=(invoice_id,), fetchone=True
+    )
+    if not row or row[3] != 'confirmed':
+        return False
+    amount = float(row[1] or 0)
+    _add_raffle_stats(tx, row[0], sign * _numbers_count(row[2]), sign, sign * amount, amount)
+    return True
+
+
+def add_purchase_stats(tx, invoice_id):
+    """Cuenta en raffle_stats una compra recién confirmada (dentro de su transacción)"""
+    return _apply_purchase_stats(tx, invoice_id, 1)
+
+
+def remove_purchase_stats(tx, invoice_id):
+    """Descuenta una compra confirmada antes de eliminarla o editarla"""
+    return _apply_purchase_stats(tx, invoice_id, -1)
+
+
+def get_raffle_stats(raffle_id=DEFAULT_RAFFLE_ID, packages=True):
+    """
+    Agregados de una rifa (una lectura por clave primaria, más los paquetes
+    si `packages`); None si aún no existen
+    """
+    row = run_query(
+        "SELECT confirmed_numbers, confirmed_purchases, revenue FROM raffle_stats WHERE raffle_id = %s",
+        params=(raffle_id,), fetchone=True
+    )
+    if not row:
+        return None
+    if packages:
+        packages = run_query(
+            "SELECT amount, purchases FROM raffle_package_stats WHERE raffle_id = %s AND purchases > 0",
+            params=(raffle_id,), fetchall=True
+        ) or []
+    else:
+        packages = []
+    return {
+        'raffle_id': raffle_id,
+        'confirmed_numbers': int(row[0]),
+        'confirmed_purchases': int(row[1]),
+        'revenue': float(row[2] or 0),
+        'packages': {float(amount): int(count) for amount, count in packages},
+    }
+
+
+def get_raffle_dashboard(raffle_id=DEFAULT_RAFFLE_ID, date_from=None, date_to=None, days=7):
+    """
+    Todo lo que muestra el panel en una sola consulta (UNION ALL): los
+    agregados de raffle_stats, los paquetes, las ventas diarias de los
+    últimos `days` días y, si hay rango de fechas, su conteo y total.
+    None si raffle_stats aún no existe para la rifa.
+    """
+    since = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    query = """
+        SELECT 'stats', CAST(NULL AS DATE), NULL, confirmed_purchases, revenue, confirmed_numbers
+        FROM raffle_stats WHERE raffle_id = %s
+        UNION ALL
+        SELECT 'package', NULL, amount, purchases, NULL, NULL
+        FROM raffle_package_stats WHERE raffle_id = %s AND purchases > 0
+        UNION ALL
+        SELECT 'day', DATE(created_at), NULL, COUNT(*), SUM(amount), NULL
+        FROM purchases WHERE raffle_id = %s AND status = 'confirmed' AND created_at >= %s
+        GROUP BY DATE(created_at)
+    """
+    params = [raffle_id, raffle_id, raffle_id, since]
+    if date_from or date_to:
+        query += """
+        UNION ALL
+        SELECT 'range', NULL, NULL, COUNT(*), SUM(amount), NULL
+        FROM purchases WHERE raffle_id = %s AND status = 'confirmed'
+        """
+        params.append(raffle_id)
+        if date_from:
+            query += " AND created_at >= %s"
+            params.append(date_from)
+        if date_to:
+            query += " AND created_at <= %s"
+            params.append(date_to)
+
+    dashboard = {'stats': None, 'packages': {}, 'daily_sales': [], 'range': None}
+    for kind, day, amount, count, revenue, numbers in run_query(query, params=tuple(params), fetchall=True) or []:
+        if kind == 'stats':
+            dashboard['stats'] = {
+                'raffle_id': raffle_id,
+                'confirmed_numbers': int(numbers),
+                'confirmed_purchases': int(count),
+                'revenue': float(revenue or 0),
+            }
+        elif kind == 'package':
+            dashboard['packages'][float(amount)] = int(count)
+        elif kind == 'day':
+            dashboard['daily_sales'].append({'date': str(day), 'count': int(count), 'revenue': float(revenue or 0)})
+        else:
+            dashboard['range'] = {'purchases': int(count), 'revenue': float(revenue or 0)}
+    if dashboard['stats'] is None:
+        return None
+    dashboard['stats']['packages'] = dashboard['packages']
+    dashboard['daily_sales'].sort(key=lambda day: day['date'], reverse=True)
+    return dashboard
+
+
+def _compute_raffle_stats(tx, raffle_id):
+    row = tx.execute(f"""
+        SELECT COUNT(*), COALESCE(SUM(amount), 0), COALESCE(SUM({NUMBERS_COUNT_SQL}), 0)
+        FROM purchases WHERE status = 'confirmed' AND raffle_id = %s
+    """, params=(raffle_id,), fetchone=True)
+    packages = tx.execute("""
+        SELECT amount, COUNT(*) FROM purchases
+        WHERE status = 'confirmed' AND raffle_id = %s
+        GROUP BY amount
+    """, params=(raffle_id,), fetchall=True) or []
+    return {
+        'raffle_id': raffle_id,
+        'confirmed_numbers': int(row[2]),
+        'confirmed_purchases': int(row[0]),
+        'revenue': float(row[1] or 0),
+        'packages': {float(amount): int(count) for amount, count in packages},
+    }
+
+
+def rebuild_raffle_stats(raffle_id=DEFAULT_RAFFLE_ID):
+    """Recalcula desde cero los agregados de una rifa a partir de purchases"""
+    with transaction() as tx:
+        if not tx.is_sqlite:
+            # Las confirmaciones concurrentes esperan a que termine el recálculo
+            tx.execute("LOCK TABLE raffle_stats, raffle_package_stats IN EXCLUSIVE MODE")
+        stats = _compute_raffle_stats(tx, raffle_id)
+        tx.execute("DELETE FROM raffle_stats WHERE raffle_id = %s", params=(raffle_id,))
+        tx.execute("DELETE FROM raffle_package_stats WHERE raffle_id = %s", params=(raffle_id,))
+        tx.execute("""
+            INSERT INTO raffle_stats (raffle_id, confirmed_numbers, confirmed_purchases, revenue)
+            VALUES (%s, %s, %s, %s)
+        """, params=(raffle_id, stats['confirmed_numbers'], stats['confirmed_purchases'], stats['revenue']))
+        tx.executemany(
+            "INSERT INTO raffle_package_stats (raffle_id, amount, purchases) VALUES (%s, %s, %s)",
+            [(raffle_id, amount, count) for amount, count in stats['packages'].items()]
+        )
+    logger.info(f"✅ Estadísticas de la rifa {raffle_id} recalculadas: {stats['confirmed_purchases']} compras")
+    return stats
+
+
+def check_raffle_stats(raffle_id=DEFAULT_RAFFLE_ID, repair=False):
+    """Compara raffle_stats con un recálculo desde purchases; opcionalmente lo repara"""
+    stored = get_raffle_stats(raffle_id)
+    with transaction() as tx:
+        expected = _compute_raffle_stats(tx, raffle_id)
+    consistent = stored == expected
+    if not consistent:
+        logger.warning(f"⚠️ Estadísticas de la rifa {raffle_id} inconsistentes: {stored} != {expected}")
+        if repair:
+            expected = rebuild_raffle_stats(raffle_id)
+    return {
+        'raffle_id': raffle_id,
+        'consistent': consistent,
+        'stored': stored,
+        'expected': expected,
+        'repaired': bool(repair and not consistent),
+    }
+
+
 def get_purchase_by_id(purchase_id):
     """Obtiene una compra por ID"""
     return run_query(
@@ -294,17 +1720,35 @@ def get_purchase_by_id(purchase_id):
     )
 
 
-def update_purchase(purchase_id, invoice_id, amount, email, numbers, status, notes=None):
-    """Actualiza una compra existente"""
+def rename_assigned_invoice(tx, old_invoice_id, new_invoice_id):
+    """Mueve los números asignados a la nueva factura (la búsqueda por número los une por invoice_id)"""
+    return tx.execute(
+        "UPDATE assigned_numbers SET invoice_id = %s WHERE invoice_id = %s",
+        params=(new_invoice_id, old_invoice_id)
+    )
+
+
+def update_purchase(purchase_id, invoice_id, amount, email, numbers, status, notes=None,
+                    full_name=None, phone=None, document_number=None):
+    """Actualiza una compra existente (y sus agregados en raffle_stats)"""
     try:
-        run_query(
-            """UPDATE purchases 
-               SET invoice_id = %s, amount = %s, email = %s, numbers = %s, 
-                   status = %s, notes = %s, updated_at = CURRENT_TIMESTAMP
-               WHERE id = %s""",
-            params=(invoice_id, amount, email, numbers, status, notes, purchase_id),
-            commit=True
-        )
+        with transaction() as tx:
+            row = tx.execute("SELECT invoice_id FROM purchases WHERE id = %s",
+                             params=(purchase_id,), fetchone=True)
+            if row:
+                remove_purchase_stats(tx, row[0])
+            tx.execute(
+                """UPDATE purchases 
+                   SET invoice_id = %s, amount = %s, email = %s, numbers = %s, 
+                       status = %s, full_name = %s, phone = %s, 
+                       document_number = %s, notes = %s, updated_at = CURRENT_TIMESTAMP
+                   WHERE id = %s""",
+                params=(invoice_id, amount, email, numbers, status,
+                        full_name, phone, document_number, notes, purchase_id)
+            )
+            if row and row[0] != invoice_id:
+                rename_assigned_invoice(tx, row[0], invoice_id)
+            add_purchase_stats(tx, invoice_id)
         return True
     except Exception as e:
         logger.error(f"Error actualizando compra {purchase_id}: {e}")
@@ -320,19 +1764,17 @@ def delete_purchase(purchase_id):
         
         invoice_id = purchase[1]
         
-        # Eliminar números asignados
-        run_query(
-            "DELETE FROM assigned_numbers WHERE invoice_id = %s",
-            params=(invoice_id,),
-            commit=True
-        )
-        
-        # Soft delete de la compra
-        run_query(
-            "UPDATE purchases SET status = 'deleted', deleted_at = CURRENT_TIMESTAMP WHERE id = %s",
-            params=(purchase_id,),
-            commit=True
-        )
+        with transaction() as tx:
+            # Eliminar números asignados y devolverlos al pool
+            delete_assigned_numbers(tx, invoice_id)
+            release_numbers(tx, invoice_id)
+            remove_purchase_stats(tx, invoice_id)
+            
+            # Soft delete de la compra
+            tx.execute(
+                "UPDATE purchases SET status = 'deleted', deleted_at = CURRENT_TIMESTAMP WHERE id = %s",
+                params=(purchase_id,)
+            )
         
         return True
         
@@ -0,0 +1,82 @@
+"""
+Difusión de eventos en vivo (Server-Sent Events) a los navegadores.
+
+Cada worker tiene un EventHub. Un hilo de fondo vigila las fuentes
+(generación del bitmap compartido, configuración de números benditos) y
+publica solo cuando el contenido cambia; cada conexión SSE espera en una
+Condition, así miles de clientes inactivos no consumen CPU ni consultas.
+"""
+import json
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EventHub:
+    """
+    Guarda el último mensaje de cada tema ('progress:1', 'blessed', ...)
+    y despierta a los suscriptores cuando alguno cambia. Un cliente nuevo
+    recibe de inmediato el estado actual de sus temas.
+    """
+
+    def __init__(self, heartbeat=15.0):
+        self.heartbeat = heartbeat
+        self._cond = threading.Condition()
+        self._version = 0
+        self._latest = {}
+        self.subscribers = 0
+
+    def publish(self, topic, data):
+        """Publica `data` en `topic`; retorna False si no cambió"""
+        payload = json.dumps(data, separators=(',', ':'), default=str)
+        with self._cond:
+            current = self._latest.get(topic)
+            if current and current[1] == payload:
+                return False
+            self._version += 1
+            self._latest[topic] = (self._version, payload)
+            self._cond.notify_all()
+        return True
+
+    def _pending(self, topics, seen):
+        return sorted(
+            (version, topic, payload)
+            for topic, (version, payload) in self._latest.items()
+            if version > seen and topic in topics
+        )
+
+    def stream(self, topics):
+        """Generador de mensajes text/event-stream para los `topics` dados"""
+        topics = set(topics)
+        seen = 0
+        with self._cond:
+            self.subscribers += 1
+        try:
+            # Los navegadores reconectan solos; pedirles que esperen 5 s
+            yield "retry: 5000\n\n"
+            while True:
+                with self._cond:
+                    pending = self._pending(topics, seen)
+                    if not pending:
+                        self._cond.wait(self.heartbeat)
+                        pending = self._pending(topics, seen)
+                    seen = self._version
+                if not pending:
+                    # Comentario SSE: mantiene viva la conexión en proxies
+                    yield ": ping\n\n"
+                    continue
+                for version, topic, payload in pending:
+                    yield f"id: {version}\nevent: {topic.split(':')[0]}\ndata: {payload}\n\n"
+        finally:
+            with self._cond:
+                self.subscribers -= 1
+
+    def snapshot(self):
+        """Estado serializable para endpoints de monitoreo"""
+        with self._cond:
+            return {
+                'subscribers': self.subscribers,
+                'version': self._version,
+                'topics': sorted(self._latest),
+            }
@@ -0,0 +1,167 @@
+"""
+Idempotencia de notificaciones de pasarelas (MercadoPago, ePayco).
+
+Cada evento (pasarela, id del pago) se reclama de forma atómica en la tabla
+`processed_events` antes de procesarlo: un INSERT con clave única, así dos
+notificaciones repetidas que llegan a la vez nunca procesan dos veces el
+mismo pago. Los eventos ya terminados quedan además en una caché caliente
+por worker que responde las repeticiones sin ir a la base de datos.
+"""
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Un reclamo 'processing' más viejo que esto se considera de un worker caído
+EVENT_CLAIM_LEASE = float(os.getenv('EVENT_CLAIM_LEASE', '300'))
+RECENT_EVENTS_SIZE = int(os.getenv('RECENT_EVENTS_SIZE', '10000'))
+RECENT_EVENTS_TTL = float(os.getenv('RECENT_EVENTS_TTL', '3600'))
+
+# Resultados de claim_event
+CLAIMED, IN_FLIGHT, DONE = 'claimed', 'in_flight', 'done'
+
+
+class EventInFlight(RuntimeError):
+    """
+    Otro worker tiene un reclamo vigente del evento. No es un repetido: si
+    ese worker murió el evento sigue sin procesar, así que el trabajo debe
+    reintentarse (cuando el reclamo venza se podrá retomar).
+    """
+
+
+class RecentEvents:
+    """Conjunto acotado (LRU con vencimiento) de eventos ya procesados"""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def add(self, key):
+        with self._lock:
+            self._items[key] = time.monotonic() + self.ttl
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._items.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._items[key]
+                return False
+            self.hits += 1
+            return True
+
+    def snapshot(self):
+        return {'size': len(self._items), 'max_size': self.size, 'hits': self.hits}
+
+
+recent_events = RecentEvents(RECENT_EVENTS_SIZE, RECENT_EVENTS_TTL)
+
+
+def is_processed(gateway, event_id):
+    """True si el evento ya se procesó (primero la caché del worker, luego la tabla)"""
+    key = (gateway, str(event_id))
+    if key in recent_events:
+        return True
+    row = db.run_query(
+        "SELECT status FROM processed_events WHERE gateway = %s AND event_id = %s",
+        params=key, fetchone=True
+    )
+    if row and row[0] == 'done':
+        recent_events.add(key)
+        return True
+    return False
+
+
+def claim_event(gateway, event_id, lease=None):
+    """
+    Reclama el evento para procesarlo. Retorna CLAIMED si lo tomó, DONE si
+    ya está procesado o IN_FLIGHT si otro worker lo está procesando (y su
+    reclamo no ha vencido).
+    """
+    key = (gateway, str(event_id))
+    if key in recent_events:
+        return DONE
+    now = datetime.now()
+    with db.transaction() as tx:
+        claimed = tx.execute("""
+            INSERT INTO processed_events (gateway, event_id, status, claimed_at)
+            VALUES (%s, %s, 'processing', %s)
+            ON CONFLICT (gateway, event_id) DO NOTHING
+        """, params=(*key, now))
+        if not claimed:
+            # Retomar un reclamo abandonado por un worker que murió
+            stale = now - timedelta(seconds=lease or EVENT_CLAIM_LEASE)
+            claimed = tx.execute("""
+                UPDATE processed_events SET claimed_at = %s
+                WHERE gateway = %s AND event_id = %s AND status = 'processing' AND claimed_at < %s
+            """, params=(now, *key, stale))
+            if not claimed:
+                row = tx.execute("SELECT status FROM processed_events WHERE gateway = %s AND event_id = %s",
+                                 params=key, fetchone=True)
+                if row and row[0] == 'done':
+                    recent_events.add(key)
+                    return DONE
+                return IN_FLIGHT
+    return CLAIMED
+
+
+def complete_event(gateway, event_id):
+    key = (gateway, str(event_id))
+    db.run_query(
+        "UPDATE processed_events SET status = 'done', completed_at = %s WHERE gateway = %s AND event_id = %s",
+        params=(datetime.now(), *key), commit=True
+    )
+    recent_events.add(key)
+
+
+def release_event(gateway, event_id):
+    """Libera un reclamo tras un fallo para que un reintento pueda procesarlo"""
+    db.run_query(
+        "DELETE FROM processed_events WHERE gateway = %s AND event_id = %s AND status = 'processing'",
+        params=(gateway, str(event_id)), commit=True
+    )
+
+
+@contextmanager
+def processing(gateway, event_id):
+    """
+    Reclama el evento durante el bloque; lo marca terminado si el bloque
+    sale bien y lo libera si lanza una excepción. Si otro worker lo tiene
+    reclamado lanza EventInFlight, para que el trabajo se reintente en vez
+    de darse por terminado.
+
+        with idempotency.processing('mercadopago', payment_id) as claimed:
+            if not claimed:
+                return  # repetido
+            ...
+    """
+    state = claim_event(gateway, event_id)
+    if state == IN_FLIGHT:
+        raise EventInFlight(f"Evento {gateway}:{event_id} reclamado por otro worker")
+    if state == DONE:
+        logger.info(f"♻️ Evento {gateway}:{event_id} repetido, se omite")
+        yield False
+        return
+    try:
+        yield True
+    except BaseException:
+        try:
+            release_event(gateway, event_id)
+        except Exception as e:
+            logger.error(f"Error liberando evento {gateway}:{event_id}: {e}")
+        raise
+    complete_event(gateway, event_id)
@@ -0,0 +1,264 @@
+"""
+Cola de trabajos durable sobre la misma base de datos (patrón outbox).
+
+Los webhooks solo verifican la notificación y la encolan en la tabla `jobs`;
+hilos de fondo de cada worker la procesan con reintentos, backoff
+exponencial con jitter y dead-letter (status 'dead'). No requiere broker:
+funciona con Postgres (FOR UPDATE SKIP LOCKED) y con SQLite (BEGIN IMMEDIATE).
+
+    jobs.register('mercadopago_payment', handler, concurrency=2)
+    jobs.enqueue('mercadopago_payment', {'payment_id': 123}, dedupe_key='mp:123')
+    jobs.start_job_workers()
+"""
+import os
+import json
+import random
+import threading
+import time
+import logging
+from datetime import datetime, timedelta
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '1'))
+# Tras esto otro worker lo retoma. Nunca menos que el reclamo de eventos
+# (EVENT_CLAIM_LEASE, app/idempotency.py): retomarlo antes solo encontraría
+# vivo el reclamo del worker caído
+JOB_LEASE_SECONDS = max(float(os.getenv('JOB_LEASE_SECONDS', '300')),
+                        float(os.getenv('EVENT_CLAIM_LEASE', '300')))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '8'))
+JOB_BACKOFF_BASE = float(os.getenv('JOB_BACKOFF_BASE', '5'))       # segundos; se duplica por intento
+JOB_BACKOFF_MAX = float(os.getenv('JOB_BACKOFF_MAX', '900'))
+
+PENDING, RUNNING, DONE, DEAD = 'pending', 'running', 'done', 'dead'
+
+JOB_COLUMNS = "id, kind, payload, attempts, max_attempts"
+
+_handlers = {}
+_wakeup = threading.Event()
+_workers = []
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+
+class PermanentJobError(Exception):
+    """El trabajo no puede tener éxito reintentando: pasa directo a dead-letter"""
+
+
+def register(kind, handler, concurrency=1, max_attempts=None):
+    """Registra `handler(payload)` para los trabajos de tipo `kind`"""
+    _handlers[kind] = {
+        'handler': handler,
+        'concurrency': max(1, int(concurrency)),
+        'max_attempts': max_attempts or JOB_MAX_ATTEMPTS,
+    }
+
+
+def enqueue(kind, payload, tx=None, dedupe_key=None, delay=0):
+    """
+    Encola un trabajo (dentro de `tx` si se pasa, así se confirma junto con
+    la transacción). Con `dedupe_key`, un trabajo igual aún pendiente absorbe
+    el nuevo: el índice único idx_jobs_dedupe_active lo garantiza aunque dos
+    workers encolen a la vez. Retorna el id, o None si se deduplicó.
+    """
+    if tx is None:
+        with db.transaction() as own_tx:
+            return enqueue(kind, payload, own_tx, dedupe_key, delay)
+
+    spec = _handlers.get(kind, {})
+    params = (
+        kind, json.dumps(payload, default=str), spec.get('max_attempts', JOB_MAX_ATTEMPTS),
+        datetime.now() + timedelta(seconds=delay), dedupe_key
+    )
+    columns = "jobs (kind, payload, max_attempts, run_at, dedupe_key) VALUES (%s, %s, %s, %s, %s)"
+    if tx.is_sqlite:
+        inserted = tx.execute(f"INSERT OR IGNORE INTO {columns}", params=params)
+        row = tx.execute("SELECT last_insert_rowid()", fetchone=True) if inserted else None
+    else:
+        row = tx.execute(f"""
+            INSERT INTO {columns}
+            ON CONFLICT (dedupe_key) WHERE status IN ('pending', 'running') DO NOTHING
+            RETURNING id
+        """, params=params, fetchone=True)
+    if row is None:
+        logger.info(f"♻️ Trabajo {kind} ya encolado: {dedupe_key}")
+        return None
+    job_id = row[0]
+
+    # Despertar a los workers de este proceso en cuanto se confirme
+    tx.on_commit(_wakeup.set)
+    return int(job_id)
+
+
+def _job_from_row(row):
+    return {
+        'id': int(row[0]),
+        'kind': row[1],
+        'payload': json.loads(row[2]) if row[2] else {},
+        'attempts': int(row[3]),
+        'max_attempts': int(row[4]),
+    }
+
+
+def claim_jobs(kind, limit=1, lease=None):
+    """
+    Toma hasta `limit` trabajos listos de `kind` (pendientes o con lease
+    vencido) y los marca 'running' por `lease` segundos. Dos workers nunca
+    toman el mismo trabajo.
+    """
+    now = datetime.now()
+    locked_until = now + timedelta(seconds=lease or JOB_LEASE_SECONDS)
+    ready = """
+        kind = %s AND run_at <= %s
+        AND (status = 'pending' OR (status = 'running' AND locked_until < %s))
+    """
+    with db.transaction() as tx:
+        lock = '' if tx.is_sqlite else ' FOR UPDATE SKIP LOCKED'
+        rows = tx.execute(
+            f"SELECT {JOB_COLUMNS} FROM jobs WHERE {ready} ORDER BY run_at, id LIMIT %s{lock}",
+            params=(kind, now, now, limit), fetchall=True
+        ) or []
+        tx.executemany("""
+            UPDATE jobs
+            SET status = 'running', attempts = attempts + 1, locked_until = %s, updated_at = %s
+            WHERE id = %s
+        """, [(locked_until, now, row[0]) for row in rows])
+
+    jobs = [_job_from_row(row) for row in rows]
+    for job in jobs:
+        job['attempts'] += 1
+    return jobs
+
+
+def complete_job(job):
+    db.run_query(
+        "UPDATE jobs SET status = 'done', locked_until = NULL, last_error = NULL, updated_at = %s WHERE id = %s",
+        params=(datetime.now(), job['id']), commit=True
+    )
+
+
+def retry_delay(attempts):
+    """Backoff exponencial con jitter: ~base·2^(n-1), acotado por JOB_BACKOFF_MAX"""
+    delay = min(JOB_BACKOFF_BASE * 2 ** (attempts - 1), JOB_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def fail_job(job, error, permanent=False):
+    """Reprograma el trabajo con backoff, o lo manda a dead-letter si no quedan intentos"""
+    now = datetime.now()
+    message = str(error)[:1000]
+    if permanent or job['attempts'] >= job['max_attempts']:
+        db.run_query(
+            "UPDATE jobs SET status = 'dead', locked_until = NULL, last_error = %s, updated_at = %s WHERE id = %s",
+            params=(message, now, job['id']), commit=True
+        )
+        logger.error(f"💀 Trabajo {job['kind']} #{job['id']} en dead-letter tras {job['attempts']} intentos: {message}")
+        return DEAD
+
+    run_at = now + timedelta(seconds=retry_delay(job['attempts']))
+    db.run_query("""
+        UPDATE jobs SET status = 'pending', locked_until = NULL, run_at = %s, last_error = %s, updated_at = %s
+        WHERE id = %s
+    """, params=(run_at, message, now, job['id']), commit=True)
+    logger.warning(f"🔁 Trabajo {job['kind']} #{job['id']} falló (intento {job['attempts']}), reintento a las {run_at:%H:%M:%S}: {message}")
+    return PENDING
+
+
+def run_job(job):
+    """Ejecuta un trabajo tomado y registra su resultado; retorna el nuevo status"""
+    handler = _handlers[job['kind']]['handler']
+    try:
+        handler(job['payload'])
+    except PermanentJobError as e:
+        return fail_job(job, e, permanent=True)
+    except Exception as e:
+        return fail_job(job, e)
+    complete_job(job)
+    return DONE
+
+
+def run_pending(kind, limit=100):
+    """Procesa en este hilo los trabajos listos de `kind` (útil en tests y scripts)"""
+    processed = 0
+    while processed < limit:
+        jobs = claim_jobs(kind, 1)
+        if not jobs:
+            break
+        run_job(jobs[0])
+        processed += 1
+    return processed
+
+
+def retry_job(job_id):
+    """
+    Vuelve a encolar un trabajo en dead-letter con sus intentos en cero (no
+    si ya hay otro activo con la misma dedupe_key)
+    """
+    with db.transaction() as tx:
+        updated = tx.execute("""
+            UPDATE jobs SET status = 'pending', attempts = 0, run_at = %s, locked_until = NULL, updated_at = %s
+            WHERE id = %s AND status = 'dead'
+              AND NOT EXISTS (SELECT 1 FROM jobs active
+                              WHERE active.dedupe_key = jobs.dedupe_key AND active.status IN ('pending', 'running'))
+        """, params=(datetime.now(), datetime.now(), job_id))
+        if updated:
+            tx.on_commit(_wakeup.set)
+    return bool(updated)
+
+
+def get_job_stats():
+    """Cantidad de trabajos por tipo y estado, más los últimos en dead-letter"""
+    rows = db.run_query("SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status", fetchall=True) or []
+    counts = {}
+    for kind, status, count in rows:
+        counts.setdefault(kind, {})[status] = int(count)
+    dead = db.run_query("""
+        SELECT id, kind, attempts, last_error, updated_at FROM jobs
+        WHERE status = 'dead' ORDER BY updated_at DESC LIMIT 20
+    """, fetchall=True) or []
+    return {
+        'counts': counts,
+        'dead': [
+            {'id': r[0], 'kind': r[1], 'attempts': r[2], 'last_error': r[3], 'updated_at': str(r[4])}
+            for r in dead
+        ],
+        'workers': sum(1 for t in _workers if t.is_alive()) if _workers_pid == os.getpid() else 0,
+    }
+
+
+def _work(kind):
+    while True:
+        try:
+            jobs = claim_jobs(kind, 1)
+        except Exception as e:
+            logger.error(f"Error tomando trabajos {kind}: {e}")
+            jobs = []
+        if not jobs:
+            # Esperar un trabajo nuevo de este proceso o el siguiente sondeo
+            _wakeup.wait(JOB_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        try:
+            run_job(jobs[0])
+        except Exception as e:
+            # Si ni siquiera se pudo registrar el fallo, el lease vencido lo devuelve a la cola
+            logger.error(f"Error registrando el trabajo {kind} #{jobs[0]['id']}: {e}")
+            time.sleep(JOB_POLL_INTERVAL)
+
+
+def start_job_workers():
+    """Inicia (una vez por proceso) `concurrency` hilos por cada tipo registrado"""
+    global _workers, _workers_pid
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers = []
+        for kind, spec in _handlers.items():
+            for i in range(spec['concurrency']):
+                thread = threading.Thread(target=_work, args=(kind,), name=f'job-{kind}-{i}', daemon=True)
+                thread.start()
+                _workers.append(thread)
+        _workers_pid = os.getpid()
+    logger.info(f"✅ {len(_workers)} workers de trabajos iniciados")
@@ -0,0 +1,278 @@
+"""
+Bandeja de salida de emails (tabla `email_outbox`).
+
+Las rutas y los trabajos solo encolan el email; un hilo de fondo por worker
+los toma en lotes y los entrega con una sola llamada al proveedor (Brevo
+`messageVersions`), limitado por un token bucket de envíos por segundo.
+Los fallos transitorios se reintentan con backoff; cada email enviado
+guarda el message id que devolvió el proveedor.
+
+    mailer.set_transport(send_brevo_batch)
+    mailer.enqueue_email('ana@x.co', 'Asunto', '<p>Hola</p>', kind='purchase_confirmation', ref='inv-1')
+    mailer.start_email_sender()
+"""
+import os
+import time
+import threading
+import logging
+from datetime import datetime, timedelta
+
+from app import db
+from app.jobs import retry_delay
+
+logger = logging.getLogger(__name__)
+
+EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', '50'))          # emails por llamada al proveedor
+EMAIL_SEND_RATE = float(os.getenv('EMAIL_SEND_RATE', '5'))           # emails por segundo, por worker
+EMAIL_SEND_BURST = int(os.getenv('EMAIL_SEND_BURST', '50'))
+EMAIL_MAX_ATTEMPTS = int(os.getenv('EMAIL_MAX_ATTEMPTS', '8'))
+EMAIL_LEASE_SECONDS = float(os.getenv('EMAIL_LEASE_SECONDS', '120'))
+EMAIL_POLL_INTERVAL = float(os.getenv('EMAIL_POLL_INTERVAL', '2'))
+
+PENDING, SENDING, SENT, DEAD = 'pending', 'sending', 'sent', 'dead'
+
+EMAIL_COLUMNS = "id, kind, ref, to_email, to_name, subject, html_content, text_content, attempts"
+
+_transport = None
+_wakeup = threading.Event()
+_sender = None
+_sender_pid = None
+_sender_lock = threading.Lock()
+
+
+class TransientEmailError(Exception):
+    """El proveedor no pudo entregar el lote ahora (caído, 429, 5xx): se reintenta"""
+
+
+class PermanentEmailError(Exception):
+    """El proveedor rechazó el envío (4xx): reintentar no sirve"""
+
+
+class TokenBucket:
+    """Limita a `rate` unidades por segundo con ráfagas de hasta `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, n=1):
+        """Espera hasta poder consumir `n` fichas (como mucho `capacity`)"""
+        n = min(n, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                wait = (n - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+send_bucket = TokenBucket(EMAIL_SEND_RATE, EMAIL_SEND_BURST)
+
+
+def set_transport(send_batch):
+    """
+    Registra `send_batch(messages)`: entrega una lista de emails en una sola
+    llamada y retorna sus message ids en el mismo orden. Lanza
+    TransientEmailError o PermanentEmailError si falla.
+    """
+    global _transport
+    _transport = send_batch
+
+
+def enqueue_email(to_email, subject, html_content, text_content=None, to_name=None,
+                  kind='generic', ref=None, tx=None, dedupe=False):
+    """
+    Encola un email (dentro de `tx` si se pasa). Con `dedupe`, un email del
+    mismo `kind` y `ref` aún sin enviar absorbe el nuevo. Retorna el id, o
+    None si se deduplicó.
+    """
+    if tx is None:
+        with db.transaction() as own_tx:
+            return enqueue_email(to_email, subject, html_content, text_content, to_name,
+                                 kind, ref, own_tx, dedupe)
+
+    if dedupe and ref and tx.execute(
+        "SELECT 1 FROM email_outbox WHERE kind = %s AND ref = %s AND status IN ('pending', 'sending')",
+        params=(kind, ref), fetchone=True
+    ):
+        logger.info(f"♻️ Email {kind} para {ref} ya encolado")
+        return None
+
+    now = datetime.now()
+    params = (kind, ref, to_email, to_name, subject, html_content, text_content, now, now)
+    insert = """
+        INSERT INTO email_outbox (kind, ref, to_email, to_name, subject, html_content, text_content, run_at, created_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    if tx.is_sqlite:
+        tx.execute(insert, params=params)
+        email_id = tx.execute("SELECT last_insert_rowid()", fetchone=True)[0]
+    else:
+        email_id = tx.execute(insert + " RETURNING id", params=params, fetchone=True)[0]
+
+    tx.on_commit(_wakeup.set)
+    return int(email_id)
+
+
+def _email_from_row(row):
+    return {
+        'id': int(row[0]), 'kind': row[1], 'ref': row[2], 'to_email': row[3], 'to_name': row[4],
+        'subject': row[5], 'html_content': row[6], 'text_content': row[7], 'attempts': int(row[8]) + 1,
+    }
+
+
+def claim_emails(limit=None, lease=None):
+    """Toma hasta `limit` emails listos (pendientes o con lease vencido) y los marca 'sending'"""
+    now = datetime.now()
+    locked_until = now + timedelta(seconds=lease or EMAIL_LEASE_SECONDS)
+    ready = """
+        run_at <= %s AND (status = 'pending' OR (status = 'sending' AND locked_until < %s))
+    """
+    with db.transaction() as tx:
+        lock = '' if tx.is_sqlite else ' FOR UPDATE SKIP LOCKED'
+        rows = tx.execute(
+            f"SELECT {EMAIL_COLUMNS} FROM email_outbox WHERE {ready} ORDER BY run_at, id LIMIT %s{lock}",
+            params=(now, now, limit or EMAIL_BATCH_SIZE), fetchall=True
+        ) or []
+        tx.executemany("""
+            UPDATE email_outbox
+            SET status = 'sending', attempts = attempts + 1, locked_until = %s, updated_at = %s
+            WHERE id = %s
+        """, [(locked_until, now, row[0]) for row in rows])
+    return [_email_from_row(row) for row in rows]
+
+
+def mark_sent(emails, message_ids):
+    now = datetime.now()
+    message_ids = list(message_ids or [])
+    message_ids += [None] * (len(emails) - len(message_ids))
+    with db.transaction() as tx:
+        tx.executemany("""
+            UPDATE email_outbox
+            SET status = 'sent', message_id = %s, sent_at = %s, locked_until = NULL, last_error = NULL, updated_at = %s
+            WHERE id = %s
+        """, [(message_id, now, now, email['id']) for email, message_id in zip(emails, message_ids)])
+
+
+def mark_failed(emails, error, permanent=False):
+    """Reprograma los emails con backoff, o los deja en 'dead' si no quedan intentos"""
+    now = datetime.now()
+    message = str(error)[:1000]
+    dead, retry = [], []
+    for email in emails:
+        if permanent or email['attempts'] >= EMAIL_MAX_ATTEMPTS:
+            dead.append((message, now, email['id']))
+        else:
+            retry.append((now + timedelta(seconds=retry_delay(email['attempts'])), message, now, email['id']))
+    with db.transaction() as tx:
+        tx.executemany("""
+            UPDATE email_outbox SET status = 'dead', locked_until = NULL, last_error = %s, updated_at = %s
+            WHERE id = %s
+        """, dead)
+        tx.executemany("""
+            UPDATE email_outbox SET status = 'pending', locked_until = NULL, run_at = %s, last_error = %s, updated_at = %s
+            WHERE id = %s
+        """, retry)
+    if dead:
+        logger.error(f"💀 {len(dead)} emails descartados: {message}")
+    if retry:
+        logger.warning(f"🔁 {len(retry)} emails se reintentarán: {message}")
+
+
+def send_batch(emails):
+    """Entrega un lote ya tomado; retorna cuántos quedaron enviados"""
+    if _transport is None:
+        mark_failed(emails, 'Sin transporte de email configurado')
+        return 0
+
+    send_bucket.acquire(len(emails))
+    try:
+        message_ids = _transport(emails)
+    except PermanentEmailError as e:
+        if len(emails) > 1:
+            # El proveedor rechaza el lote entero por un destinatario inválido:
+            # enviarlos de a uno deja en 'dead' solo al culpable
+            return sum(send_batch([email]) for email in emails)
+        mark_failed(emails, e, permanent=True)
+        return 0
+    except Exception as e:
+        mark_failed(emails, e)
+        return 0
+
+    mark_sent(emails, message_ids)
+    logger.info(f"📧 {len(emails)} emails enviados")
+    return len(emails)
+
+
+def run_pending(limit=1000):
+    """Envía en este hilo los emails listos (útil en tests y scripts)"""
+    sent = processed = 0
+    while processed < limit:
+        emails = claim_emails(min(EMAIL_BATCH_SIZE, limit - processed))
+        if not emails:
+            break
+        sent += send_batch(emails)
+        processed += len(emails)
+    return sent
+
+
+def get_email_stats():
+    """Cantidad de emails por tipo y estado, más los últimos descartados"""
+    rows = db.run_query("SELECT kind, status, COUNT(*) FROM email_outbox GROUP BY kind, status", fetchall=True) or []
+    counts = {}
+    for kind, status, count in rows:
+        counts.setdefault(kind, {})[status] = int(count)
+    dead = db.run_query("""
+        SELECT id, kind, ref, to_email, attempts, last_error, updated_at FROM email_outbox
+        WHERE status = 'dead' ORDER BY updated_at DESC LIMIT 20
+    """, fetchall=True) or []
+    return {
+        'counts': counts,
+        'dead': [
+            {'id': r[0], 'kind': r[1], 'ref': r[2], 'to_email': r[3], 'attempts': r[4],
+             'last_error': r[5], 'updated_at': str(r[6])}
+            for r in dead
+        ],
+        'sender': bool(_sender and _sender.is_alive()) if _sender_pid == os.getpid() else False,
+    }
+
+
+def _work():
+    while True:
+        try:
+            emails = claim_emails()
+        except Exception as e:
+            logger.error(f"Error tomando emails: {e}")
+            emails = []
+        if not emails:
+            _wakeup.wait(EMAIL_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        try:
+            send_batch(emails)
+        except Exception as e:
+            # Si no se pudo registrar el resultado, el lease vencido los devuelve a la cola
+            logger.error(f"Error enviando lote de emails: {e}")
+            time.sleep(EMAIL_POLL_INTERVAL)
+
+
+def start_email_sender():
+    """Inicia (una vez por proceso) el hilo que envía la bandeja de salida"""
+    global _sender, _sender_pid
+    with _sender_lock:
+        if _sender_pid == os.getpid():
+            return
+        _sender = threading.Thread(target=_work, name='email-sender', daemon=True)
+        _sender.start()
+        _sender_pid = os.getpid()
+    logger.info("✅ Envío de emails en segundo plano iniciado")
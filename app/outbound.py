@@ -0,0 +1,249 @@
+"""
+Cliente HTTP saliente compartido (MercadoPago, Brevo, ...).
+
+Un `OutboundClient` por dependencia mantiene una `requests.Session` con pool
+de conexiones por host (keep-alive), timeouts de conexión y de lectura,
+reintentos acotados con backoff y jitter, y un circuit breaker propio: si la
+dependencia está caída se falla rápido en vez de acumular hilos esperando.
+Cada llamada queda registrada en contadores de latencia y errores por
+endpoint, visibles en /admin/db_stats.
+
+    brevo = OutboundClient('brevo', base_url='https://api.brevo.com/v3')
+    response = brevo.request('POST', '/smtp/email', json=payload, endpoint='smtp.email')
+"""
+import os
+import re
+import time
+import random
+import threading
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from mercadopago.http import HttpClient as MercadoPagoBaseHttpClient
+
+from app.breaker import CircuitBreaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '10'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '2'))               # reintentos además del primer intento
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '0.3'))  # segundos; se duplica por intento
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '3'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))           # conexiones por host
+HTTP_BREAKER_THRESHOLD = int(os.getenv('HTTP_BREAKER_THRESHOLD', '5'))
+HTTP_BREAKER_RESET = float(os.getenv('HTTP_BREAKER_RESET', '30'))
+
+# Métodos que se pueden repetir sin riesgo aunque el servidor ya los haya recibido
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+LATENCY_SAMPLES = 200
+
+
+class EndpointStats:
+    """Contadores de una ruta: llamadas, errores, reintentos y latencias recientes"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.timed = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.statuses = {}
+        self.last_error = None
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def snapshot(self):
+        samples = sorted(self.latencies)
+
+        def percentile(p):
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))], 1) if samples else None
+
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'avg_ms': round(self.total_ms / self.timed, 1) if self.timed else None,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95),
+            'max_ms': round(self.max_ms, 1),
+            'statuses': dict(self.statuses),
+            'last_error': self.last_error,
+        }
+
+
+def endpoint_name(method, url):
+    """'GET /v1/payments/123' -> 'GET /v1/payments/:id' (agrupa ids numéricos)"""
+    path = re.sub(r'/\d+(?=/|$)', '/:id', urlsplit(url).path or '/')
+    return f"{method} {path}"
+
+
+def _never_sent(error):
+    """True si el error ocurrió al conectar (la petición no alcanzó a enviarse)"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class OutboundClient:
+    """Sesión HTTP con pool, timeouts, reintentos y circuit breaker para una dependencia"""
+
+    def __init__(self, name, base_url='', headers=None, connect_timeout=None, read_timeout=None,
+                 retries=None, pool_size=None, breaker=None):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout or HTTP_CONNECT_TIMEOUT, read_timeout or HTTP_READ_TIMEOUT)
+        self.retries = HTTP_RETRIES if retries is None else retries
+        self.breaker = breaker or CircuitBreaker(
+            name, failure_threshold=HTTP_BREAKER_THRESHOLD, reset_timeout=HTTP_BREAKER_RESET
+        )
+
+        # Los reintentos los maneja request(); el adapter solo aporta el pool
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size or HTTP_POOL_SIZE, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _record(self, endpoint, elapsed_ms, status=None, error=None, retried=False):
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats()
+            stats.calls += 1
+            if elapsed_ms is not None:
+                stats.timed += 1
+                stats.total_ms += elapsed_ms
+                stats.max_ms = max(stats.max_ms, elapsed_ms)
+                stats.latencies.append(elapsed_ms)
+            if retried:
+                stats.retries += 1
+            if status is not None:
+                stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            if error is not None:
+                stats.errors += 1
+                stats.last_error = str(error)[:300]
+
+    def _backoff(self, attempt, response=None):
+        """Espera antes del reintento `attempt` (1, 2, ...); respeta Retry-After si es corto"""
+        delay = min(HTTP_BACKOFF_BASE * 2 ** (attempt - 1), HTTP_BACKOFF_MAX) * random.uniform(0.5, 1.0)
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), HTTP_BACKOFF_MAX))
+        time.sleep(delay)
+
+    def request(self, method, url, endpoint=None, retry=None, **kwargs):
+        """
+        Hace la petición y retorna el `requests.Response` (también para 4xx/5xx).
+
+        Reintenta los fallos al conectar siempre, y timeouts de lectura, 429 y
+        5xx solo si el método es idempotente (o `retry=True`). Lanza CircuitOpenError
+        si el circuito de la dependencia está abierto, o la excepción de
+        requests del último intento.
+        """
+        method = method.upper()
+        if not url.startswith(('http://', 'https://')):
+            url = f"{self.base_url}/{url.lstrip('/')}"
+        endpoint = endpoint or endpoint_name(method, url)
+        kwargs.setdefault('timeout', self.timeout)
+        can_retry = method in IDEMPOTENT_METHODS if retry is None else retry
+
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._record(endpoint, None, error='circuit open')
+                raise CircuitOpenError(f"{self.name} no disponible (circuito abierto)")
+
+            started = time.monotonic()
+            response = error = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                # Si la petición nunca llegó al servidor, repetirla es seguro para cualquier método
+                error, retryable = e, can_retry or _never_sent(e)
+            elapsed_ms = (time.monotonic() - started) * 1000
+
+            if response is not None:
+                failed = response.status_code >= 500
+                retryable = can_retry and response.status_code in RETRY_STATUSES
+                if failed:
+                    self.breaker.record_failure(f"HTTP {response.status_code}")
+                else:
+                    # Un 4xx indica que la dependencia responde: no abre el circuito
+                    self.breaker.record_success()
+                error = f"HTTP {response.status_code}" if failed or response.status_code == 429 else None
+            else:
+                self.breaker.record_failure(error)
+
+            retrying = retryable and error is not None and attempt < self.retries
+            self._record(
+                endpoint, elapsed_ms, status=response.status_code if response is not None else None,
+                error=error, retried=retrying
+            )
+            if not retrying:
+                if response is None:
+                    logger.warning(f"⚠️ {self.name} {endpoint} falló tras {attempt + 1} intentos: {error}")
+                    raise error
+                return response
+
+            attempt += 1
+            logger.info(f"🔁 {self.name} {endpoint}: {error}, reintento {attempt}/{self.retries}")
+            if response is not None:
+                response.close()
+            self._backoff(attempt, response)
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {name: stats.snapshot() for name, stats in self._stats.items()}
+        return {'name': self.name, 'breaker': self.breaker.snapshot(), 'endpoints': endpoints}
+
+
+class MercadoPagoHttpClient(MercadoPagoBaseHttpClient):
+    """
+    Adaptador con la interfaz `http_client` del SDK de MercadoPago
+    (request/get/post/put/delete que retornan {'status', 'response'}), para
+    que el SDK use el pool, los timeouts y el breaker de un OutboundClient.
+    El timeout y los reintentos que manda el SDK se ignoran: mandan los del cliente.
+    Si el cliente apunta a otra URL base (p. ej. un stub local), las URLs
+    absolutas del SDK se redirigen a ella.
+    """
+
+    SDK_BASE_URL = 'https://api.mercadopago.com'
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        kwargs.pop('timeout', None)
+        if self.client.base_url and url.startswith(self.SDK_BASE_URL):
+            url = self.client.base_url + url[len(self.SDK_BASE_URL):]
+        api_result = self.client.request(method, url, **kwargs)
+        response = {'status': api_result.status_code, 'response': None}
+        if api_result.status_code != 204 and api_result.content:
+            try:
+                response['response'] = api_result.json()
+            except ValueError as e:
+                logger.warning(f"Respuesta no JSON de MercadoPago ({api_result.status_code}): {e}")
+        return response
+
+    def get(self, url, headers, params=None, timeout=None, maxretries=None):
+        return self.request('GET', url, headers=headers, params=params)
+
+    def post(self, url, headers, data=None, params=None, timeout=None, maxretries=None):
+        return self.request('POST', url, headers=headers, data=data, params=params)
+
+    def put(self, url, headers, data=None, params=None, timeout=None, maxretries=None):
+        return self.request('PUT', url, headers=headers, data=data, params=params)
+
+    def delete(self, url, headers, params=None, timeout=None, maxretries=None):
+        return self.request('DELETE', url, headers=headers, params=params)
@@ -0,0 +1,152 @@
+"""
+Conciliación de pagos de MercadoPago contra `purchases`.
+
+Si un webhook nunca llega (o llega durante una caída), el pago aprobado no
+tiene compra. Periódicamente se consultan los pagos aprobados recientes con
+la API de búsqueda (paginada: una llamada por página, no por compra), se
+comparan en bloque con las compras registradas y solo los que faltan se
+encolan como trabajo `mercadopago_payment`, el mismo que usa el webhook.
+Un pago cuyo trabajo ya terminó o quedó en dead-letter (p. ej. números
+agotados o pago insuficiente) no se vuelve a encolar: lo revisa un admin.
+
+    reconcile.reconcile_payments(mercadopago_http, MERCADOPAGO_ACCESS_TOKEN)
+"""
+import os
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+
+from app import db, jobs
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_KIND = 'mercadopago_reconcile'
+MP_RECONCILE_INTERVAL = float(os.getenv('MP_RECONCILE_INTERVAL', '600'))          # segundos entre corridas
+MP_RECONCILE_LOOKBACK_HOURS = float(os.getenv('MP_RECONCILE_LOOKBACK_HOURS', '48'))
+MP_RECONCILE_PAGE_SIZE = int(os.getenv('MP_RECONCILE_PAGE_SIZE', '100'))
+MP_RECONCILE_MAX_PAGES = int(os.getenv('MP_RECONCILE_MAX_PAGES', '50'))
+# Solo se concilian los pagos creados por esta app: compras por cantidad (rifa_mp_)
+# y de números elegidos (rifa_ch_, ver CHOSEN_PREFIX en server.py)
+MP_REFERENCE_PREFIXES = tuple(
+    prefix.strip() for prefix in os.getenv('MP_REFERENCE_PREFIXES', 'rifa_mp_,rifa_ch_').split(',') if prefix.strip()
+)
+LOOKUP_CHUNK = 500
+
+
+def _mp_date(value):
+    return value.astimezone(timezone.utc).isoformat(timespec='milliseconds')
+
+
+def search_approved_payments(client, access_token, begin, end, page_size=None, max_pages=None):
+    """Genera los pagos aprobados creados entre `begin` y `end`, página por página"""
+    page_size = page_size or MP_RECONCILE_PAGE_SIZE
+    offset = 0
+    for _ in range(max_pages or MP_RECONCILE_MAX_PAGES):
+        response = client.request(
+            'GET', '/v1/payments/search', endpoint='GET /v1/payments/search',
+            headers={'Authorization': f'Bearer {access_token}'},
+            params={
+                'status': 'approved',
+                'range': 'date_created',
+                'begin_date': _mp_date(begin),
+                'end_date': _mp_date(end),
+                'sort': 'date_created',
+                'criteria': 'asc',
+                'limit': page_size,
+                'offset': offset,
+            },
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"Búsqueda de pagos respondió {response.status_code}: {response.text[:300]}")
+
+        data = response.json()
+        results = data.get('results') or []
+        yield from results
+        offset += len(results)
+        if not results or offset >= (data.get('paging') or {}).get('total', 0):
+            return
+    logger.warning(f"⚠️ Conciliación truncada en {offset} pagos (MP_RECONCILE_MAX_PAGES)")
+
+
+def missing_invoices(invoice_ids):
+    """De `invoice_ids`, los que no tienen ninguna fila en purchases (una consulta por bloque)"""
+    invoice_ids = list(dict.fromkeys(invoice_ids))
+    existing = set()
+    for start in range(0, len(invoice_ids), LOOKUP_CHUNK):
+        chunk = invoice_ids[start:start + LOOKUP_CHUNK]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        rows = db.run_query(
+            f"SELECT invoice_id FROM purchases WHERE invoice_id IN ({placeholders})",
+            params=tuple(chunk), fetchall=True
+        ) or []
+        existing.update(row[0] for row in rows)
+    return [invoice_id for invoice_id in invoice_ids if invoice_id not in existing]
+
+
+def settled_payments(payment_ids):
+    """
+    De `payment_ids`, los que ya tuvieron su trabajo `mercadopago_payment`
+    (terminado o en dead-letter) o su evento procesado (una consulta por bloque)
+    """
+    payment_ids = [str(payment_id) for payment_id in dict.fromkeys(payment_ids)]
+    settled = set()
+    for start in range(0, len(payment_ids), LOOKUP_CHUNK):
+        chunk = payment_ids[start:start + LOOKUP_CHUNK]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        rows = db.run_query(f"""
+            SELECT dedupe_key FROM jobs
+            WHERE kind = 'mercadopago_payment' AND dedupe_key IN ({placeholders}) AND status IN ('done', 'dead')
+        """, params=tuple(f"mercadopago:{payment_id}" for payment_id in chunk), fetchall=True) or []
+        settled.update(row[0].split(':', 1)[1] for row in rows)
+        rows = db.run_query(
+            f"SELECT event_id FROM processed_events WHERE gateway = 'mercadopago' AND event_id IN ({placeholders})",
+            params=tuple(chunk), fetchall=True
+        ) or []
+        settled.update(row[0] for row in rows)
+    return settled
+
+
+def reconcile_payments(client, access_token, lookback_hours=None, now=None):
+    """
+    Encola `mercadopago_payment` para cada pago aprobado de la ventana que no
+    tenga compra. Una compra eliminada por un admin sigue contando como
+    registrada, así la conciliación no la revive.
+    """
+    end = now or datetime.now(timezone.utc)
+    begin = end - timedelta(hours=lookback_hours or MP_RECONCILE_LOOKBACK_HOURS)
+
+    payments = {}
+    for payment in search_approved_payments(client, access_token, begin, end):
+        reference = payment.get('external_reference') or ''
+        if payment.get('status') == 'approved' and reference.startswith(MP_REFERENCE_PREFIXES):
+            payments[reference] = payment
+
+    missing = missing_invoices(payments)
+    settled = settled_payments(payments[reference]['id'] for reference in missing)
+    skipped = [reference for reference in missing if str(payments[reference]['id']) in settled]
+    enqueued = 0
+    for reference in missing:
+        payment_id = payments[reference]['id']
+        if str(payment_id) in settled:
+            continue
+        if jobs.enqueue('mercadopago_payment', {'payment_id': payment_id},
+                        dedupe_key=f"mercadopago:{payment_id}") is not None:
+            enqueued += 1
+
+    if missing:
+        logger.warning(f"🧾 Conciliación MercadoPago: {len(missing)} pagos aprobados sin compra, {enqueued} encolados, "
+                       f"{len(skipped)} ya intentados (ver /admin/jobs)")
+    else:
+        logger.info(f"🧾 Conciliación MercadoPago: {len(payments)} pagos aprobados, ninguno faltante")
+    return {'approved': len(payments), 'missing': missing, 'enqueued': enqueued, 'skipped': skipped}
+
+
+def schedule_next(interval=None):
+    """
+    Encola la próxima corrida al inicio del siguiente intervalo. La clave de
+    deduplicación es el intervalo, así varios workers programan una sola.
+    """
+    interval = interval or MP_RECONCILE_INTERVAL
+    slot = int(time.time() // interval) + 1
+    return jobs.enqueue(RECONCILE_KIND, {'slot': slot}, dedupe_key=f"{RECONCILE_KIND}:{slot}",
+                        delay=max(0.0, slot * interval - time.time()))
@@ -0,0 +1,219 @@
+"""
+Búsqueda de compras del panel de administración (/database).
+
+`LOWER(col) LIKE '%q%'` sobre varias columnas no puede usar índices: cada
+búsqueda recorría toda la tabla purchases. Aquí cada backend usa el suyo:
+
+- Postgres: GIN con pg_trgm sobre db.PURCHASE_SEARCH_SQL (sirve LIKE '%q%');
+  ordena por word_similarity.
+- SQLite: tabla FTS5 `purchases_search` con tokenizer trigram, mantenida
+  por triggers; ordena por bm25.
+
+Con menos de 3 caracteres no hay trigramas: se usa LIKE sin índice.
+
+Una búsqueda de solo dígitos es además un número de boleta: se resuelve
+con una consulta por la clave primaria (raffle_id, number) de
+assigned_numbers, sin mirar el texto de purchases.numbers (donde '5'
+también coincidiría con 15, 150 y 1500), y esa compra va primero. Con 1 o
+2 dígitos es solo eso: un LIKE '%7%' coincidiría con casi todos los
+teléfonos y documentos, recorriendo la tabla para nada.
+"""
+import base64
+import json
+import logging
+
+from app import db
+from app.db import PURCHASE_SEARCH_SQL
+
+logger = logging.getLogger(__name__)
+
+MIN_INDEXED_QUERY = 3
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+# Por encima de este total el conteo de Postgres es la estimación del planificador
+COUNT_EXACT_LIMIT = 10_000
+CREATED_AT_COLUMN = 6  # posición de created_at en SELECT * FROM purchases
+
+_support = {}
+
+
+def index_support():
+    """Si existe el índice de búsqueda del backend activo (se consulta una vez por proceso)"""
+    backend = db.get_backend()
+    if backend not in _support:
+        if backend == 'postgres':
+            row = db.run_query("SELECT 1 FROM pg_indexes WHERE indexname = 'idx_purchases_search_trgm'", fetchone=True)
+        else:
+            row = db.run_query("SELECT 1 FROM sqlite_master WHERE name = 'purchases_search'", fetchone=True)
+        _support[backend] = bool(row)
+        if not row:
+            logger.warning(f"⚠️ Búsqueda de compras sin índice en {backend}: se usará LIKE")
+    return _support[backend]
+
+
+def _like_pattern(text):
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def ticket_number(q):
+    """El número de boleta que representa `q`, o None si no es uno ('007' -> 7)"""
+    q = q.strip()
+    if not q.isdigit() or int(q) >= db.MAX_POOL_SIZE:
+        return None
+    return int(q)
+
+
+def number_owner(number, raffle_id=db.DEFAULT_RAFFLE_ID):
+    """invoice_id que tiene asignado `number` en la rifa (una consulta por clave primaria)"""
+    row = db.run_query(
+        "SELECT invoice_id FROM assigned_numbers WHERE raffle_id = %s AND number = %s",
+        params=(raffle_id, number), fetchone=True
+    )
+    return row[0] if row else None
+
+
+def build_search(q, is_sqlite, indexed=True):
+    """
+    Condición y orden para buscar `q` en los datos del comprador, en la
+    forma que puede usar el índice del backend.
+    Retorna (condition, params, order, order_params).
+    """
+    q = q.strip()
+    lowered = q.lower()
+
+    if not indexed or len(q) < MIN_INDEXED_QUERY:
+        like = _like_pattern(lowered)
+        columns = ('full_name', 'email', 'phone', 'document_number')
+        condition = ' OR '.join(f"LOWER({column}) LIKE %s ESCAPE '\\'" for column in columns)
+        return f"({condition})", [like] * len(columns), "created_at DESC", []
+
+    if is_sqlite:
+        match = _fts_phrase(q)
+        condition = "id IN (SELECT rowid FROM purchases_search WHERE purchases_search MATCH %s)"
+        # rank es bm25: más negativo = más relevante
+        order = "(SELECT rank FROM purchases_search WHERE purchases_search MATCH %s AND rowid = purchases.id), created_at DESC"
+        return condition, [match], order, [match]
+
+    condition = f"{PURCHASE_SEARCH_SQL} LIKE %s"
+    order = f"word_similarity(%s, {PURCHASE_SEARCH_SQL}) DESC, created_at DESC"
+    return condition, [_like_pattern(lowered)], order, [lowered]
+
+
+def encode_cursor(row):
+    """Cursor opaco de la página siguiente a `row`: su (created_at, id)"""
+    raw = json.dumps([str(row[CREATED_AT_COLUMN]), row[0]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(created_at, id) de un cursor de encode_cursor; None si no es válido"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        created_at, purchase_id = json.loads(raw)
+        return str(created_at), int(purchase_id)
+    except (ValueError, TypeError) as e:
+        logger.warning(f"⚠️ Cursor de paginación inválido ({cursor!r}): {e}")
+        return None
+
+
+def page_size(value):
+    """Tamaño de página pedido por el cliente, acotado a [1, MAX_PAGE_SIZE]"""
+    try:
+        return min(max(int(value), 1), MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+
+
+def count_purchases(where, params):
+    """
+    (total, exact) de las compras que cumplen `where`. En Postgres se cuenta
+    hasta COUNT_EXACT_LIMIT filas; por encima se usa la estimación del
+    planificador en lugar de recorrer todo.
+    """
+    if db.is_sqlite():
+        row = db.run_query(f"SELECT COUNT(*) FROM purchases WHERE {where}", params=tuple(params), fetchone=True)
+        return (row[0] if row else 0), True
+
+    row = db.run_query(
+        f"SELECT COUNT(*) FROM (SELECT 1 FROM purchases WHERE {where} LIMIT %s) AS capped",
+        params=tuple(params) + (COUNT_EXACT_LIMIT + 1,), fetchone=True
+    )
+    if row and row[0] <= COUNT_EXACT_LIMIT:
+        return row[0], True
+    plan = db.run_query(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM purchases WHERE {where}",
+                        params=tuple(params), fetchone=True)[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return max(int(plan[0]['Plan']['Plan Rows']), COUNT_EXACT_LIMIT + 1), False
+
+
+def search_purchases(q='', raffle_id=db.DEFAULT_RAFFLE_ID, date_from=None, date_to=None, status=None,
+                     limit=PAGE_SIZE, cursor=None):
+    """
+    Una página de compras no eliminadas de la rifa que cumplen los filtros.
+
+    Sin texto de búsqueda la lista va de la más reciente a la más antigua y
+    se pagina por keyset: `cursor` (el next_cursor de la página anterior)
+    continúa después de la última fila vista, usando el índice
+    (raffle_id, created_at, id), así que una página profunda cuesta lo mismo
+    que la primera. Con texto de búsqueda se devuelven las `limit` más
+    relevantes, sin páginas siguientes.
+
+    Retorna {'rows', 'next_cursor', 'total', 'total_exact', 'ranked'}.
+    """
+    where = "raffle_id = %s AND (status != 'deleted' OR status IS NULL)"
+    params = [raffle_id]
+    if date_from:
+        where += " AND created_at >= %s"
+        params.append(date_from)
+    if date_to:
+        where += " AND created_at <= %s"
+        params.append(date_to)
+    if status:
+        where += " AND status = %s"
+        params.append(status)
+
+    ranked = bool(q and q.strip())
+    if ranked:
+        number = ticket_number(q)
+        owner = number_owner(number, raffle_id) if number is not None else None
+        if number is not None and len(q.strip()) < MIN_INDEXED_QUERY:
+            # 1-2 dígitos: solo la boleta, sin LIKE sobre los datos del comprador
+            if not owner:
+                return {'rows': [], 'next_cursor': None, 'total': 0, 'total_exact': True, 'ranked': True}
+            condition, search_params, order, order_params = "invoice_id = %s", [owner], "created_at DESC", []
+        else:
+            condition, search_params, order, order_params = build_search(q, db.is_sqlite(), index_support())
+            if owner:
+                condition = f"(invoice_id = %s OR {condition})"
+                search_params = [owner] + search_params
+                order = f"(invoice_id = %s) DESC, {order}"
+                order_params = [owner] + order_params
+        where += f" AND {condition}"
+        params.extend(search_params)
+    else:
+        order, order_params = "created_at DESC, id DESC", []
+
+    total, total_exact = count_purchases(where, params)
+
+    query_where, query_params = where, list(params)
+    position = decode_cursor(cursor) if cursor and not ranked else None
+    if position:
+        query_where += " AND (created_at, id) < (%s, %s)"
+        query_params.extend(position)
+
+    rows = db.run_query(
+        f"SELECT * FROM purchases WHERE {query_where} ORDER BY {order} LIMIT %s",
+        params=tuple(query_params + order_params + [limit + 1]), fetchall=True
+    ) or []
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if not ranked:
+            next_cursor = encode_cursor(rows[-1])
+    return {'rows': rows, 'next_cursor': next_cursor, 'total': total, 'total_exact': total_exact, 'ranked': ranked}
@@ -0,0 +1,62 @@
+"""
+Archivos compartidos por los workers de una máquina.
+
+`MappedFile` abre (o crea) un archivo de tamaño fijo mapeado en memoria
+(mmap) y lo protege con un lock exclusivo entre hilos y procesos; lo usan
+el bitmap de números y los contadores de versión. `flock` es el lock
+entre procesos sobre cualquier descriptor (en Windows no hace nada y solo
+queda el lock entre hilos de quien lo use).
+"""
+import os
+import mmap
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo lock entre hilos
+    fcntl = None
+
+
+@contextmanager
+def flock(fd):
+    """Lock exclusivo entre procesos sobre `fd`"""
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class MappedFile:
+    """Archivo de `length` bytes mapeado en memoria, con lock entre hilos y procesos"""
+
+    def __init__(self, path, length, init=None):
+        """
+        Abre `path` y lo deja en `length` bytes. `init(mm, previous_size)`
+        corre con el lock tomado justo después de mapearlo, para que un solo
+        proceso inicialice un archivo nuevo o de otro formato.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.lock():
+            previous_size = os.fstat(self._fd).st_size
+            if previous_size != length:
+                os.ftruncate(self._fd, length)
+            self.mm = mmap.mmap(self._fd, length)
+            if init:
+                init(self.mm, previous_size)
+
+    @contextmanager
+    def lock(self):
+        with self._lock, flock(self._fd):
+            yield
+
+    def close(self):
+        try:
+            self.mm.close()
+        finally:
+            os.close(self._fd)
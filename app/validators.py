@@ -62,8 +62,8 @@ def validate_invoice_id(invoice_id):
     return True, invoice_id
 
 
-def validate_numbers(numbers_str):
-    """Valida la lista de números"""
+def validate_numbers(numbers_str, pool_size=2000):
+    """Valida la lista de números (1..pool_size de la rifa)"""
     if not numbers_str or not isinstance(numbers_str, str):
         return False, "Números requeridos"
     
@@ -73,10 +73,10 @@ def validate_numbers(numbers_str):
         # Dividir por comas y validar cada número
         numbers = [int(n.strip()) for n in numbers_str.split(',')]
         
-        # Validar que sean números entre 1 y 2000
+        # Validar que sean números entre 1 y el tamaño del pool
         for num in numbers:
-            if num < 1 or num > 2000:
-                return False, f"Los números deben estar entre 1 y 2000 (recibido: {num})"
+            if num < 1 or num > pool_size:
+                return False, f"Los números deben estar entre 1 y {pool_size} (recibido: {num})"
         
         # Verificar números duplicados
         if len(numbers) != len(set(numbers)):
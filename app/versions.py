@@ -0,0 +1,46 @@
+"""
+Contadores de versión compartidos por los workers de una máquina.
+
+Cada nombre ('blessed', 'progress', ...) es un entero de 32 bits en un
+archivo mapeado en memoria (mmap); se incrementa cuando cambia el dato que
+representa, así cualquier worker puede calcular un ETag sin consultar la
+base de datos. Un archivo nuevo arranca con valores aleatorios para que un
+reinicio no repita los ETag de antes.
+"""
+import mmap
+import struct
+import secrets
+
+from app.shmem import MappedFile
+
+SLOT = struct.Struct('<I')
+
+
+class SharedVersions:
+    """Contadores con nombre respaldados por un archivo mmap compartido"""
+
+    def __init__(self, path, names):
+        self.path = path
+        self._slots = {name: i * SLOT.size for i, name in enumerate(names)}
+        length = max(SLOT.size * len(names), mmap.PAGESIZE)
+        self._file = MappedFile(path, length, init=self._init_file)
+        self._mm = self._file.mm
+
+    def _init_file(self, mm, previous_size):
+        if previous_size < len(mm):
+            for offset in self._slots.values():
+                SLOT.pack_into(mm, offset, secrets.randbits(32))
+
+    def get(self, name):
+        return SLOT.unpack_from(self._mm, self._slots[name])[0]
+
+    def bump(self, name):
+        """Incrementa la versión de `name` y retorna el nuevo valor"""
+        offset = self._slots[name]
+        with self._file.lock():
+            value = (SLOT.unpack_from(self._mm, offset)[0] + 1) & 0xFFFFFFFF
+            SLOT.pack_into(self._mm, offset, value)
+        return value
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,10 @@
+"""
+Configuración de gunicorn (la toma sola desde el directorio de trabajo;
+el Dockerfile y .railway.json la pasan además con -c).
+"""
+
+
+def post_worker_init(worker):
+    # Ya cargada la app (y aplicado el monkey patch de gevent): hilos de fondo de este worker
+    from server import start_background_workers
+    start_background_workers()
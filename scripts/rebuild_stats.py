@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Recalcula desde cero raffle_stats (números y compras confirmadas, recaudo y
+compras por paquete) a partir de la tabla purchases.
+Ejecutar: python scripts/rebuild_stats.py [RAFFLE_ID ...]
+Sin argumentos recalcula todas las rifas. Funciona con Postgres y SQLite.
+"""
+
+import sys
+import os
+
+# Agregar el directorio raíz al path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app import db as app_db
+
+
+def main(args):
+    raffle_ids = [int(a) for a in args] or [r['id'] for r in app_db.get_raffles()]
+    for raffle_id in raffle_ids:
+        stats = app_db.rebuild_raffle_stats(raffle_id)
+        print(f"Rifa {raffle_id}: {stats['confirmed_purchases']} compras, "
+              f"{stats['confirmed_numbers']} números, ${stats['revenue']:,.0f}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
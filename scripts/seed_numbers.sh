@@ -1,21 +1,33 @@
 #!/usr/bin/env bash
 set -euo pipefail
 
-# Inserta números del 1 al 2000 en la tabla assigned_numbers como disponibles
+# Llena number_pool de una rifa con los números 1..pool_size en orden aleatorio (position).
+# El asignador consume la permutación desde raffles.next_position, así que
+# reclamar k números cuesta O(k) aunque el pool tenga millones.
 DB_HOST=${DB_HOST:-localhost}
 DB_PORT=${DB_PORT:-5432}
 DB_NAME=${DB_NAME:-rifa_db}
 DB_USER=${DB_USER:-rifa_user}
+RAFFLE_ID=${RAFFLE_ID:-1}
 
-echo "Seed: insertando números 1..2000 en assigned_numbers (si no existen)"
-psql -h "$DB_HOST" -p "$DB_PORT" -U "$DB_USER" -d "$DB_NAME" -v ON_ERROR_STOP=1 <<'SQL'
+echo "Seed: insertando números de la rifa ${RAFFLE_ID} en number_pool (si no existen)"
+psql -h "$DB_HOST" -p "$DB_PORT" -U "$DB_USER" -d "$DB_NAME" -v ON_ERROR_STOP=1 -v raffle_id="$RAFFLE_ID" <<'SQL'
 BEGIN;
-CREATE TEMP TABLE tmp_nums(num int);
-INSERT INTO tmp_nums SELECT generate_series(1,2000);
-INSERT INTO assigned_numbers (number, status)
-SELECT num, 'available' FROM tmp_nums
-ON CONFLICT (number) DO NOTHING;
-DROP TABLE tmp_nums;
+INSERT INTO number_pool (raffle_id, number, position)
+SELECT :raffle_id, n,
+       (SELECT COALESCE(MAX(position), 0) FROM number_pool WHERE raffle_id = :raffle_id)
+       + row_number() OVER (ORDER BY random())
+FROM generate_series(1, (SELECT pool_size FROM raffles WHERE id = :raffle_id)) AS n
+WHERE NOT EXISTS (SELECT 1 FROM number_pool p WHERE p.raffle_id = :raffle_id AND p.number = n);
+UPDATE raffles
+SET tail_position = (SELECT COALESCE(MAX(position), 0) FROM number_pool WHERE raffle_id = :raffle_id)
+WHERE id = :raffle_id;
+-- Marcar como tomados los números ya vendidos
+UPDATE number_pool p
+SET invoice_id = a.invoice_id, claimed_at = CURRENT_TIMESTAMP
+FROM assigned_numbers a
+WHERE a.raffle_id = p.raffle_id AND a.number = p.number
+  AND p.raffle_id = :raffle_id AND p.invoice_id IS NULL;
 COMMIT;
 SQL
 
@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+Banco de carga de webhooks con pasarelas simuladas.
+
+Reproduce un log capturado (WEBHOOK_CAPTURE_PATH, ver app/capture.py) o
+sintetiza miles de notificaciones de MercadoPago y ePayco, y las envía en
+paralelo contra la app levantada en este mismo proceso. Servidores stub
+locales reemplazan la API de pagos de MercadoPago y la de Brevo. Al final
+espera a que la cola de trabajos y la bandeja de emails se vacíen y reporta:
+
+  - latencia p50/p95/p99 de los webhooks y throughput (peticiones y compras/s)
+  - invariantes: sin números duplicados, sin compras perdidas y un email por compra
+
+Ejecutar:
+    python scripts/webhook_harness.py synth --payments 2000 --duplicates 0.2 --concurrency 32
+    python scripts/webhook_harness.py replay webhooks.log.gz --concurrency 32
+
+Por defecto usa una base SQLite temporal. Con --backend postgres usa las
+variables DB_* del entorno: apúntalas a una base desechable (el banco crea
+su propia rifa y no borra nada, pero sí inserta compras).
+Sale con código 1 si alguna invariante falla.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode
+
+# Agregar el directorio raíz al path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import requests
+
+NUMBER_PRICE = 1000
+MAX_TICKETS = 5
+WEBHOOK_SECRET = 'harness-secret'
+PAYMENT_ID_BASE = 9_000_000_000
+WEBHOOK_KINDS = ('mercadopago_payment', 'epayco_confirmation')
+
+
+# ==================== STUBS DE PASARELAS ====================
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class MercadoPagoStub(StubHandler):
+    """GET /v1/payments/<id>: pagos registrados por el banco, o uno aprobado sintético"""
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        path = self.path.split('?', 1)[0]
+        if path == '/v1/payments/search':
+            # La conciliación queda fuera de la medición: no hay pagos que buscar
+            return self.reply(200, {'paging': {'total': 0, 'limit': 0, 'offset': 0}, 'results': []})
+        match = re.fullmatch(r'/v1/payments/(\d+)', path)
+        if not match:
+            return self.reply(404, {'message': 'not found'})
+        payment_id = int(match.group(1))
+        with self.server.lock:
+            self.server.calls[payment_id] += 1
+        self.reply(200, self.server.payments.get(payment_id) or replay_payment(payment_id, self.server.raffle_id))
+
+
+class BrevoStub(StubHandler):
+    """POST /v3/smtp/email: registra cada destinatario (también en messageVersions)"""
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        payload = self.read_json()
+        versions = payload.get('messageVersions') or [payload]
+        with self.server.lock:
+            self.server.calls['requests'] += 1
+            for version in versions:
+                for recipient in version.get('to') or []:
+                    self.server.recipients[recipient['email']] += 1
+        ids = [f'<{uuid.uuid4().hex}@harness>' for _ in versions]
+        self.reply(201, {'messageIds': ids} if payload.get('messageVersions') else {'messageId': ids[0]})
+
+
+def mp_payment(payment_id, reference, amount, email, raffle_id, status='approved'):
+    return {
+        'id': payment_id,
+        'status': status,
+        'external_reference': reference,
+        'transaction_amount': amount,
+        'payment_method_id': 'harness',
+        'payer': {'email': email, 'first_name': 'Harness', 'last_name': str(payment_id)},
+        'metadata': {'raffle_id': raffle_id},
+    }
+
+
+def replay_payment(payment_id, raffle_id):
+    """Pago aprobado determinista para un id capturado que el stub no conoce"""
+    tickets = 1 + payment_id % MAX_TICKETS
+    return mp_payment(payment_id, f'rifa_mp_replay_{payment_id}', tickets * NUMBER_PRICE,
+                      f'replay.{payment_id}@harness.test', raffle_id)
+
+
+# ==================== PLAN DE PETICIONES ====================
+
+def signed_mercadopago_webhook(payment_id, secret):
+    """Notificación de pago firmada como lo hace MercadoPago (x-signature)"""
+    request_id = uuid.uuid4().hex
+    ts = str(int(time.time() * 1000))
+    manifest = f"id:{payment_id};request-id:{request_id};ts:{ts};"
+    v1 = hmac.new(secret.encode(), manifest.encode(), hashlib.sha256).hexdigest()
+    return {
+        'path': f'/webhooks/mercadopago?{urlencode({"data.id": payment_id, "type": "payment"})}',
+        'headers': {'Content-Type': 'application/json', 'x-request-id': request_id, 'x-signature': f'ts={ts},v1={v1}'},
+        'body': json.dumps({'type': 'payment', 'action': 'payment.created', 'data': {'id': str(payment_id)}}),
+    }
+
+
+def epayco_confirmation(form):
+    return {
+        'path': '/confirmation',
+        'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+        'body': urlencode(form),
+    }
+
+
+def synth_plan(args, raffle_id, mp_stub):
+    """
+    Pagos sintéticos (aprobados y rechazados) y sus notificaciones, con una
+    fracción `duplicates` reenviada. Retorna (peticiones, compras esperadas).
+    """
+    rng = random.Random(args.seed)
+    run = uuid.uuid4().hex[:6]
+    sends, expected = [], {}
+    for i in range(args.payments):
+        gateway = args.gateway if args.gateway != 'both' else rng.choice(('mercadopago', 'epayco'))
+        tickets = rng.randint(1, MAX_TICKETS)
+        amount = tickets * NUMBER_PRICE
+        email = f'h{run}.{i}@harness.test'
+        approved = rng.random() >= args.rejected
+
+        if gateway == 'mercadopago':
+            # Ids únicos por corrida: en Postgres no chocan con los ya procesados
+            payment_id = PAYMENT_ID_BASE + int(run, 16) * 1_000_000 + i
+            reference = f'rifa_mp_h{run}_{i}'
+            mp_stub.payments[payment_id] = mp_payment(payment_id, reference, amount, email, raffle_id,
+                                                      'approved' if approved else 'rejected')
+            make = lambda payment_id=payment_id: signed_mercadopago_webhook(payment_id, WEBHOOK_SECRET)
+        else:
+            reference = f'h{run}e{i}'
+            form = {
+                'x_ref_payco': reference, 'x_transaction_id': f't{run}{i}', 'x_id_invoice': f'rifa_ep_h{run}_{i}',
+                'x_transaction_state': 'Aceptada' if approved else 'Rechazada', 'x_amount': str(amount),
+                'x_currency_code': 'COP', 'x_customer_email': email, 'x_customer_name': f'Harness {i}',
+                'x_extra1': str(raffle_id), 'x_type_payment': 'harness',
+            }
+            make = lambda form=form: epayco_confirmation(form)
+
+        copies = 1 + (rng.random() < args.duplicates)
+        sends.extend(make() for _ in range(copies))
+        if approved:
+            expected[reference] = {'email': email, 'tickets': tickets}
+
+    rng.shuffle(sends)
+    return sends, expected
+
+
+def replay_plan(args, raffle_id):
+    """Notificaciones del log capturado, en su orden original"""
+    from app.capture import CAPTURED_PATHS, read_records
+
+    sends, expected = [], {}
+    for record in read_records(args.log):
+        if record.get('method') != 'POST' or record.get('path') not in CAPTURED_PATHS:
+            continue
+        query, body = record.get('query') or '', record.get('body') or ''
+        headers = dict(record.get('headers') or {})
+        if record['path'] == '/confirmation':
+            form = {k: v[0] for k, v in parse_qs(body, keep_blank_values=True).items()}
+            # Los números se asignan en la rifa del banco
+            form['x_extra1'] = str(raffle_id)
+            body = urlencode(form)
+            if form.get('x_transaction_state') == 'Aceptada' and form.get('x_ref_payco') and form.get('x_customer_email'):
+                tickets = max(1, int(float(form.get('x_amount') or 0) // NUMBER_PRICE))
+                expected[form['x_ref_payco']] = {'email': form['x_customer_email'], 'tickets': tickets}
+        else:
+            try:
+                data = json.loads(body or '{}')
+            except ValueError:
+                data = {}
+            payment_id = str((data.get('data') or {}).get('id') or parse_qs(query).get('data.id', [''])[0])
+            if data.get('type') == 'payment' and payment_id.isdigit():
+                payment = replay_payment(int(payment_id), raffle_id)
+                expected[payment['external_reference']] = {
+                    'email': payment['payer']['email'], 'tickets': 1 + int(payment_id) % MAX_TICKETS,
+                }
+        sends.append({'path': record['path'] + (f'?{query}' if query else ''), 'headers': headers, 'body': body})
+    return sends, expected
+
+
+# ==================== CARGA ====================
+
+def fire(base_url, sends, concurrency):
+    """Envía las peticiones con `concurrency` hilos; retorna [(ruta, status, ms)]"""
+    local = threading.local()
+
+    def send(item):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            status = local.session.post(base_url + item['path'], data=item['body'].encode('utf-8'),
+                                        headers=item['headers'], timeout=30).status_code
+        except requests.RequestException:
+            status = 'error'
+        return item['path'].split('?', 1)[0], status, (time.perf_counter() - started) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(send, sends))
+
+
+def wait_for_drain(app_db, timeout):
+    """Espera a que no queden webhooks ni emails por procesar; retorna True si se vació"""
+    kinds = ', '.join(f"'{kind}'" for kind in WEBHOOK_KINDS)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        jobs_left = app_db.run_query(
+            f"SELECT COUNT(*) FROM jobs WHERE kind IN ({kinds}) AND status IN ('pending', 'running')", fetchone=True
+        )[0]
+        emails_left = app_db.run_query(
+            "SELECT COUNT(*) FROM email_outbox WHERE status IN ('pending', 'sending')", fetchone=True
+        )[0]
+        if not jobs_left and not emails_left:
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, max(0, int(round(p * len(ordered))) - 1))], 1)
+
+
+# ==================== INVARIANTES ====================
+
+def check_invariants(app_db, raffle_id, expected, brevo_stub):
+    purchases = app_db.run_query(
+        "SELECT invoice_id, email, numbers, status FROM purchases WHERE raffle_id = %s",
+        params=(raffle_id,), fetchall=True
+    ) or []
+    confirmed = {row[0]: row for row in purchases if row[3] == 'confirmed'}
+
+    # Sin números duplicados: entre compras y contra assigned_numbers
+    owners = Counter()
+    wrong_count = []
+    for invoice_id, _, numbers, _ in confirmed.values():
+        numbers = [int(n) for n in numbers.split(',')] if numbers else []
+        owners.update(numbers)
+        if invoice_id in expected and len(numbers) != expected[invoice_id]['tickets']:
+            wrong_count.append(invoice_id)
+    duplicated = sorted(number for number, count in owners.items() if count > 1)
+    assigned = app_db.run_query(
+        "SELECT COUNT(*) FROM assigned_numbers WHERE raffle_id = %s AND is_confirmed = %s",
+        params=(raffle_id, True), fetchone=True
+    )[0]
+
+    # Sin compras perdidas (ni compras de pagos rechazados)
+    lost = sorted(set(expected) - set(confirmed))
+    unexpected = sorted(set(confirmed) - set(expected))
+
+    # Un email por compra: en la bandeja y en lo que recibió el stub de Brevo
+    outbox = Counter(dict(app_db.run_query("""
+        SELECT ref, COUNT(*) FROM email_outbox
+        WHERE kind = 'purchase_confirmation' AND status = 'sent' GROUP BY ref
+    """, fetchall=True) or []))
+    wanted = Counter(row[1] for row in confirmed.values())
+    received = Counter({email: brevo_stub.recipients[email] for email in wanted})
+    email_mismatch = sorted(
+        [ref for ref in confirmed if outbox[ref] != 1] +
+        [email for email in wanted if received[email] != wanted[email]]
+    )
+
+    return {
+        'purchases': len(confirmed),
+        'expected_purchases': len(expected),
+        'no_duplicate_numbers': {
+            'ok': not duplicated and assigned == sum(owners.values()) and not wrong_count,
+            'duplicated': duplicated[:20], 'wrong_count': wrong_count[:20],
+            'assigned_rows': assigned, 'purchase_numbers': sum(owners.values()),
+        },
+        'no_lost_purchases': {'ok': not lost and not unexpected, 'lost': lost[:20], 'unexpected': unexpected[:20]},
+        'one_email_per_purchase': {'ok': not email_mismatch, 'mismatched': email_mismatch[:20]},
+    }
+
+
+# ==================== MAIN ====================
+
+def configure_environment(args, tmpdir, mp_stub, brevo_stub):
+    """Variables que la app lee al importarse: stubs, base temporal y esperas cortas"""
+    if args.backend == 'sqlite':
+        os.environ['SQLITE_PATH'] = os.path.join(tmpdir, 'rifa.db')
+    os.environ.update({
+        'DB_BACKEND': args.backend,
+        'NUMBER_BITMAP_DIR': tmpdir,
+        'ENVIRONMENT': 'development',
+        'MERCADOPAGO_ACCESS_TOKEN': 'TEST-harness',
+        'MERCADOPAGO_API_URL': mp_stub.url,
+        # Los webhooks capturados traen firmas de producción: en replay no se verifican
+        'MERCADOPAGO_WEBHOOK_SECRET': WEBHOOK_SECRET if args.mode == 'synth' else '',
+        'BREVO_API_KEY': 'harness',
+        'BREVO_API_URL': brevo_stub.url + '/v3',
+        'EMAIL_SEND_RATE': '100000',
+        'EMAIL_SEND_BURST': '1000',
+        'EMAIL_POLL_INTERVAL': '0.05',
+        'JOB_POLL_INTERVAL': '0.05',
+        'JOB_BACKOFF_BASE': '0.2',
+        'JOB_BACKOFF_MAX': '2',
+        'WEBHOOK_JOB_CONCURRENCY': str(args.workers),
+        'MP_RECONCILE_INTERVAL': '86400',
+    })
+    os.environ.pop('WEBHOOK_CAPTURE_PATH', None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = parser.add_subparsers(dest='mode', required=True)
+    synth = sub.add_parser('synth', help='sintetizar notificaciones')
+    synth.add_argument('--payments', type=int, default=1000)
+    synth.add_argument('--gateway', choices=('mercadopago', 'epayco', 'both'), default='both')
+    synth.add_argument('--duplicates', type=float, default=0.2, help='fracción de notificaciones reenviadas')
+    synth.add_argument('--rejected', type=float, default=0.05, help='fracción de pagos rechazados')
+    synth.add_argument('--seed', type=int, default=None)
+    replay = sub.add_parser('replay', help='reproducir un log de captura')
+    replay.add_argument('log')
+    for p in (synth, replay):
+        p.add_argument('--concurrency', type=int, default=32)
+        p.add_argument('--workers', type=int, default=2, help='hilos de trabajos por tipo de webhook')
+        p.add_argument('--stub-latency', type=float, default=20, help='ms de latencia de cada stub')
+        p.add_argument('--drain-timeout', type=float, default=300)
+        p.add_argument('--backend', choices=('sqlite', 'postgres'), default='sqlite')
+        p.add_argument('--json', help='guardar el reporte en este archivo')
+        p.add_argument('--keep-db', action='store_true', help='no borrar la base SQLite temporal al terminar')
+        p.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='rifa_harness_')
+    mp_stub = StubServer(MercadoPagoStub, args.stub_latency / 1000).start()
+    mp_stub.payments, mp_stub.raffle_id = {}, None
+    brevo_stub = StubServer(BrevoStub, args.stub_latency / 1000).start()
+    brevo_stub.recipients = Counter()
+    configure_environment(args, tmpdir, mp_stub, brevo_stub)
+
+    # Antes de importar la app, así su basicConfig no sube el nivel a INFO
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    if not args.verbose:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    import server
+    from app import db as app_db
+    from werkzeug.serving import make_server
+
+    server.start_background_workers()
+
+    # Rifa propia con pool suficiente para todas las compras
+    if args.mode == 'synth':
+        pool_size = args.payments * MAX_TICKETS + 100
+    else:
+        from app.capture import read_records
+        pool_size = sum(1 for _ in read_records(args.log)) * 200 + 100
+    raffle_id = app_db.create_raffle(f'Harness {time.strftime("%Y-%m-%d %H:%M:%S")}', pool_size, NUMBER_PRICE)
+    mp_stub.raffle_id = raffle_id
+    sends, expected = synth_plan(args, raffle_id, mp_stub) if args.mode == 'synth' else replay_plan(args, raffle_id)
+
+    app_server = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=app_server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{app_server.server_port}'
+
+    print(f"🚀 {len(sends)} notificaciones ({len(expected)} compras esperadas), "
+          f"concurrencia {args.concurrency}, rifa {raffle_id}")
+    started = time.perf_counter()
+    results = fire(base_url, sends, args.concurrency)
+    sent = time.perf_counter()
+    drained = wait_for_drain(app_db, args.drain_timeout)
+    finished = time.perf_counter()
+
+    latency = {}
+    for path in sorted({r[0] for r in results}):
+        samples = [r[2] for r in results if r[0] == path]
+        latency[path] = {
+            'requests': len(samples),
+            'p50_ms': percentile(samples, 0.50), 'p95_ms': percentile(samples, 0.95), 'p99_ms': percentile(samples, 0.99),
+            'statuses': dict(Counter(str(r[1]) for r in results if r[0] == path)),
+        }
+    invariants = check_invariants(app_db, raffle_id, expected, brevo_stub)
+    dead = app_db.run_query("SELECT COUNT(*) FROM jobs WHERE status = 'dead'", fetchone=True)[0]
+    report = {
+        'mode': args.mode,
+        'backend': app_db.get_backend(),
+        'raffle_id': raffle_id,
+        'notifications': len(sends),
+        'drained': drained,
+        'dead_jobs': dead,
+        'latency': latency,
+        'throughput': {
+            'requests_per_s': round(len(sends) / (sent - started), 1),
+            'purchases_per_s': round(invariants['purchases'] / (finished - started), 1),
+            'send_seconds': round(sent - started, 2),
+            'total_seconds': round(finished - started, 2),
+        },
+        'gateways': {
+            'mercadopago_payment_gets': sum(mp_stub.calls.values()),
+            'brevo_requests': brevo_stub.calls['requests'],
+            'brevo_messages': sum(brevo_stub.recipients.values()),
+        },
+        'invariants': invariants,
+    }
+    ok = drained and all(
+        invariants[name]['ok'] for name in ('no_duplicate_numbers', 'no_lost_purchases', 'one_email_per_purchase')
+    )
+
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print("✅ Invariantes OK" if ok else "❌ Invariantes fallidas")
+    app_server.shutdown()
+    if args.keep_db:
+        print(f"📁 Base y bitmaps en {tmpdir}")
+    else:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
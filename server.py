@@ -1,20 +1,21 @@
 import os
-import random
+import base64
 import logging
+import time
+import threading
 import hashlib
 import hmac
 import uuid
 import json
 from datetime import datetime, timedelta
 import psycopg
+import requests
 from psycopg.rows import dict_row
-from flask import Flask, request, jsonify, render_template, redirect, url_for, send_from_directory, abort, session
+from flask import Flask, Response, request, jsonify, render_template, stream_template, redirect, url_for, send_from_directory, abort, session
 from dotenv import load_dotenv
 from functools import wraps
 import secrets
 from flask_talisman import Talisman
-import sib_api_v3_sdk
-from sib_api_v3_sdk.rest import ApiException
 import mercadopago
 
 # ==================== CONFIGURACIÓN INICIAL ====================
@@ -118,16 +119,41 @@ ADMIN_SIM_KEY = os.getenv('ADMIN_SIM_KEY', secrets.token_urlsafe(32))
 
 # ==================== CONFIGURACIÓN DE BASE DE DATOS ====================
 from app import db as app_db
+from app import idempotency, jobs, mailer, reconcile, search
+from app.breaker import CircuitOpenError
+from app.cache import TTLCache
+from app.capture import CAPTURED_PATHS, CaptureLog, request_record
+from app.events import EventHub
+from app.outbound import OutboundClient, MercadoPagoHttpClient
+from app.versions import SharedVersions
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-try:
-    app_db.init_db()
-except Exception as e:
-    logger.error(f"Error initializing database: {e}")
-    import traceback
-    traceback.print_exc()
+_db_initialized = False
+_db_init_lock = threading.Lock()
+
+
+@app.before_request
+def init_database():
+    """
+    Crea el esquema una vez por proceso: al arrancar el worker (ver
+    start_background_workers) o con la primera petición. Importar server
+    no toca la base de datos.
+    """
+    global _db_initialized
+    if _db_initialized:
+        return
+    with _db_init_lock:
+        if _db_initialized:
+            return
+        _db_initialized = True
+        try:
+            app_db.init_db()
+        except Exception as e:
+            logger.error(f"Error initializing database: {e}")
+            import traceback
+            traceback.print_exc()
 
 # ==================== CONFIGURACIÓN DE PAGOS ====================
 EPAYCO_PUBLIC_KEY = os.getenv('EPAYCO_PUBLIC_KEY', '70b19a05a3f3374085061d1bfd386a8b')
@@ -136,16 +162,59 @@ EPAYCO_PRIVATE_KEY = os.getenv('EPAYCO_PRIVATE_KEY', 'your_private_key_here')
 # MercadoPago
 MERCADOPAGO_ACCESS_TOKEN = os.getenv('MERCADOPAGO_ACCESS_TOKEN', '')
 MERCADOPAGO_PUBLIC_KEY = os.getenv('MERCADOPAGO_PUBLIC_KEY', '')
+# Secreto de firma de webhooks (panel de MercadoPago > Webhooks)
+MERCADOPAGO_WEBHOOK_SECRET = os.getenv('MERCADOPAGO_WEBHOOK_SECRET', '')
 
 # Control de pasarelas activas
 ACTIVE_GATEWAY = os.getenv('ACTIVE_GATEWAY', 'epayco')  # 'epayco', 'mercadopago', 'both'
 PREFERRED_GATEWAY = os.getenv('PREFERRED_GATEWAY', 'epayco')  # Para modo 'both'
 
+# Máximo de números que un cliente puede elegir en una sola reserva
+MAX_CHOSEN_NUMBERS = int(os.getenv('MAX_CHOSEN_NUMBERS', '100'))
+# Prefijo de las reservas de números elegidos (se usa también como invoice_id)
+CHOSEN_PREFIX = 'rifa_ch_'
+# Proxies delante de la app (Railway, nginx) que agregan la IP del cliente a X-Forwarded-For
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '1'))
+
+# /progress se sirve desde caché; las compras y eliminaciones la invalidan
+PROGRESS_CACHE_TTL = float(os.getenv('PROGRESS_CACHE_TTL', '5'))
+progress_cache = TTLCache('progress', PROGRESS_CACHE_TTL)
+# Snapshot de /api/bootstrap (y de la versión embebida en la portada)
+bootstrap_cache = TTLCache('bootstrap', PROGRESS_CACHE_TTL)
+INLINE_BOOTSTRAP = os.getenv('INLINE_BOOTSTRAP', 'true').lower() in ('1', 'true', 'yes')
+
+# Versiones compartidas entre workers para los ETag de los endpoints que
+# consultan los navegadores: un 304 se decide sin tocar la base de datos
+shared_versions = SharedVersions(
+    os.path.join(app_db.BITMAP_DIR, 'rifa_versions.bin'), ('progress', 'blessed')
+)
+BLESSED_CACHE_TTL = float(os.getenv('BLESSED_CACHE_TTL', '60'))
+blessed_cache = TTLCache('blessed', BLESSED_CACHE_TTL)
+# Métricas del panel por (rifa, desde, hasta); versionadas con 'progress'
+METRICS_CACHE_TTL = float(os.getenv('METRICS_CACHE_TTL', '60'))
+metrics_cache = TTLCache('metrics', METRICS_CACHE_TTL)
+
+# Eventos en vivo (/events): cada cuánto se revisa el bitmap compartido y
+# cada cuánto se refrescan las rifas y los números benditos
+EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', '0.5'))
+EVENTS_REFRESH_INTERVAL = float(os.getenv('EVENTS_REFRESH_INTERVAL', '5'))
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', '15'))
+event_hub = EventHub(heartbeat=EVENTS_HEARTBEAT)
+_events_watcher = None
+_events_watcher_lock = threading.Lock()
+
+# Clientes HTTP salientes: pool, timeouts, reintentos y circuito por dependencia
+MERCADOPAGO_API_URL = os.getenv('MERCADOPAGO_API_URL', 'https://api.mercadopago.com')
+mercadopago_http = OutboundClient('mercadopago', base_url=MERCADOPAGO_API_URL)
+
 # Inicializar MercadoPago SDK solo si está configurado
 mp_sdk = None
 if MERCADOPAGO_ACCESS_TOKEN:
     try:
-        mp_sdk = mercadopago.SDK(MERCADOPAGO_ACCESS_TOKEN)
+        mp_sdk = mercadopago.SDK(
+            MERCADOPAGO_ACCESS_TOKEN,
+            http_client=MercadoPagoHttpClient(mercadopago_http)
+        )
         logger.info("✅ MercadoPago SDK inicializado")
     except Exception as e:
         logger.error(f"❌ Error inicializando MercadoPago: {e}")
@@ -160,10 +229,12 @@ if not BREVO_API_KEY:
 else:
     logger.info(f"✅ Brevo configurado: {BREVO_SENDER_EMAIL}")
 
-# Configurar cliente de Brevo
-configuration = sib_api_v3_sdk.Configuration()
-configuration.api_key['api-key'] = BREVO_API_KEY
-brevo_api = sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(configuration))
+# Configurar cliente de Brevo (API REST v3 sobre el cliente HTTP compartido)
+BREVO_API_URL = os.getenv('BREVO_API_URL', 'https://api.brevo.com/v3')
+brevo_http = OutboundClient(
+    'brevo', base_url=BREVO_API_URL,
+    headers={'api-key': BREVO_API_KEY or '', 'accept': 'application/json'}
+)
 
 # ==================== URLs ====================
 BASE_URL = os.getenv('BASE_URL', 'http://localhost:8080' if not IS_PRODUCTION else 'https://laparladelosniches.com')
@@ -301,43 +372,64 @@ def admin_api_key_required(f):
 def generate_reset_token():
     return secrets.token_urlsafe(32)
 
-def send_email_brevo(to_email, to_name, subject, html_content, text_content=None):
+def send_brevo_batch(emails):
     """
-    Envía email usando Brevo API de forma síncrona
+    Transporte de la bandeja de salida: entrega un lote de emails en una sola
+    llamada a Brevo (`messageVersions`, una versión por destinatario) y
+    retorna los message ids en el mismo orden.
     """
+    if not BREVO_API_KEY:
+        raise mailer.TransientEmailError("BREVO_API_KEY no configurado")
+    
+    def version(email):
+        return {
+            "to": [{"email": email['to_email'], "name": email['to_name'] or "Cliente"}],
+            "subject": email['subject'],
+            "htmlContent": email['html_content'],
+            "textContent": email['text_content'] or "Este es un email de Rifa 5 Millones"
+        }
+    
+    # Crear mensaje: el primero va como contenido base, cada email como versión
+    payload = {"sender": {"email": BREVO_SENDER_EMAIL, "name": BREVO_SENDER_NAME}, **version(emails[0])}
+    if len(emails) > 1:
+        del payload["to"]
+        payload["messageVersions"] = [version(email) for email in emails]
+    
+    # Enviar
     try:
-        logger.info(f"📧 Enviando email a {to_email} vía Brevo...")
-        
-        if not BREVO_API_KEY:
-            logger.error("❌ BREVO_API_KEY no configurado")
-            return False
-        
-        # Crear mensaje
-        send_smtp_email = sib_api_v3_sdk.SendSmtpEmail(
-            to=[{"email": to_email, "name": to_name}],
-            sender={"email": BREVO_SENDER_EMAIL, "name": BREVO_SENDER_NAME},
-            subject=subject,
-            html_content=html_content,
-            text_content=text_content or "Este es un email de Rifa 5 Millones"
-        )
-        
-        # Enviar
-        api_response = brevo_api.send_transac_email(send_smtp_email)
-        
-        logger.info(f"✅ Email enviado exitosamente a {to_email} - Message ID: {api_response.message_id}")
+        response = brevo_http.request('POST', '/smtp/email', json=payload, endpoint='POST /smtp/email')
+    except (requests.RequestException, CircuitOpenError) as e:
+        raise mailer.TransientEmailError(f"Brevo no disponible: {e}")
+    
+    if response.status_code == 429 or response.status_code >= 500:
+        raise mailer.TransientEmailError(f"Brevo {response.status_code}: {response.text[:300]}")
+    if response.status_code >= 400:
+        raise mailer.PermanentEmailError(f"Brevo {response.status_code}: {response.text[:300]}")
+    
+    result = response.json()
+    return result.get("messageIds") or [result.get("messageId")]
+
+def queue_email(to_email, to_name, subject, html_content, text_content=None, kind='generic', ref=None, dedupe=False,
+                tx=None):
+    """
+    Encola el email en la bandeja de salida; el envío real lo hace el hilo de
+    fondo en lotes. Retorna True si quedó encolado (o ya lo estaba).
+    Dentro de `tx` el email se confirma con ella y un error se propaga, para
+    que la transacción no se confirme sin su email.
+    """
+    try:
+        logger.info(f"📧 Encolando email a {to_email} ({kind})...")
+        mailer.enqueue_email(to_email, subject, html_content, text_content, to_name,
+                             kind=kind, ref=ref, tx=tx, dedupe=dedupe)
         return True
-        
-    except ApiException as e:
-        logger.error(f"❌ Error Brevo API: {e}")
-        return False
     except Exception as e:
-        logger.error(f"❌ Error inesperado enviando email: {e}")
-        import traceback
-        traceback.print_exc()
+        if tx is not None:
+            raise
+        logger.error(f"❌ Error encolando email a {to_email}: {e}")
         return False
 
 def send_password_reset_email(email, token, admin_id):
-    """Envía email de recuperación usando Brevo"""
+    """Encola el email de recuperación (se envía vía Brevo en segundo plano)"""
     try:
         logger.info(f"📧 Preparando email de recuperación para {email}...")
         
@@ -404,18 +496,20 @@ def send_password_reset_email(email, token, admin_id):
         Rifa 5 Millones - Panel Administrativo
         """
         
-        success = send_email_brevo(
+        success = queue_email(
             to_email=email,
             to_name="Administrador",
             subject="🔐 Recuperación de Contraseña - Rifa 5 Millones",
             html_content=html_content,
-            text_content=text_content
+            text_content=text_content,
+            kind='password_reset',
+            ref=str(admin_id)
         )
         
         if success:
-            logger.info(f"✅ Email de recuperación enviado a {email}")
+            logger.info(f"✅ Email de recuperación encolado para {email}")
         else:
-            logger.error(f"❌ Falló el envío de email de recuperación a {email}")
+            logger.error(f"❌ No se pudo encolar el email de recuperación a {email}")
         
         return success
         
@@ -425,8 +519,12 @@ def send_password_reset_email(email, token, admin_id):
         traceback.print_exc()
         return False
 
-def send_purchase_confirmation_email(customer_email, customer_name, numbers, amount, invoice_id):
-    """Envía email de confirmación usando Brevo"""
+def send_purchase_confirmation_email(customer_email, customer_name, numbers, amount, invoice_id, dedupe=False,
+                                     tx=None):
+    """
+    Encola el email de confirmación de compra (se envía vía Brevo en segundo
+    plano). Con `tx` (la de la compra) el email se confirma junto con ella.
+    """
     try:
         logger.info(f"📧 Preparando email de confirmación para {customer_email}...")
         
@@ -532,61 +630,93 @@ def send_purchase_confirmation_email(customer_email, customer_name, numbers, amo
         Rifa 5 Millones
         """
         
-        success = send_email_brevo(
+        success = queue_email(
             to_email=customer_email,
             to_name=customer_name or "Cliente",
             subject="✅ ¡Confirmación de Compra - Rifa 5 Millones! 🎉",
             html_content=html_content,
-            text_content=text_content
+            text_content=text_content,
+            kind='purchase_confirmation',
+            ref=invoice_id,
+            dedupe=dedupe,
+            tx=tx
         )
         
         if success:
-            logger.info(f"✅ Email de confirmación enviado a {customer_email}")
+            logger.info(f"✅ Email de confirmación encolado para {customer_email}")
         else:
-            logger.error(f"❌ Falló el envío de email de confirmación a {customer_email}")
+            logger.error(f"❌ No se pudo encolar el email de confirmación a {customer_email}")
         
         return success
         
     except Exception as e:
+        if tx is not None:
+            raise
         logger.error(f"❌ Error preparando email para {customer_email}: {str(e)}")
         import traceback
         traceback.print_exc()
         return False
     
 # ==================== ENDPOINT: Obtener configuración de pasarelas ====================
+def conditional_json(etag, build):
+    """
+    Responde 304 si el cliente ya tiene `etag` (If-None-Match) sin llamar a
+    `build`; si no, el JSON de `build()` con su ETag
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    # El navegador puede guardar la respuesta pero debe revalidarla siempre
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
 @app.route('/api/payment_gateways')
 def get_payment_gateways():
     """Retorna configuración de pasarelas disponibles"""
     try:
-        gateways = {
-            'active_gateway': ACTIVE_GATEWAY,
-            'preferred_gateway': PREFERRED_GATEWAY,
-            'available': []
-        }
-        
-        # Verificar ePayco
-        if EPAYCO_PUBLIC_KEY and ACTIVE_GATEWAY in ['epayco', 'both']:
-            gateways['available'].append({
-                'id': 'epayco',
-                'name': 'ePayco',
-                'public_key': EPAYCO_PUBLIC_KEY,
-                'enabled': True
-            })
-        
-        # Verificar MercadoPago
-        if MERCADOPAGO_PUBLIC_KEY and mp_sdk and ACTIVE_GATEWAY in ['mercadopago', 'both']:
-            gateways['available'].append({
-                'id': 'mercadopago',
-                'name': 'MercadoPago',
-                'public_key': MERCADOPAGO_PUBLIC_KEY,
-                'enabled': True
-            })
-        
-        return jsonify(gateways)
+        gateways = build_payment_gateways()
+        return conditional_json(payment_gateways_etag(gateways), lambda: gateways)
         
     except Exception as e:
         logger.error(f"Error en payment_gateways: {e}")
         return jsonify({'error': str(e)}), 500
+
+
+def payment_gateways_etag(gateways):
+    """Solo depende de la configuración del proceso: el ETag es su hash"""
+    return hashlib.md5(json.dumps(gateways, sort_keys=True).encode()).hexdigest()
+
+
+def build_payment_gateways():
+    """Pasarelas habilitadas según las variables de entorno"""
+    gateways = {
+        'active_gateway': ACTIVE_GATEWAY,
+        'preferred_gateway': PREFERRED_GATEWAY,
+        'available': []
+    }
+    
+    # Verificar ePayco
+    if EPAYCO_PUBLIC_KEY and ACTIVE_GATEWAY in ['epayco', 'both']:
+        gateways['available'].append({
+            'id': 'epayco',
+            'name': 'ePayco',
+            'public_key': EPAYCO_PUBLIC_KEY,
+            'enabled': True
+        })
+    
+    # Verificar MercadoPago
+    if MERCADOPAGO_PUBLIC_KEY and mp_sdk and ACTIVE_GATEWAY in ['mercadopago', 'both']:
+        gateways['available'].append({
+            'id': 'mercadopago',
+            'name': 'MercadoPago',
+            'public_key': MERCADOPAGO_PUBLIC_KEY,
+            'enabled': True
+        })
+    
+    return gateways
     
 # ==================== MERCADOPAGO: Crear preferencia CORREGIDO ====================
 @app.route('/api/mercadopago/create_preference', methods=['POST'])
@@ -611,6 +741,7 @@ def mp_create_preference():
         phone = data.get('phone', '').strip()
         document_type = data.get('document_type', 'CC').strip()
         document_number = data.get('document_number', '').strip()
+        raffle_id = get_request_raffle_id(data.get('raffle_id'))
         description = data.get('description', f'Rifa 5 Millones - {quantity} números')
         
         # Validaciones
@@ -634,8 +765,42 @@ def mp_create_preference():
             logger.error("❌ Monto inválido")
             return jsonify({'status': 'error', 'message': 'Monto inválido'}), 400
         
-        # Crear ID único
-        invoice_id = f"rifa_mp_{uuid.uuid4().hex[:12]}"
+        if raffle_id is None:
+            logger.error("❌ Rifa inválida")
+            return jsonify({'status': 'error', 'message': 'Rifa inválida'}), 400
+        
+        # La cantidad la decide el monto, no el cliente: el webhook confirma
+        # tantos números como cubra el pago aprobado
+        quantity = tickets_for_amount(amount, raffle_id)
+        
+        reservation_id = data.get('reservation_id')
+        if reservation_id:
+            # ✅ Números elegidos por el cliente: ya están apartados en /api/numbers/claim
+            reservation = app_db.get_reservation(reservation_id)
+            if not reservation:
+                logger.error(f"❌ Reserva vencida o inexistente: {reservation_id}")
+                return jsonify({'status': 'error', 'message': 'Tu reserva de números venció, elígelos de nuevo'}), 409
+            invoice_id = reservation_id
+            raffle_id = reservation['raffle_id']
+            reserved_numbers = reservation['numbers']
+            quantity = len(reserved_numbers)
+            # El precio de los números elegidos se calcula aquí, no en el navegador
+            amount = chosen_numbers_price(quantity, raffle_id)
+            reserved_until = datetime.fromisoformat(reservation['reserved_until'])
+        else:
+            # Crear ID único
+            invoice_id = f"rifa_mp_{uuid.uuid4().hex[:12]}"
+            
+            # ✅ Apartar los números mientras el cliente paga
+            try:
+                reserved_numbers, reserved_until = app_db.reserve_numbers(quantity, invoice_id, raffle_id,
+                                                                          held_by=client_key())
+            except app_db.NumbersUnavailable:
+                logger.error(f"❌ No hay {quantity} números disponibles")
+                return jsonify({'status': 'error', 'message': 'No hay suficientes números disponibles'}), 409
+            except app_db.TooManyHolds as e:
+                logger.warning(f"🚫 {e}")
+                return jsonify({'status': 'error', 'message': 'Ya tienes números apartados; termina ese pago o espera a que venza'}), 429
         
         logger.info(f"✅ Validaciones OK - Creando preferencia para {email}")
         
@@ -697,12 +862,16 @@ def mp_create_preference():
                 "excluded_payment_types": [],
                 "installments": 1
             },
+            # No aceptar pagos después de vencida la reserva
+            "expires": True,
+            "expiration_date_to": reserved_until.astimezone().isoformat(timespec='milliseconds'),
             "metadata": {
                 "customer_name": name,
                 "customer_email": email,
                 "customer_phone": phone,
                 "quantity": quantity,
-                "invoice_id": invoice_id
+                "invoice_id": invoice_id,
+                "raffle_id": raffle_id
             }
         }
         
@@ -718,6 +887,7 @@ def mp_create_preference():
             
             if "response" not in preference_response:
                 logger.error(f"❌ Respuesta inesperada: {preference_response}")
+                app_db.cancel_reservation(invoice_id)
                 return jsonify({
                     "status": "error", 
                     "message": "Error en la respuesta de MercadoPago"
@@ -727,6 +897,7 @@ def mp_create_preference():
             
             if "id" not in preference:
                 logger.error(f"❌ Preferencia sin ID: {preference}")
+                app_db.cancel_reservation(invoice_id)
                 return jsonify({
                     "status": "error", 
                     "message": f"Error de MercadoPago: {preference.get('message', 'Unknown error')}"
@@ -734,8 +905,8 @@ def mp_create_preference():
             
             logger.info(f"✅ MercadoPago preferencia creada: {preference['id']}")
             
-            # ✅ NO GUARDAR NADA EN BASE DE DATOS AQUÍ
-            # El webhook se encargará cuando el pago sea aprobado
+            # ✅ Solo queda la reserva; el webhook la confirma cuando el pago
+            # sea aprobado y el barrido la libera si vence antes
             
             return jsonify({
                 "status": "success",
@@ -743,11 +914,22 @@ def mp_create_preference():
                 "preference_id": preference["id"],
                 "init_point": preference.get("init_point"),
                 "sandbox_init_point": preference.get("sandbox_init_point"),
-                "invoice_id": invoice_id
+                "invoice_id": invoice_id,
+                "numbers": reserved_numbers,
+                "reserved_until": reserved_until.isoformat()
             })
             
+        except CircuitOpenError as mp_error:
+            logger.error(f"❌ MercadoPago no disponible: {mp_error}")
+            app_db.cancel_reservation(invoice_id)
+            return jsonify({
+                "status": "error",
+                "message": "MercadoPago no está disponible en este momento, intenta de nuevo en unos minutos"
+            }), 503
+            
         except Exception as mp_error:
             logger.error(f"❌ Error en SDK de MercadoPago: {mp_error}")
+            app_db.cancel_reservation(invoice_id)
             import traceback
             traceback.print_exc()
             return jsonify({
@@ -765,94 +947,270 @@ def mp_create_preference():
         }), 500
 
 
-# ==================== MERCADOPAGO: Webhook MEJORADO ====================
+# ==================== RESERVAS DE CHECKOUT ====================
+@app.route('/api/reservations', methods=['POST'])
+def create_reservation():
+    """
+    Aparta números para un checkout del lado del cliente (ePayco). El
+    invoice_id retornado se usa como `invoice` del checkout; /confirmation
+    convierte la reserva en compra con x_id_invoice.
+    """
+    data = request.get_json(silent=True) or request.form
+    raffle_id = get_request_raffle_id(data.get('raffle_id'))
+    if raffle_id is None:
+        return jsonify({'status': 'error', 'message': 'Rifa inválida'}), 400
+
+    # La cantidad sale del monto del paquete: /confirmation confirma solo
+    # los números que cubre el pago
+    try:
+        amount = float(data.get('amount') or 0)
+    except (TypeError, ValueError):
+        amount = 0
+    if amount <= 0:
+        return jsonify({'status': 'error', 'message': 'Monto inválido'}), 400
+    quantity = tickets_for_amount(amount, raffle_id)
+
+    invoice_id = f"rifa_ep_{uuid.uuid4().hex[:12]}"
+    try:
+        numbers, reserved_until = app_db.reserve_numbers(quantity, invoice_id, raffle_id, held_by=client_key())
+    except app_db.NumbersUnavailable:
+        return jsonify({'status': 'error', 'message': 'No hay suficientes números disponibles'}), 409
+    except app_db.TooManyHolds as e:
+        logger.warning(f"🚫 {e}")
+        return jsonify({'status': 'error', 'message': 'Ya tienes números apartados; termina ese pago o espera a que venza'}), 429
+    except Exception as e:
+        logger.error(f"❌ Error creando reserva: {e}")
+        return jsonify({'status': 'error', 'message': 'Error del servidor'}), 500
+
+    return jsonify({
+        'status': 'success',
+        'invoice_id': invoice_id,
+        'raffle_id': raffle_id,
+        'numbers': numbers,
+        'reserved_until': reserved_until.isoformat()
+    }), 201
+
+
+@app.route('/api/numbers/claim', methods=['POST'])
+def claim_chosen_numbers():
+    """
+    Aparta los números que eligió el cliente. Responde 409 con la lista
+    `taken` si alguno ya no está disponible. El invoice_id retornado se
+    envía como reservation_id al crear el pago.
+    """
+    data = request.get_json(silent=True) or {}
+    raffle_id = get_request_raffle_id(data.get('raffle_id'))
+    if raffle_id is None:
+        return jsonify({'status': 'error', 'message': 'Rifa inválida'}), 400
+
+    try:
+        numbers = sorted({int(n) for n in data.get('numbers') or []})
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Números inválidos'}), 400
+
+    pool_size = app_db.get_pool_size(raffle_id)
+    if not numbers or len(numbers) > MAX_CHOSEN_NUMBERS:
+        return jsonify({'status': 'error', 'message': f'Elige entre 1 y {MAX_CHOSEN_NUMBERS} números'}), 400
+    if numbers[0] < 1 or numbers[-1] > pool_size:
+        return jsonify({'status': 'error', 'message': f'Los números deben estar entre 1 y {pool_size}'}), 400
+
+    invoice_id = f"{CHOSEN_PREFIX}{uuid.uuid4().hex[:12]}"
+    try:
+        numbers, reserved_until = app_db.reserve_numbers(len(numbers), invoice_id, raffle_id, numbers=numbers,
+                                                         held_by=client_key())
+    except app_db.NumbersTaken as e:
+        return jsonify({'status': 'error', 'message': 'Algunos números ya no están disponibles', 'taken': e.numbers}), 409
+    except app_db.TooManyHolds as e:
+        logger.warning(f"🚫 {e}")
+        return jsonify({'status': 'error', 'message': 'Ya tienes números apartados; termina ese pago o espera a que venza'}), 429
+    except Exception as e:
+        logger.error(f"❌ Error apartando números elegidos: {e}")
+        return jsonify({'status': 'error', 'message': 'Error del servidor'}), 500
+
+    return jsonify({
+        'status': 'success',
+        'invoice_id': invoice_id,
+        'raffle_id': raffle_id,
+        'numbers': numbers,
+        'reserved_until': reserved_until.isoformat()
+    }), 201
+
+
+@app.route('/api/numbers/availability')
+def numbers_availability():
+    """
+    Disponibilidad de la rifa como bitmap en base64: el número n está tomado
+    si el bit (n % 8) del byte n // 8 vale 1. 2000 números caben en 251 bytes.
+    """
+    raffle_id = get_request_raffle_id(request.args.get('raffle_id'))
+    if raffle_id is None:
+        return jsonify({'status': 'error', 'message': 'Rifa inválida'}), 404
+
+    raffle = app_db.get_raffle(raffle_id)
+    bitmap = app_db.get_number_bitmap(raffle_id)
+    return jsonify({
+        'raffle_id': raffle_id,
+        'total': raffle['pool_size'],
+        'taken': bitmap.count(),
+        'number_price': raffle['number_price'],
+        'generation': bitmap.generation,
+        'encoding': 'bitmap-base64',
+        'bitmap': base64.b64encode(bitmap.to_bytes()).decode('ascii')
+    })
+
+
+# ==================== MERCADOPAGO: Webhook ====================
+# ==================== CAPTURA DE WEBHOOKS ====================
+# Log comprimido de notificaciones para reproducirlas (scripts/webhook_harness.py)
+WEBHOOK_CAPTURE_PATH = os.getenv('WEBHOOK_CAPTURE_PATH', '')
+webhook_capture = CaptureLog(WEBHOOK_CAPTURE_PATH) if WEBHOOK_CAPTURE_PATH else None
+
+@app.before_request
+def capture_webhook():
+    """Guarda la notificación entrante de una pasarela en el log de captura"""
+    if webhook_capture and request.method == 'POST' and request.path in CAPTURED_PATHS:
+        try:
+            webhook_capture.append(request_record(request))
+        except Exception as e:
+            logger.error(f"❌ Error capturando webhook {request.path}: {e}")
+
 @app.route('/webhooks/mercadopago', methods=['POST'])
 def mercadopago_webhook():
-    """Procesa notificaciones de MercadoPago - CON PROTECCIÓN DUPLICADOS"""
+    """
+    Recibe notificaciones de MercadoPago: verifica la firma, encola el pago
+    y responde de inmediato. Consultar el pago, asignar números y enviar el
+    email lo hace un worker de fondo (process_mercadopago_payment).
+    """
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True) or {}
         logger.info(f"📥 MercadoPago webhook: {data}")
         
         # Verificar tipo de notificación
-        if data.get("type") == "payment":
-            payment_id = data["data"]["id"]
-            
-            logger.info(f"💳 Obteniendo información del pago: {payment_id}")
-            
-            # Obtener información del pago
-            payment_info = mp_sdk.payment().get(payment_id)
-            payment = payment_info["response"]
-            
-            logger.info(f"📊 Estado del pago: {payment['status']}")
-            
-            # ✅ SOLO PROCESAR SI ESTÁ APROBADO
-            if payment["status"] != "approved":
-                logger.info(f"⏳ Pago no aprobado aún: {payment['status']}")
-                return jsonify({'status': 'ok', 'message': 'Not approved yet'}), 200
-            
-            external_reference = payment.get("external_reference")
-            amount = payment["transaction_amount"]
-            
-            # Información del pagador
-            payer = payment.get("payer", {})
-            payer_email = payer.get("email", "")
-            first_name = payer.get("first_name", "")
-            last_name = payer.get("last_name", "")
-            payer_name = f"{first_name} {last_name}".strip()
-            
-            identification = payer.get("identification", {})
-            document_type = identification.get("type", "")
-            document_number = identification.get("number", "")
-            
-            phone_data = payer.get("phone", {})
-            phone = phone_data.get("number", "") if isinstance(phone_data, dict) else ""
-            
-            logger.info(f"✅ Pago aprobado: {external_reference}")
-            
-            # ✅ VERIFICAR DUPLICADOS POR INVOICE_ID Y STATUS
-            existing = app_db.run_query("""
-                SELECT id, status FROM purchases 
-                WHERE invoice_id = %s 
-                ORDER BY created_at DESC 
-                LIMIT 1
-            """, params=(external_reference,), fetchone=True)
-            
-            if existing:
-                existing_id, existing_status = existing[0], existing[1]
-                
-                if existing_status == 'confirmed':
-                    logger.warning(f"⚠️ Pago ya confirmado: {external_reference}")
-                    return jsonify({'status': 'ok', 'message': 'Already confirmed'}), 200
-                
-                # Si existe pero está pending, actualizar
-                logger.info(f"📝 Actualizando compra existente: {external_reference}")
-                
-                # Calcular números
-                num_tickets_map = {
-                    25000: 4, 53000: 8, 81000: 12,
-                    109000: 16, 137000: 20
-                }
-                num_tickets = num_tickets_map.get(int(amount), max(1, int(amount / 6250)))
-                
-                # Obtener números existentes
-                numbers_result = app_db.run_query(
-                    "SELECT numbers FROM purchases WHERE id = %s",
-                    params=(existing_id,),
-                    fetchone=True
-                )
-                
-                if numbers_result and numbers_result[0]:
+        if data.get("type") != "payment":
+            return jsonify({'status': 'ok'}), 200
+        
+        payment_id = str((data.get("data") or {}).get("id") or request.args.get("data.id") or '')
+        if not payment_id:
+            return jsonify({'status': 'error', 'message': 'No payment id'}), 400
+        
+        if not verify_mercadopago_signature(payment_id):
+            logger.warning(f"❌ Firma inválida en webhook de MercadoPago: {payment_id}")
+            return jsonify({'status': 'error', 'message': 'Invalid signature'}), 401
+        
+        if idempotency.is_processed('mercadopago', payment_id):
+            logger.info(f"♻️ Pago {payment_id} ya procesado")
+            return jsonify({'status': 'ok', 'message': 'Already processed'}), 200
+        
+        job_id = jobs.enqueue('mercadopago_payment', {'payment_id': payment_id},
+                              dedupe_key=f"mercadopago:{payment_id}")
+        logger.info(f"📬 Pago {payment_id} encolado (trabajo {job_id})")
+        return jsonify({'status': 'ok', 'queued': job_id is not None}), 200
+        
+    except Exception as e:
+        logger.error(f"❌ Error webhook MercadoPago: {e}")
+        return jsonify({'status': 'error'}), 500
+
+
+def verify_mercadopago_signature(data_id):
+    """
+    Valida el header x-signature (ts=...,v1=...) con MERCADOPAGO_WEBHOOK_SECRET.
+    Sin secreto configurado no se puede verificar y se acepta la notificación.
+    """
+    if not MERCADOPAGO_WEBHOOK_SECRET:
+        return True
+    parts = dict(
+        item.split('=', 1) for item in request.headers.get('x-signature', '').split(',') if '=' in item
+    )
+    ts, v1 = parts.get('ts', '').strip(), parts.get('v1', '').strip()
+    if not ts or not v1:
+        return False
+    data_id = data_id.lower() if data_id.isalnum() else data_id
+    manifest = f"id:{data_id};request-id:{request.headers.get('x-request-id', '')};ts:{ts};"
+    expected = hmac.new(MERCADOPAGO_WEBHOOK_SECRET.encode(), manifest.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(v1, expected)
+
+
+def process_mercadopago_payment(payload):
+    """Trabajo de fondo: confirma un pago aprobado de MercadoPago (idempotente)"""
+    payment_id = payload['payment_id']
+    if not mp_sdk:
+        raise jobs.PermanentJobError("MercadoPago no está configurado")
+    logger.info(f"💳 Obteniendo información del pago: {payment_id}")
+    
+    # Obtener información del pago
+    payment_info = mp_sdk.payment().get(payment_id)
+    if payment_info["status"] >= 500 or not payment_info["response"]:
+        # Falla transitoria de MercadoPago: el trabajo se reintenta con backoff
+        raise RuntimeError(f"MercadoPago respondió {payment_info['status']} al consultar el pago {payment_id}")
+    payment = payment_info["response"]
+    
+    logger.info(f"📊 Estado del pago: {payment['status']}")
+    
+    # ✅ SOLO PROCESAR SI ESTÁ APROBADO
+    if payment["status"] != "approved":
+        logger.info(f"⏳ Pago no aprobado aún: {payment['status']}")
+        return
+    
+    external_reference = payment.get("external_reference")
+    amount = payment["transaction_amount"]
+    raffle_id = get_request_raffle_id((payment.get("metadata") or {}).get("raffle_id"))
+    if raffle_id is None:
+        raise jobs.PermanentJobError(f"Rifa inválida en el pago {payment_id}")
+    
+    # Reclamo atómico del pago: las notificaciones repetidas no lo procesan dos veces
+    with idempotency.processing('mercadopago', payment_id) as claimed:
+        if not claimed:
+            return
+        
+        # Información del pagador
+        payer = payment.get("payer", {})
+        payer_email = payer.get("email", "")
+        first_name = payer.get("first_name", "")
+        last_name = payer.get("last_name", "")
+        payer_name = f"{first_name} {last_name}".strip()
+    
+        identification = payer.get("identification", {})
+        document_type = identification.get("type", "")
+        document_number = identification.get("number", "")
+    
+        phone_data = payer.get("phone", {})
+        phone = phone_data.get("number", "") if isinstance(phone_data, dict) else ""
+    
+        logger.info(f"✅ Pago aprobado: {external_reference}")
+    
+        # ✅ VERIFICAR DUPLICADOS POR INVOICE_ID Y STATUS
+        existing = app_db.run_query("""
+            SELECT id, status, numbers FROM purchases 
+            WHERE invoice_id = %s 
+            ORDER BY created_at DESC 
+            LIMIT 1
+        """, params=(external_reference,), fetchone=True)
+    
+        if existing:
+            existing_id, existing_status, existing_numbers = existing[0], existing[1], existing[2]
+        
+            if existing_status == 'confirmed':
+                logger.warning(f"⚠️ Pago ya confirmado: {external_reference}")
+                return
+        
+            # Si existe pero está pending, actualizar
+            logger.info(f"📝 Actualizando compra existente: {external_reference}")
+        
+            # Calcular números
+            num_tickets = tickets_for_amount(amount, raffle_id)
+        
+            # Asignar, actualizar registro y números en una sola transacción
+            with app_db.transaction() as tx:
+                if existing_numbers:
                     # Ya tiene números asignados, solo actualizar status
-                    numbers = [int(n) for n in numbers_result[0].split(',')]
+                    numbers = [int(n) for n in existing_numbers.split(',')]
                     logger.info(f"♻️ Usando números existentes: {numbers}")
                 else:
                     # Asignar números nuevos
-                    numbers = assign_numbers(num_tickets)
-                    numbers_str = ','.join(map(str, numbers))
+                    numbers = assign_numbers(num_tickets, external_reference, tx, raffle_id)
                     logger.info(f"🎲 Números nuevos asignados: {numbers}")
-                
-                # Actualizar registro
-                app_db.run_query("""
+            
+                tx.execute("""
                     UPDATE purchases 
                     SET status = 'confirmed', 
                         full_name = %s,
@@ -870,72 +1228,49 @@ def mercadopago_webhook():
                     payment.get("status_detail", ""),
                     ','.join(map(str, numbers)),
                     existing_id
-                ), commit=True)
-                
-                # Confirmar números asignados (si no existían)
-                if not numbers_result or not numbers_result[0]:
-                    for number in numbers:
-                        app_db.run_query(
-                            "INSERT INTO assigned_numbers (number, invoice_id, is_confirmed) VALUES (%s, %s, TRUE)", 
-                            params=(number, external_reference), commit=True
-                        )
-                else:
-                    # Solo confirmar
-                    app_db.run_query("""
-                        UPDATE assigned_numbers 
-                        SET is_confirmed = TRUE 
-                        WHERE invoice_id = %s
-                    """, params=(external_reference,), commit=True)
-                
-            else:
-                # ✅ CREAR NUEVO REGISTRO SOLO SI APROBADO
-                logger.info(f"💾 Creando nueva compra: {external_reference}")
-                
-                num_tickets_map = {
-                    25000: 4, 53000: 8, 81000: 12,
-                    109000: 16, 137000: 20
-                }
-                num_tickets = num_tickets_map.get(int(amount), max(1, int(amount / 6250)))
-                
-                numbers = assign_numbers(num_tickets)
-                
-                client_info = {
-                    'full_name': payer_name,
-                    'document_type': document_type,
-                    'document_number': document_number,
-                    'phone': phone,
-                    'transaction_id': str(payment_id),
-                    'payment_method': f"MercadoPago - {payment.get('payment_method_id', '')}",
-                    'response_code': payment.get("status_detail", "")
-                }
-                
-                saved = save_purchase(external_reference, amount, payer_email, numbers, **client_info)
-                
-                if not saved:
-                    logger.error(f"❌ No se pudo guardar: {external_reference}")
-                    return jsonify({'status': 'error'}), 500
+                ))
             
-            # ✅ ENVIAR EMAIL SOLO UNA VEZ
-            try:
+                if existing_numbers:
+                    # Solo confirmar
+                    app_db.confirm_assigned_numbers(tx, external_reference)
+                else:
+                    # Confirmar números asignados (no existían)
+                    insert_assigned_numbers(tx, numbers, external_reference, raffle_id)
+                app_db.add_purchase_stats(tx, external_reference)
+                # El email se confirma con la compra: un reintento la ve confirmada y no lo repite
                 send_purchase_confirmation_email(
-                    customer_email=payer_email,
-                    customer_name=payer_name,
-                    numbers=numbers,
-                    amount=amount,
-                    invoice_id=external_reference
+                    customer_email=payer_email, customer_name=payer_name, numbers=numbers,
+                    amount=amount, invoice_id=external_reference, tx=tx
                 )
-            except Exception as email_error:
-                logger.error(f"❌ Error enviando email: {email_error}")
-            
-            logger.info(f"✅✅✅ Compra completada: {external_reference}")
+            notify_progress(raffle_id)
         
-        return jsonify({'status': 'ok'}), 200
+        else:
+            # ✅ CREAR NUEVO REGISTRO SOLO SI APROBADO
+            logger.info(f"💾 Creando nueva compra: {external_reference}")
         
-    except Exception as e:
-        logger.error(f"❌ Error webhook MercadoPago: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'status': 'error'}), 500
+            num_tickets = tickets_for_amount(amount, raffle_id)
+        
+            client_info = {
+                'full_name': payer_name,
+                'document_type': document_type,
+                'document_number': document_number,
+                'phone': phone,
+                'transaction_id': str(payment_id),
+                'payment_method': f"MercadoPago - {payment.get('payment_method_id', '')}",
+                'response_code': payment.get("status_detail", "")
+            }
+        
+            try:
+                numbers = save_purchase(external_reference, amount, payer_email, quantity=num_tickets,
+                                        raffle_id=raffle_id, **client_info)
+            except (app_db.NumbersUnavailable, app_db.ReservationUnderpaid) as e:
+                raise jobs.PermanentJobError(f"No se confirmó {external_reference}: {e}")
+        
+            if not numbers:
+                # Reintentar con backoff (la base de datos pudo estar caída)
+                raise RuntimeError(f"No se pudo guardar: {external_reference}")
+    
+        logger.info(f"✅✅✅ Compra completada: {external_reference}")
 
     
 # ==================== RUTAS DE AUTENTICACIÓN ====================
@@ -1128,6 +1463,8 @@ def admin_blessed_numbers():
         errors = []
         success = False
         deleted = False
+        # Los números benditos son de la rifa principal
+        pool_size = app_db.get_pool_size(app_db.DEFAULT_RAFFLE_ID)
         
         if request.method == 'POST':
             action = request.form.get('action')
@@ -1135,6 +1472,7 @@ def admin_blessed_numbers():
             if action == 'delete':
                 # Eliminar configuración
                 app_db.run_query("DELETE FROM blessed_numbers_config", commit=True)
+                notify_blessed()
                 deleted = True
                 logger.info("🗑️ Configuración de números benditos eliminada")
             
@@ -1150,10 +1488,10 @@ def admin_blessed_numbers():
                         num1 = int(number1)
                         num2 = int(number2)
                         
-                        if num1 < 1 or num1 > 2000:
-                            errors.append("El número 1 debe estar entre 1 y 2000")
-                        if num2 < 1 or num2 > 2000:
-                            errors.append("El número 2 debe estar entre 1 y 2000")
+                        if num1 < 1 or num1 > pool_size:
+                            errors.append(f"El número 1 debe estar entre 1 y {pool_size}")
+                        if num2 < 1 or num2 > pool_size:
+                            errors.append(f"El número 2 debe estar entre 1 y {pool_size}")
                         if num1 == num2:
                             errors.append("Los números deben ser diferentes")
                         
@@ -1164,6 +1502,7 @@ def admin_blessed_numbers():
                             
                             # Guardar configuración
                             save_blessed_numbers_config(visible, scheduled_date, numbers)
+                            notify_blessed()
                             success = True
                             logger.info(f"✅ Números benditos guardados: {numbers}")
                 
@@ -1177,7 +1516,8 @@ def admin_blessed_numbers():
                              config=config,
                              errors=errors,
                              success=success,
-                             deleted=deleted)
+                             deleted=deleted,
+                             pool_size=pool_size)
         
     except Exception as e:
         logger.error(f"❌ Error en blessed_numbers: {e}")
@@ -1192,7 +1532,14 @@ def admin_blessed_numbers():
 @app.route('/')
 def index():
     try:
-        return render_template('index.html')
+        # El estado inicial va embebido: la portada pinta sin pedir nada más
+        bootstrap = None
+        if INLINE_BOOTSTRAP:
+            try:
+                bootstrap = get_bootstrap(app_db.DEFAULT_RAFFLE_ID)
+            except Exception as e:
+                logger.error(f"Error armando bootstrap: {e}")
+        return render_template('index.html', bootstrap=bootstrap)
     except Exception as e:
         logger.error(f"Error rendering index.html: {e}")
         return f"Error loading page: {str(e)}", 500
@@ -1211,10 +1558,61 @@ def serve_static(filename):
 
 @app.route('/progress')
 def progress():
-    total_numbers = 2000
+    raffle_id = get_request_raffle_id(request.args.get('raffle_id'))
+    if raffle_id is None:
+        return jsonify({'status': 'error', 'message': 'Invalid raffle'}), 404
+
+    version = progress_version(raffle_id)
+    etag = f"p{raffle_id}." + '.'.join(str(v) for v in version)
+    return conditional_json(etag, lambda: get_progress(raffle_id, version))
+
+
+def progress_version(raffle_id):
+    """
+    Versión del progreso de una rifa sin consultar la base de datos: la
+    generación del bitmap (cambia con cada número tomado o liberado en
+    cualquier worker) y el contador compartido de confirmaciones
+    """
+    try:
+        generation = app_db.get_number_bitmap(raffle_id).generation
+    except Exception as e:
+        logger.error(f"Error leyendo bitmap: {e}")
+        generation = None
+    return (generation, shared_versions.get('progress'))
+
+
+def get_progress(raffle_id, version=None):
+    """Progreso de la rifa desde la caché"""
+    # Versionar la caché evita servir conteos viejos tras una venta
+    if version is None:
+        version = progress_version(raffle_id)
+    return progress_cache.get(raffle_id, lambda: build_progress(raffle_id), version=version)
+
+
+def notify_progress(raffle_id=None):
+    """Invalida la caché de /progress y avisa a los clientes SSE de este worker"""
+    # Confirmar una reserva no cambia el bitmap: el contador avisa a los
+    # demás workers (y cambia el ETag)
+    shared_versions.bump('progress')
+    progress_cache.invalidate(raffle_id)
+    bootstrap_cache.invalidate(raffle_id)
+    if raffle_id is not None and event_hub.subscribers:
+        event_hub.publish(f'progress:{raffle_id}', get_progress(raffle_id))
+
+
+def build_progress(raffle_id):
+    """Conteos de la barra de progreso (una lectura de raffle_stats)"""
+    total_numbers = app_db.get_pool_size(raffle_id)
     assigned_count = 0
+    reserved_count = 0
     try:
-        assigned_count = app_db.count_assigned_numbers()
+        stats = app_db.get_raffle_stats(raffle_id, packages=False)
+        if stats is None:
+            assigned_count = app_db.count_assigned_numbers(raffle_id)
+        else:
+            assigned_count = stats['confirmed_numbers']
+        # Lo demás marcado en el bitmap son números apartados en checkout
+        reserved_count = max(app_db.get_number_bitmap(raffle_id).count() - assigned_count, 0)
     except Exception as e:
         logger.error(f"Error counting assigned numbers: {e}")
 
@@ -1224,42 +1622,213 @@ def progress():
     except Exception:
         percentage = 0.0
 
-    return jsonify({
+    return {
+        'raffle_id': raffle_id,
         'assigned': int(assigned_count or 0),
+        'reserved': int(reserved_count or 0),
         'total': total_numbers,
         'percentage': round(percentage, 1)
-    })
+    }
 
 @app.route('/api/blessed_numbers_status')
 def api_blessed_numbers_status():
+    # El ETag cambia al guardar la configuración o al llegar la fecha de
+    # revelación; ambas se saben sin consultar la base de datos
+    version = shared_versions.get('blessed')
+    config = get_cached_blessed_config(version)
+    etag = f"b{version}.{int(blessed_revealed(config))}"
+    return conditional_json(etag, build_blessed_status)
+
+
+def get_cached_blessed_config(version=None):
+    """Configuración de números benditos desde la caché del worker"""
+    if version is None:
+        version = shared_versions.get('blessed')
+    return blessed_cache.get('config', get_blessed_numbers_config, version=version)
+
+
+def blessed_scheduled_date(config):
+    """Fecha programada de revelación como datetime (None si no hay o es inválida)"""
+    if not config['scheduled_date']:
+        return None
     try:
-        config = get_blessed_numbers_config()
+        return datetime.fromisoformat(str(config['scheduled_date']))
+    except ValueError:
+        logger.error(f"Error parsing scheduled date: {config['scheduled_date']}")
+        return None
+
+
+def blessed_revealed(config, now=None):
+    """True si los números ya son visibles o llegó su fecha programada"""
+    if config['visible']:
+        return True
+    scheduled = blessed_scheduled_date(config)
+    return scheduled is not None and (now or datetime.now()) >= scheduled
+
+
+def reveal_blessed_numbers(config):
+    """
+    Marca como visible la configuración vigente al llegar su fecha. Es un
+    compare-and-set sobre la misma fila (sin insertar historial): aunque
+    muchas peticiones lo intenten a la vez, solo una lo aplica y avisa.
+    """
+    if not config.get('id'):
+        return False
+    try:
+        with app_db.transaction() as tx:
+            updated = tx.execute("""
+                UPDATE blessed_numbers_config
+                SET visible = TRUE, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND visible = FALSE
+            """, params=(config['id'],))
+    except Exception as e:
+        logger.error(f"Error revelando números benditos: {e}")
+        return False
+    if updated:
+        shared_versions.bump('blessed')
+        logger.info(f"✨ Números benditos revelados: {config['numbers']}")
+    return bool(updated)
+
+
+def build_blessed_status():
+    """Estado público de los números benditos (los revela al llegar la fecha)"""
+    try:
+        config = get_cached_blessed_config()
         
-        now = datetime.now()
-        visible = config['visible']
+        visible = bool(config['visible'])
         show_date = None
         
-        if config['scheduled_date'] and not visible:
-            try:
-                scheduled = datetime.fromisoformat(config['scheduled_date'])
-                if now >= scheduled:
-                    visible = True
-                    save_blessed_numbers_config(True, config['scheduled_date'], config['numbers'])
-                else:
-                    show_date = scheduled.strftime('%d/%m/%Y %H:%M')
-            except Exception as e:
-                logger.error(f"Error parsing scheduled date: {e}")
+        if not visible:
+            scheduled = blessed_scheduled_date(config)
+            if scheduled and datetime.now() >= scheduled:
+                visible = True
+                reveal_blessed_numbers(config)
+            elif scheduled:
+                show_date = scheduled.strftime('%d/%m/%Y %H:%M')
         
-        return jsonify({
+        return {
             'visible': visible,
             'scheduled_date': config['scheduled_date'],
             'show_date': show_date,
             'numbers': config['numbers'] if (visible and config['numbers']) else [],
             'has_numbers': bool(config['numbers'])
-        })
+        }
     except Exception as e:
         logger.error(f"Error in blessed numbers status: {e}")
-        return jsonify({'visible': False, 'numbers': [], 'has_numbers': False})
+        return {'visible': False, 'numbers': [], 'has_numbers': False}
+
+
+def notify_blessed():
+    """Publica a los clientes SSE de este worker el estado de los números benditos"""
+    shared_versions.bump('blessed')
+    bootstrap_cache.invalidate()
+    if event_hub.subscribers:
+        event_hub.publish('blessed', build_blessed_status())
+
+
+@app.route('/api/bootstrap')
+def api_bootstrap():
+    """Pasarelas, progreso y números benditos en una sola respuesta para la portada"""
+    raffle_id = get_request_raffle_id(request.args.get('raffle_id'))
+    if raffle_id is None:
+        return jsonify({'status': 'error', 'message': 'Invalid raffle'}), 404
+
+    etag = bootstrap_etag(raffle_id)
+    return conditional_json(etag, lambda: get_bootstrap(raffle_id, etag))
+
+
+def bootstrap_etag(raffle_id):
+    """Combina las versiones de las tres partes (sin consultar la base de datos)"""
+    progress_part = '.'.join(str(v) for v in progress_version(raffle_id))
+    blessed = shared_versions.get('blessed')
+    revealed = int(blessed_revealed(get_cached_blessed_config(blessed)))
+    gateways = payment_gateways_etag(build_payment_gateways())[:8]
+    return f"s{raffle_id}.{progress_part}.{blessed}.{revealed}.{gateways}"
+
+
+def get_bootstrap(raffle_id, etag=None):
+    """Snapshot de la portada desde la caché, versionado por su ETag"""
+    if etag is None:
+        etag = bootstrap_etag(raffle_id)
+    return bootstrap_cache.get(raffle_id, lambda: build_bootstrap(raffle_id, etag), version=etag)
+
+
+def build_bootstrap(raffle_id, etag):
+    """Arma el snapshot; `version` permite al navegador revalidarlo con If-None-Match"""
+    return {
+        'version': etag,
+        'raffle_id': raffle_id,
+        'payment_gateways': build_payment_gateways(),
+        'progress': get_progress(raffle_id),
+        'blessed': build_blessed_status(),
+    }
+
+
+@app.route('/events')
+def events():
+    """
+    Stream SSE con el progreso de la rifa y los números benditos.
+    Cada conexión queda esperando sin consultar la base de datos; requiere
+    un worker asíncrono (gevent) para sostener miles de conexiones.
+    """
+    raffle_id = get_request_raffle_id(request.args.get('raffle_id'))
+    if raffle_id is None:
+        return jsonify({'status': 'error', 'message': 'Invalid raffle'}), 404
+
+    start_events_watcher()
+    return Response(
+        event_hub.stream({f'progress:{raffle_id}', 'blessed'}),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def start_events_watcher():
+    """Inicia (una vez por worker, con el primer cliente) el hilo que alimenta /events"""
+    global _events_watcher
+    if _events_watcher is not None and _events_watcher.is_alive():
+        return
+    with _events_watcher_lock:
+        if _events_watcher is None or not _events_watcher.is_alive():
+            _events_watcher = threading.Thread(target=watch_events, name='events-watcher', daemon=True)
+            _events_watcher.start()
+
+
+def watch_events():
+    """
+    Publica el progreso cuando cambia la generación del bitmap (una compra
+    confirmada en cualquier worker) y refresca periódicamente las rifas y
+    los números benditos, revelándolos en cuanto llega su fecha.
+    """
+    generations = {}
+    raffle_ids = [app_db.DEFAULT_RAFFLE_ID]
+    next_refresh = 0
+    reveal_at = None
+    while True:
+        try:
+            now = time.monotonic()
+            if now >= next_refresh or (reveal_at and datetime.now() >= reveal_at):
+                raffle_ids = [r['id'] for r in app_db.get_raffles()]
+                blessed = build_blessed_status()
+                event_hub.publish('blessed', blessed)
+                reveal_at = None
+                if not blessed.get('visible') and blessed.get('scheduled_date'):
+                    try:
+                        reveal_at = datetime.fromisoformat(str(blessed['scheduled_date']))
+                    except ValueError:
+                        pass
+                for raffle_id in raffle_ids:
+                    event_hub.publish(f'progress:{raffle_id}', get_progress(raffle_id))
+                next_refresh = now + EVENTS_REFRESH_INTERVAL
+
+            for raffle_id in raffle_ids:
+                generation = app_db.get_number_bitmap(raffle_id).generation
+                if generations.get(raffle_id) != generation:
+                    generations[raffle_id] = generation
+                    event_hub.publish(f'progress:{raffle_id}', get_progress(raffle_id))
+        except Exception as e:
+            logger.error(f"Error publicando eventos: {e}")
+        time.sleep(EVENTS_POLL_INTERVAL)
 
 @app.route('/test_epayco')
 def test_epayco():
@@ -1336,40 +1905,40 @@ def database():
         date_from = request.args.get('date_from', '')
         date_to = request.args.get('date_to', '')
         status_filter = request.args.get('status', '')
-        
-        query = "SELECT * FROM purchases WHERE 1=1"
-        params = []
-        
-        if search_query:
-            # ✅ AGREGAR BÚSQUEDA POR NÚMERO
-            query += """ AND (
-                LOWER(full_name) LIKE LOWER(%s) OR 
-                LOWER(email) LIKE LOWER(%s) OR 
-                LOWER(phone) LIKE LOWER(%s) OR 
-                LOWER(document_number) LIKE LOWER(%s) OR
-                numbers LIKE %s
-            )"""
-            search_pattern = f"%{search_query}%"
-            params.extend([search_pattern] * 5)  # ✅ Ahora son 5 parámetros
-        
-        if date_from:
-            query += " AND created_at >= %s"
-            params.append(date_from)
-        if date_to:
-            query += " AND created_at <= %s"
-            params.append(date_to)
-        if status_filter:
-            query += " AND status = %s"
-            params.append(status_filter)
-        
-        query += " AND (status != 'deleted' OR status IS NULL) ORDER BY created_at DESC LIMIT 100"
-        
-        purchases = app_db.run_query(query, params=tuple(params) if params else None, fetchall=True) or []
-        metrics = calculate_metrics(date_from, date_to)
-        table_rows = generate_table_rows(purchases)
-        
-        return render_template('admin_database.html', purchases=purchases, table_rows=table_rows, metrics=metrics,
-                             search_query=search_query, date_from=date_from, date_to=date_to, status_filter=status_filter)
+        raffle_id = get_request_raffle_id(request.args.get('raffle_id')) or app_db.DEFAULT_RAFFLE_ID
+        
+        per_page = search.page_size(request.args.get('per_page', search.PAGE_SIZE))
+        cursor = request.args.get('cursor', '')
+        metrics = calculate_metrics(date_from, date_to, raffle_id)
+        
+        filters = {key: value for key, value in {
+            'search': search_query, 'date_from': date_from, 'date_to': date_to,
+            'status': status_filter, 'raffle_id': raffle_id, 'per_page': per_page,
+        }.items() if value}
+        
+        def load_page():
+            # La plantilla lo llama al llegar a la tabla: el navegador ya
+            # está pintando el encabezado, las métricas y la gráfica.
+            # Búsqueda indexada (trigramas en Postgres, FTS5 en SQLite)
+            # ordenada por relevancia; sin búsqueda, keyset con `cursor`
+            try:
+                page = search.search_purchases(search_query, raffle_id, date_from, date_to, status_filter,
+                                               limit=per_page, cursor=cursor)
+                page['error'] = None
+            except Exception as e:
+                # La respuesta ya empezó: el error se muestra en la tabla
+                logger.error(f"Error consultando compras en /database: {e}")
+                page = {'rows': [], 'next_cursor': None, 'total': 0, 'total_exact': True,
+                        'ranked': bool(search_query), 'error': 'No se pudieron consultar las compras'}
+            page['entries'] = purchase_rows(page['rows'])
+            page['next_url'] = url_for('database', cursor=page['next_cursor'], **filters) if page['next_cursor'] else None
+            page['first_url'] = url_for('database', **filters) if cursor else None
+            return page
+        
+        return stream_template('admin_database.html', metrics=metrics, load_page=load_page,
+                               search_query=search_query, date_from=date_from, date_to=date_to,
+                               status_filter=status_filter, raffles=app_db.get_raffles(), raffle_id=raffle_id,
+                               per_page=per_page, page_sizes=(25, 50, 100, 250, 500))
     
     except Exception as e:
         logger.error(f"Error en endpoint /database: {e}")
@@ -1377,6 +1946,72 @@ def database():
         traceback.print_exc()
         return f"<h1>Error en Base de Datos</h1><pre>{str(e)}</pre>", 500
 
+@app.route('/admin/db_stats')
+@login_required
+def admin_db_stats():
+    """Backend activo, circuito, pool de conexiones y cachés de este worker"""
+    status = app_db.get_backend_status()
+    status['caches'] = [progress_cache.snapshot(), blessed_cache.snapshot(), bootstrap_cache.snapshot(),
+                         metrics_cache.snapshot()]
+    status['events'] = event_hub.snapshot()
+    status['recent_events'] = idempotency.recent_events.snapshot()
+    status['outbound'] = [mercadopago_http.snapshot(), brevo_http.snapshot()]
+    return jsonify(status)
+
+@app.route('/admin/numbers_check')
+@login_required
+def admin_numbers_check():
+    """Verifica el bitmap de números contra la base de datos (?repair=1 lo corrige)"""
+    raffle_id = get_request_raffle_id(request.args.get('raffle_id'))
+    if raffle_id is None:
+        return jsonify({'error': 'Invalid raffle'}), 404
+    try:
+        return jsonify(app_db.check_number_bitmap(raffle_id, repair=request.args.get('repair') == '1'))
+    except Exception as e:
+        logger.error(f"Error verificando bitmap: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/admin/stats_check')
+@login_required
+def admin_stats_check():
+    """Verifica raffle_stats contra las compras (?repair=1 lo recalcula)"""
+    raffle_id = get_request_raffle_id(request.args.get('raffle_id'))
+    if raffle_id is None:
+        return jsonify({'error': 'Invalid raffle'}), 404
+    try:
+        result = app_db.check_raffle_stats(raffle_id, repair=request.args.get('repair') == '1')
+        if result['repaired']:
+            notify_progress(raffle_id)
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"Error verificando estadísticas: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/admin/raffles', methods=['GET', 'POST'])
+@login_required
+def admin_raffles():
+    """Lista las rifas (GET) o crea una nueva con su pool de números (POST)"""
+    if request.method == 'GET':
+        return jsonify({'raffles': app_db.get_raffles()})
+
+    data = request.get_json(silent=True) or request.form
+    try:
+        name = (data.get('name') or '').strip()
+        pool_size = int(data.get('pool_size', 0))
+        number_price = float(data.get('number_price', 0))
+        if not name or number_price <= 0:
+            raise ValueError("Nombre y precio por número son requeridos")
+        raffle_id = app_db.create_raffle(name, pool_size, number_price)
+    except (TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logger.error(f"❌ Error creando rifa: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    app_db.log_audit(session.get('admin_id'), 'CREATE', 'raffles', raffle_id,
+                     new_values={'name': name, 'pool_size': pool_size, 'number_price': number_price})
+    return jsonify({'status': 'ok', 'raffle': app_db.get_raffle(raffle_id)}), 201
+
 @app.route('/admin/simulate_purchase', methods=['GET'])
 @login_required
 def simulate_purchase_page():
@@ -1390,36 +2025,29 @@ def simulate_purchase():
         amount = int(request.form.get('amount', 4))
         email = request.form.get('email', 'test@demo.com')
         customer_name = request.form.get('name', 'Cliente de Prueba')
+        raffle_id = get_request_raffle_id(request.form.get('raffle_id'))
+        if raffle_id is None:
+            return jsonify({"status": "error", "message": "Invalid raffle"}), 404
         
         logger.info(f"🎲 Simulación iniciada por: {request.remote_addr}")
         
-        numbers = assign_numbers(amount)
+        invoice_id = f"sim_{uuid.uuid4().hex[:12]}"
+        amount_value = amount * app_db.get_raffle(raffle_id)['number_price']
         
-        if not numbers:
+        try:
+            numbers = save_purchase(invoice_id=invoice_id, amount=amount_value, email=email, 
+                                    quantity=amount, raffle_id=raffle_id, full_name=customer_name)
+        except app_db.NumbersUnavailable:
             logger.error("❌ No hay números disponibles")
             return jsonify({"status": "error", "message": "Not enough numbers available"}), 400
         
-        invoice_id = f"sim_{uuid.uuid4().hex[:12]}"
-        amount_value = amount * 6250
-        
-        saved = save_purchase(invoice_id=invoice_id, amount=amount_value, email=email, 
-                            numbers=numbers, full_name=customer_name)
-        
-        if not saved:
+        if not numbers:
             logger.error("❌ Error guardando en base de datos")
             return jsonify({"status": "error", "message": "Database error - check server logs"}), 500
         
-        try:
-            email_sent = send_purchase_confirmation_email(
-                customer_email=email, customer_name=customer_name,
-                numbers=numbers, amount=amount_value, invoice_id=invoice_id
-            )
-        except Exception as email_error:
-            logger.error(f"❌ Error enviando email: {email_error}")
-            email_sent = False
-        
         logger.info(f"✅ Simulación completada: {invoice_id}")
-        return jsonify({"status": "ok", "invoice_id": invoice_id, "numbers": numbers, "email_sent": email_sent})
+        # save_purchase encoló el email en la misma transacción
+        return jsonify({"status": "ok", "invoice_id": invoice_id, "numbers": numbers, "email_sent": True})
             
     except Exception as e:
         logger.error(f"💥 Error en simulate_purchase: {str(e)}")
@@ -1452,16 +2080,13 @@ def edit_purchase(purchase_id):
                                      purchase=None,
                                      error="Todos los campos obligatorios deben completarse")
             
-            # Actualizar en base de datos
-            app_db.run_query("""
-                UPDATE purchases 
-                SET invoice_id = %s, amount = %s, email = %s, numbers = %s, 
-                    status = %s, full_name = %s, phone = %s, 
-                    document_number = %s, notes = %s, updated_at = CURRENT_TIMESTAMP
-                WHERE id = %s
-            """, params=(invoice_id, amount, email, numbers, status, 
-                        full_name, phone, document_number, notes, purchase_id), 
-            commit=True)
+            # Actualizar en base de datos junto con raffle_stats
+            if not app_db.update_purchase(purchase_id, invoice_id, amount, email, numbers, status, notes,
+                                          full_name=full_name, phone=phone, document_number=document_number):
+                return render_template('edit_purchase.html',
+                                     purchase=app_db.get_purchase_by_id(purchase_id),
+                                     error="No se pudo actualizar la compra")
+            notify_progress()
             
             # Log de auditoría
             admin_id = session.get('admin_id')
@@ -1501,19 +2126,21 @@ def delete_purchase(purchase_id):
         
         invoice_id = purchase[1]
         
-        # Soft delete: marcar como eliminada
-        app_db.run_query("""
-            UPDATE purchases 
-            SET status = 'deleted', deleted_at = CURRENT_TIMESTAMP 
-            WHERE id = %s
-        """, params=(purchase_id,), commit=True)
-        
-        # Eliminar números asignados
-        app_db.run_query(
-            "DELETE FROM assigned_numbers WHERE invoice_id = %s",
-            params=(invoice_id,),
-            commit=True
-        )
+        with app_db.transaction() as tx:
+            # Descontar de raffle_stats antes de dejar de estar confirmada
+            app_db.remove_purchase_stats(tx, invoice_id)
+            
+            # Soft delete: marcar como eliminada
+            tx.execute("""
+                UPDATE purchases 
+                SET status = 'deleted', deleted_at = CURRENT_TIMESTAMP 
+                WHERE id = %s
+            """, params=(purchase_id,))
+            
+            # Eliminar números asignados y devolverlos al pool
+            app_db.delete_assigned_numbers(tx, invoice_id)
+            app_db.release_numbers(tx, invoice_id)
+        notify_progress()
         
         # Log de auditoría
         admin_id = session.get('admin_id')
@@ -1541,6 +2168,7 @@ def get_blessed_numbers_config():
         )
         if config:
             return {
+                'id': config[0],
                 'visible': config[1],
                 'scheduled_date': config[2],
                 'numbers': json.loads(config[3]) if config[3] else []
@@ -1566,98 +2194,22 @@ def save_blessed_numbers_config(visible, scheduled_date=None, numbers=None):
         return False
 
 
-def calculate_metrics(date_from=None, date_to=None):
-    """Calcula métricas del sistema"""
+def calculate_metrics(date_from=None, date_to=None, raffle_id=app_db.DEFAULT_RAFFLE_ID):
+    """Métricas de una rifa desde la caché (se invalida con cada compra)"""
+    key = (raffle_id, date_from or None, date_to or None)
     try:
-        metrics = {}
-        
-        date_condition = "WHERE status = 'confirmed'"
-        params = []
-        
-        if date_from:
-            date_condition += " AND created_at >= %s"
-            params.append(date_from)
-        if date_to:
-            date_condition += " AND created_at <= %s"
-            params.append(date_to)
-        
-        result = app_db.run_query(
-            f"SELECT COUNT(*) FROM purchases {date_condition}",
-            params=tuple(params) if params else None,
-            fetchone=True
-        )
-        metrics['total_purchases'] = result[0] if result else 0
-        
-        result = app_db.run_query(
-            f"SELECT SUM(amount) FROM purchases {date_condition}",
-            params=tuple(params) if params else None,
-            fetchone=True
-        )
-        metrics['total_revenue'] = float(result[0]) if result and result[0] else 0.0
-        
-        metrics['numbers_sold'] = app_db.count_assigned_numbers()
-        metrics['numbers_available'] = 2000 - metrics['numbers_sold']
-        metrics['percentage_sold'] = (metrics['numbers_sold'] / 2000) * 100
-        
-        result = app_db.run_query("""
-            SELECT 
-                DATE(created_at) as date,
-                COUNT(*) as count,
-                SUM(amount) as revenue
-            FROM purchases 
-            WHERE status = 'confirmed' 
-            AND created_at >= CURRENT_DATE - INTERVAL '7 days'
-            GROUP BY DATE(created_at)
-            ORDER BY date DESC
-        """, fetchall=True)
-        
-        metrics['daily_sales'] = []
-        if result:
-            for row in result:
-                metrics['daily_sales'].append({
-                    'date': str(row[0]),
-                    'count': row[1],
-                    'revenue': float(row[2])
-                })
-        
-        if metrics['total_purchases'] > 0:
-            metrics['average_purchase'] = metrics['total_revenue'] / metrics['total_purchases']
-        else:
-            metrics['average_purchase'] = 0.0
-        
-        result = app_db.run_query("""
-            SELECT amount, COUNT(*) as count
-            FROM purchases 
-            WHERE status = 'confirmed'
-            GROUP BY amount
-            ORDER BY count DESC
-            LIMIT 1
-        """, fetchone=True)
-        
-        if result:
-            amount_map = {
-                5000: '1 número (Test)',
-                10000: '2 números (Test)',
-                15000: '4 números (Test)',
-                25000: '4 números',
-                53000: '8 números',
-                81000: '12 números',
-                109000: '16 números',
-                137000: '20 números'
-            }
-            metrics['most_popular_package'] = amount_map.get(int(result[0]), f'${result[0]:,.0f}')
-        else:
-            metrics['most_popular_package'] = 'N/A'
-        
-        return metrics
-        
+        return metrics_cache.get(key, lambda: build_metrics(date_from, date_to, raffle_id),
+                                 version=shared_versions.get('progress'))
     except Exception as e:
         logger.error(f"Error calculando métricas: {e}")
+        pool_size = app_db.get_pool_size(raffle_id)
         return {
+            'raffle_id': raffle_id,
+            'pool_size': pool_size,
             'total_purchases': 0,
             'total_revenue': 0.0,
             'numbers_sold': 0,
-            'numbers_available': 2000,
+            'numbers_available': pool_size,
             'percentage_sold': 0.0,
             'daily_sales': [],
             'average_purchase': 0.0,
@@ -1665,100 +2217,148 @@ def calculate_metrics(date_from=None, date_to=None):
         }
 
 
-def generate_table_rows(purchases):
-    """Genera las filas HTML de la tabla"""
-    if not purchases:
-        return '''
-            <tr>
-                <td colspan="8" style="text-align: center; padding: 40px; color: #b0b0b0;">
-                    <div style="font-size: 3em; margin-bottom: 1rem;">📭</div>
-                    <div style="font-size: 1.2em;">No hay compras registradas</div>
-                </td>
-            </tr>
-        '''
+def build_metrics(date_from=None, date_to=None, raffle_id=app_db.DEFAULT_RAFFLE_ID):
+    """Calcula métricas de una rifa (una consulta, ver app_db.get_raffle_dashboard)"""
+    pool_size = app_db.get_pool_size(raffle_id)
+    metrics = {'raffle_id': raffle_id, 'pool_size': pool_size}
+    dashboard = app_db.get_raffle_dashboard(raffle_id, date_from, date_to)
+    if dashboard is None:
+        # Base de datos anterior a raffle_stats: calcularlas una vez
+        app_db.rebuild_raffle_stats(raffle_id)
+        dashboard = app_db.get_raffle_dashboard(raffle_id, date_from, date_to)
+    stats = dashboard['stats']
     
-    table_rows = ""
-    for p in purchases:
-        try:
-            p_id = p[0] if len(p) > 0 else 'N/A'
-            p_invoice = p[1] if len(p) > 1 else 'N/A'
-            p_amount = p[2] if len(p) > 2 else 0
-            p_email = p[3] if len(p) > 3 else 'N/A'
-            p_numbers = p[4] if len(p) > 4 else ''
-            p_status = p[5] if len(p) > 5 else 'pending'
-            
-            p_full_name = p[10] if len(p) > 10 and p[10] else 'No especificado'
-            p_document = p[12] if len(p) > 12 and p[12] else 'N/A'
-            p_phone = p[13] if len(p) > 13 and p[13] else 'N/A'
-            
-            status_styles = {
-                'confirmed': 'background: linear-gradient(135deg, #4CAF50, #45a049); color: #ffffff; padding: 8px 16px; border-radius: 8px; font-weight: 700; box-shadow: 0 0 15px rgba(76, 175, 80, 0.5);',
-                'pending': 'background: linear-gradient(135deg, #FFA500, #FF8C00); color: #ffffff; padding: 8px 16px; border-radius: 8px; font-weight: 700; box-shadow: 0 0 15px rgba(255, 165, 0, 0.5);',
-                'cancelled': 'background: linear-gradient(135deg, #f44336, #d32f2f); color: #ffffff; padding: 8px 16px; border-radius: 8px; font-weight: 700; box-shadow: 0 0 15px rgba(244, 67, 54, 0.5);'
-            }
-            status_style = status_styles.get(p_status, '')
-            
-            numbers_display = p_numbers
-            if len(p_numbers) > 50:
-                num_count = len(p_numbers.split(','))
-                numbers_display = f"{p_numbers[:50]}... ({num_count} números)"
-            
-            table_rows += f'''
-            <tr style="border-bottom: 1px solid rgba(76, 175, 80, 0.1);">
-                <td style="padding: 12px; color: #e0e0e0; font-weight: 600;">{p_id}</td>
-                <td style="padding: 12px; color: #e0e0e0;">{p_invoice}</td>
-                <td style="padding: 12px; font-weight: 700; color: #4CAF50;">${float(p_amount):,.0f}</td>
-                <td style="padding: 12px;">
-                    <div style="margin-bottom: 5px; font-weight: 600; color: #ffffff;">{p_full_name}</div>
-                    <div style="font-size: 0.85em; color: #b0b0b0;">{p_email}</div>
-                </td>
-                <td style="padding: 12px;">
-                    <div style="color: #e0e0e0;">📱 {p_phone}</div>
-                    <div style="font-size: 0.85em; color: #b0b0b0;">📄 {p_document}</div>
-                </td>
-                <td style="padding: 12px; max-width: 200px; word-wrap: break-word; color: #e0e0e0;">{numbers_display}</td>
-                <td style="padding: 12px;"><span style="{status_style}">{p_status.upper()}</span></td>
-                <td class="actions" style="padding: 12px;">
-                    <a href="/edit_purchase/{p_id}" style="text-decoration: none; padding: 8px 12px; background: linear-gradient(135deg, #2196F3, #1976D2); color: white; border-radius: 6px; margin-right: 5px; display: inline-block; font-weight: 600; box-shadow: 0 0 10px rgba(33, 150, 243, 0.5);">✏️ Editar</a>
-                    <a href="/delete_purchase/{p_id}" style="text-decoration: none; padding: 8px 12px; background: linear-gradient(135deg, #f44336, #d32f2f); color: white; border-radius: 6px; display: inline-block; font-weight: 600; box-shadow: 0 0 10px rgba(244, 67, 54, 0.5);" onclick="return confirm('¿Estás seguro de eliminar esta compra?')">🗑️ Eliminar</a>
-                </td>
-            </tr>
-            '''
-        except Exception as e:
-            logger.error(f"Error procesando fila: {e}")
-            continue
+    if dashboard['range'] is not None:
+        # Un rango de fechas no está en raffle_stats: se sumó ese tramo
+        metrics['total_purchases'] = dashboard['range']['purchases']
+        metrics['total_revenue'] = dashboard['range']['revenue']
+    else:
+        metrics['total_purchases'] = stats['confirmed_purchases']
+        metrics['total_revenue'] = stats['revenue']
+    
+    metrics['numbers_sold'] = stats['confirmed_numbers']
+    metrics['numbers_available'] = pool_size - metrics['numbers_sold']
+    metrics['percentage_sold'] = (metrics['numbers_sold'] / pool_size) * 100
+    metrics['daily_sales'] = dashboard['daily_sales']
+    
+    if metrics['total_purchases'] > 0:
+        metrics['average_purchase'] = metrics['total_revenue'] / metrics['total_purchases']
+    else:
+        metrics['average_purchase'] = 0.0
+    
+    packages = stats['packages']
+    result = max(packages.items(), key=lambda item: item[1]) if packages else None
     
-    return table_rows
+    if result:
+        amount_map = {
+            5000: '1 número (Test)',
+            10000: '2 números (Test)',
+            15000: '4 números (Test)',
+            25000: '4 números',
+            53000: '8 números',
+            81000: '12 números',
+            109000: '16 números',
+            137000: '20 números'
+        }
+        metrics['most_popular_package'] = amount_map.get(int(result[0]), f'${result[0]:,.0f}')
+    else:
+        metrics['most_popular_package'] = 'N/A'
+    
+    return metrics
 
 
-def assign_numbers(count):
-    """Asigna números aleatorios disponibles"""
-    rows = app_db.run_query("SELECT number FROM assigned_numbers", fetchall=True) or []
-    assigned = set()
-    for r in rows:
-        try:
-            assigned.add(int(r[0]))
-        except Exception:
-            try:
-                assigned.add(int(r))
-            except Exception:
-                pass
+def purchase_rows(purchases):
+    """Datos de cada fila de la tabla de compras (admin_purchase_rows.html), uno a uno"""
+    for p in purchases:
+        numbers = p[4] or ''
+        if len(numbers) > 50:
+            numbers = f"{numbers[:50]}... ({len(numbers.split(','))} números)"
+        yield {
+            'id': p[0],
+            'invoice_id': p[1],
+            'amount': float(p[2] or 0),
+            'email': p[3],
+            'numbers': numbers,
+            'status': p[5] or 'pending',
+            'full_name': p[10] or 'No especificado',
+            'document_number': p[12] or 'N/A',
+            'phone': p[13] or 'N/A',
+        }
+
+
+def client_key():
+    """
+    Identifica al cliente para limitar sus números apartados: la IP que
+    agregó a X-Forwarded-For el último proxy de confianza (las anteriores
+    las escribe el propio cliente y no sirven).
+    """
+    forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',') if ip.strip()]
+    if TRUSTED_PROXIES and len(forwarded) >= TRUSTED_PROXIES:
+        return f"ip:{forwarded[-TRUSTED_PROXIES]}"
+    return f"ip:{request.remote_addr or 'desconocida'}"
+
+
+def get_request_raffle_id(value=None):
+    """
+    Convierte el raffle_id recibido en una petición. Sin valor se usa la
+    rifa principal; retorna None si la rifa no existe.
+    """
+    if value in (None, ''):
+        return app_db.DEFAULT_RAFFLE_ID
+    try:
+        raffle = app_db.get_raffle(int(value))
+    except (TypeError, ValueError):
+        return None
+    return raffle['id'] if raffle else None
+
+
+def tickets_for_amount(amount, raffle_id=app_db.DEFAULT_RAFFLE_ID):
+    """Cantidad de números que compra `amount` en la rifa"""
+    if raffle_id == app_db.DEFAULT_RAFFLE_ID:
+        return get_package_info(amount)['numbers']
+    return max(1, int(float(amount) // app_db.get_raffle(raffle_id)['number_price']))
+
+
+def chosen_numbers_price(count, raffle_id=app_db.DEFAULT_RAFFLE_ID):
+    """Lo que cuestan `count` números elegidos (sin precio de paquete)"""
+    return count * app_db.get_raffle(raffle_id)['number_price']
 
-    available = [n for n in range(1, 2001) if n not in assigned]
 
-    if len(available) < count:
-        raise ValueError("Not enough numbers available")
+def assign_numbers(count, invoice_id, tx, raffle_id=app_db.DEFAULT_RAFFLE_ID):
+    """
+    Reclama `count` números libres al azar de la rifa para `invoice_id`.
+    Debe llamarse dentro de la transacción que guarda la compra (`tx`),
+    así la asignación y el registro se confirman o se revierten juntos.
+    """
+    # El bitmap compartido permite rechazar sin tocar la base de datos
+    if app_db.get_number_bitmap(raffle_id).free_count() < count:
+        raise app_db.NumbersUnavailable("Not enough numbers available")
+    return app_db.claim_numbers(tx, count, invoice_id, raffle_id)
 
-    selected = random.sample(available, count)
-    selected.sort()
-    return selected
+
+def insert_assigned_numbers(tx, numbers, invoice_id, raffle_id=app_db.DEFAULT_RAFFLE_ID):
+    """Inserta los números confirmados de una compra en un solo lote"""
+    tx.executemany(
+        "INSERT INTO assigned_numbers (raffle_id, number, invoice_id, is_confirmed) VALUES (%s, %s, %s, TRUE)",
+        [(raffle_id, number, invoice_id) for number in numbers]
+    )
 
 
-def save_purchase(invoice_id, amount, email, numbers, **kwargs):
-    """Guarda una compra con información adicional del cliente"""
+def save_purchase(invoice_id, amount, email, quantity=None,
+                  raffle_id=app_db.DEFAULT_RAFFLE_ID, reservation_id=None, **kwargs):
+    """
+    Guarda una compra con información adicional del cliente.
+    Confirma la reserva `reservation_id` (por defecto `invoice_id`) con
+    exactamente `quantity` números (los que cubre el pago): libera los
+    apartados de más y reclama en la misma transacción los que falten. Una reserva de números elegidos no se recorta: si
+    `amount` no alcanza para todos, no se confirma.
+    El email de confirmación se encola en la misma transacción: si la
+    compra se confirma, su email también.
+    Retorna la lista de números guardados, o None si falla.
+    Lanza NumbersUnavailable si no quedan números suficientes y
+    ReservationUnderpaid si el pago no cubre los números elegidos.
+    """
     try:
-        numbers_str = ','.join(map(str, numbers))
-        
         full_name = kwargs.get('full_name')
         document_type = kwargs.get('document_type')
         document_number = kwargs.get('document_number')
@@ -1770,40 +2370,69 @@ def save_purchase(invoice_id, amount, email, numbers, **kwargs):
         franchise = kwargs.get('franchise')
         response_code = kwargs.get('response_code')
 
-        try:
-            app_db.run_query("""
-                INSERT INTO purchases 
-                (invoice_id, amount, email, numbers, status, full_name, document_type, 
-                 document_number, phone, address, payment_method, bank_name, 
-                 transaction_id, franchise, response_code, confirmed_at)
-                VALUES (%s, %s, %s, %s, 'confirmed', %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, params=(
-                invoice_id, amount, email, numbers_str,
-                full_name, document_type, document_number, phone, address,
-                payment_method, bank_name, transaction_id, franchise, response_code,
-                datetime.now()
-            ), commit=True)
-        except Exception as e:
-            logger.warning(f"Trying fallback insert: {e}")
-            app_db.run_query(
-                "INSERT INTO purchases (invoice_id, amount, email, numbers, status) VALUES (%s, %s, %s, %s, 'confirmed')",
-                params=(invoice_id, amount, email, numbers_str), commit=True
-            )
-
-        for number in numbers:
-            app_db.run_query(
-                "INSERT INTO assigned_numbers (number, invoice_id, is_confirmed) VALUES (%s, %s, TRUE)", 
-                params=(number, invoice_id), commit=True
+        # ✅ Compra y números en una sola transacción: todo o nada
+        with app_db.transaction() as tx:
+            reservation_id = reservation_id or invoice_id
+            if reservation_id.startswith(CHOSEN_PREFIX):
+                numbers = app_db.confirm_reservation(tx, reservation_id, invoice_id)
+                price = chosen_numbers_price(len(numbers), raffle_id)
+                if numbers and float(amount) < price:
+                    raise app_db.ReservationUnderpaid(
+                        f"{reservation_id}: pagó {float(amount):,.0f} por {len(numbers)} números de {price:,.0f}")
+                if numbers:
+                    quantity = len(numbers)
+            else:
+                numbers = app_db.confirm_reservation(tx, reservation_id, invoice_id, max_count=quantity)
+            if numbers:
+                logger.info(f"🕒 Reserva confirmada para {invoice_id}: {numbers}")
+            missing = (quantity or 0) - len(numbers)
+            if missing > 0:
+                extra = assign_numbers(missing, invoice_id, tx, raffle_id)
+                insert_assigned_numbers(tx, extra, invoice_id, raffle_id)
+                numbers = sorted(numbers + extra)
+            numbers_str = ','.join(map(str, numbers))
+            
+            try:
+                with tx.savepoint('purchase_insert'):
+                    tx.execute("""
+                        INSERT INTO purchases 
+                        (invoice_id, raffle_id, amount, email, numbers, status, full_name, document_type, 
+                         document_number, phone, address, payment_method, bank_name, 
+                         transaction_id, franchise, response_code, confirmed_at)
+                        VALUES (%s, %s, %s, %s, %s, 'confirmed', %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    """, params=(
+                        invoice_id, raffle_id, amount, email, numbers_str,
+                        full_name, document_type, document_number, phone, address,
+                        payment_method, bank_name, transaction_id, franchise, response_code,
+                        datetime.now()
+                    ))
+            except Exception as e:
+                logger.warning(f"Trying fallback insert: {e}")
+                tx.execute(
+                    "INSERT INTO purchases (invoice_id, raffle_id, amount, email, numbers, status) VALUES (%s, %s, %s, %s, %s, 'confirmed')",
+                    params=(invoice_id, raffle_id, amount, email, numbers_str)
+                )
+            app_db.add_purchase_stats(tx, invoice_id)
+            send_purchase_confirmation_email(
+                customer_email=email, customer_name=full_name, numbers=numbers,
+                amount=float(amount), invoice_id=invoice_id, tx=tx
             )
+        notify_progress(raffle_id)
         
         logger.info(f"✅ Compra guardada exitosamente: {invoice_id}")
-        return True
-        
+        return numbers
+        
+    except app_db.NumbersUnavailable:
+        logger.error(f"❌ No hay números disponibles para {invoice_id}")
+        raise
+    except app_db.ReservationUnderpaid as e:
+        logger.error(f"❌ Pago insuficiente para la reserva: {e}")
+        raise
     except Exception as e:
         logger.error(f"❌ Error guardando compra {invoice_id}: {e}")
         import traceback
         traceback.print_exc()
-        return False
+        return None
 
 
 def verify_signature(data, signature):
@@ -1858,6 +2487,8 @@ def confirmation():
     transaction_state = data.get('x_transaction_state')
     amount = data.get('x_amount')
     customer_email = data.get('x_customer_email')
+    # La rifa viaja en el campo extra de ePayco
+    raffle_id = get_request_raffle_id(data.get('x_extra1'))
 
     # ✅ VALIDACIONES CRÍTICAS
     if not ref_payco:
@@ -1867,98 +2498,95 @@ def confirmation():
     if not customer_email:
         logger.error("❌ No customer email")
         return jsonify({'status': 'error', 'message': 'No email'}), 400
-
-    # ✅ VERIFICAR DUPLICADOS
-    existing = app_db.run_query(
-        "SELECT id FROM purchases WHERE invoice_id = %s", 
-        params=(ref_payco,), 
-        fetchone=True
-    )
     
-    if existing:
-        logger.warning(f"⚠️ Purchase {ref_payco} already exists")
-        return jsonify({'status': 'success', 'message': 'Already processed'}), 200
+    if raffle_id is None:
+        logger.error("❌ Invalid raffle")
+        return jsonify({'status': 'error', 'message': 'Invalid raffle'}), 400
 
     logger.info(f"💳 Transaction state: {transaction_state}")
 
-    if transaction_state == 'Aceptada':
-        try:
-            amount_float = float(amount)
-            
-            # ✅ MAPEO CORREGIDO
-            num_tickets_map = {
-                5000: 1, 10000: 2, 15000: 4,
-                25000: 4, 53000: 8, 81000: 12,
-                109000: 16, 137000: 20
-            }
-            
-            num_tickets = num_tickets_map.get(int(amount_float))
-            
-            if not num_tickets:
-                logger.warning(f"⚠️ Amount {amount_float} not in map - Using fallback")
-                num_tickets = max(1, int(amount_float / 6250))
+    if transaction_state != 'Aceptada':
+        logger.info(f"⏳ Not accepted: {transaction_state}")
+        return jsonify({'status': 'pending'}), 200
 
-            logger.info(f"🎯 Assigning {num_tickets} numbers for ${amount_float}")
-            
-            numbers = assign_numbers(num_tickets)
-            logger.info(f"🎲 Numbers: {numbers}")
-            
-            client_info = {
-                'full_name': data.get('x_customer_name', ''),
-                'document_type': data.get('x_customer_doctype', ''),
-                'document_number': data.get('x_customer_document', ''),
-                'phone': data.get('x_customer_phone', '') or data.get('x_customer_mobile', ''),
-                'address': data.get('x_customer_address', ''),
-                'transaction_id': data.get('x_transaction_id', ''),
-                'payment_method': data.get('x_type_payment', ''),
-                'bank_name': data.get('x_bank_name', ''),
-                'franchise': data.get('x_franchise', ''),
-                'response_code': data.get('x_response', ''),
-            }
-            
-            logger.info(f"💾 Saving purchase: {ref_payco}")
-            saved = save_purchase(ref_payco, amount_float, customer_email, numbers, **client_info)
-            
-            if not saved:
-                logger.error(f"❌ Failed to save {ref_payco}")
-                return jsonify({'status': 'error', 'message': 'DB error'}), 500
+    try:
+        float(amount)
+    except (TypeError, ValueError):
+        logger.error(f"❌ Invalid amount: {amount}")
+        return jsonify({'status': 'error', 'message': 'Invalid amount'}), 400
 
-            logger.info(f"✅ Purchase saved: {ref_payco}")
+    # Asignar números y enviar el email lo hace un worker de fondo
+    try:
+        if idempotency.is_processed('epayco', ref_payco):
+            logger.warning(f"⚠️ Purchase {ref_payco} already processed")
+            return jsonify({'status': 'success', 'message': 'Already processed'}), 200
+        job_id = jobs.enqueue('epayco_confirmation', data, dedupe_key=f"epayco:{ref_payco}")
+    except Exception as e:
+        # Sin registrar la notificación, ePayco debe reintentarla
+        logger.error(f"❌ Error encolando {ref_payco}: {e}")
+        return jsonify({'status': 'error', 'message': 'Queue error'}), 500
+    logger.info(f"📬 Confirmación {ref_payco} encolada (trabajo {job_id})")
+    return jsonify({'status': 'success', 'queued': job_id is not None}), 200
 
-            # ✅ ENVIAR EMAIL
-            try:
-                logger.info(f"📧 Sending email to {customer_email}")
-                email_sent = send_purchase_confirmation_email(
-                    customer_email=customer_email,
-                    customer_name=client_info['full_name'],
-                    numbers=numbers,
-                    amount=amount_float,
-                    invoice_id=ref_payco
-                )
-                
-                if email_sent:
-                    logger.info(f"✅ Email sent to {customer_email}")
-                else:
-                    logger.error(f"❌ Email failed for {customer_email}")
-                    
-            except Exception as email_error:
-                logger.error(f"❌ Email error: {email_error}")
 
-            logger.info(f"✅✅✅ PURCHASE COMPLETED: {ref_payco}")
-            return jsonify({'status': 'success'}), 200
+def process_epayco_confirmation(data):
+    """Trabajo de fondo: guarda la compra confirmada por ePayco y envía el email"""
+    ref_payco = data.get('x_ref_payco')
+    customer_email = data.get('x_customer_email')
+    raffle_id = get_request_raffle_id(data.get('x_extra1'))
+    if raffle_id is None:
+        raise jobs.PermanentJobError(f"Rifa inválida en {ref_payco}")
+
+    with idempotency.processing('epayco', ref_payco) as claimed:
+        if not claimed:
+            return
+        
+        # ✅ VERIFICAR DUPLICADOS
+        existing = app_db.run_query(
+            "SELECT id FROM purchases WHERE invoice_id = %s", 
+            params=(ref_payco,), 
+            fetchone=True
+        )
+    
+        if existing:
+            logger.warning(f"⚠️ Purchase {ref_payco} already exists")
+            return
 
-        except ValueError as ve:
-            logger.error(f"❌ ValueError: {ve}")
-            return jsonify({'status': 'error', 'message': str(ve)}), 500
-            
-        except Exception as e:
-            logger.error(f"❌ Error: {e}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({'status': 'error', 'message': str(e)}), 500
-    else:
-        logger.info(f"⏳ Not accepted: {transaction_state}")
-        return jsonify({'status': 'pending'}), 200
+        amount_float = float(data.get('x_amount'))
+    
+        num_tickets = tickets_for_amount(amount_float, raffle_id)
+
+        logger.info(f"🎯 Assigning {num_tickets} numbers for ${amount_float}")
+    
+        client_info = {
+            'full_name': data.get('x_customer_name', ''),
+            'document_type': data.get('x_customer_doctype', ''),
+            'document_number': data.get('x_customer_document', ''),
+            'phone': data.get('x_customer_phone', '') or data.get('x_customer_mobile', ''),
+            'address': data.get('x_customer_address', ''),
+            'transaction_id': data.get('x_transaction_id', ''),
+            'payment_method': data.get('x_type_payment', ''),
+            'bank_name': data.get('x_bank_name', ''),
+            'franchise': data.get('x_franchise', ''),
+            'response_code': data.get('x_response', ''),
+        }
+    
+        logger.info(f"💾 Saving purchase: {ref_payco}")
+        try:
+            numbers = save_purchase(ref_payco, amount_float, customer_email, quantity=num_tickets,
+                                    raffle_id=raffle_id, reservation_id=data.get('x_id_invoice'),
+                                    **client_info)
+        except (app_db.NumbersUnavailable, app_db.ReservationUnderpaid) as e:
+            raise jobs.PermanentJobError(f"No se confirmó {ref_payco}: {e}")
+    
+        if not numbers:
+            raise RuntimeError(f"Failed to save {ref_payco}")
+
+        logger.info(f"🎲 Numbers: {numbers}")
+
+        logger.info(f"✅ Purchase saved: {ref_payco}")
+
+        logger.info(f"✅✅✅ PURCHASE COMPLETED: {ref_payco}")
 
 def get_package_info(amount):
     """Obtiene información del paquete según el monto"""
@@ -1979,5 +2607,139 @@ def get_package_info(amount):
         "type": "custom"
     })
 
+# ==================== TRABAJOS DE FONDO ====================
+# Efectos de los webhooks: hasta WEBHOOK_JOB_CONCURRENCY a la vez por worker
+WEBHOOK_JOB_CONCURRENCY = int(os.getenv('WEBHOOK_JOB_CONCURRENCY', '2'))
+jobs.register('mercadopago_payment', process_mercadopago_payment, concurrency=WEBHOOK_JOB_CONCURRENCY)
+jobs.register('epayco_confirmation', process_epayco_confirmation, concurrency=WEBHOOK_JOB_CONCURRENCY)
+
+
+def reconcile_mercadopago(payload):
+    """Trabajo periódico: encola los pagos aprobados de MercadoPago que no tienen compra"""
+    try:
+        reconcile.reconcile_payments(mercadopago_http, MERCADOPAGO_ACCESS_TOKEN)
+    finally:
+        reconcile.schedule_next()
+
+
+if MERCADOPAGO_ACCESS_TOKEN:
+    jobs.register(reconcile.RECONCILE_KIND, reconcile_mercadopago)
+
+
+@app.route('/admin/jobs')
+@login_required
+def admin_jobs():
+    """Trabajos por tipo y estado, y los últimos en dead-letter"""
+    try:
+        return jsonify(jobs.get_job_stats())
+    except Exception as e:
+        logger.error(f"Error obteniendo trabajos: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/admin/jobs/<int:job_id>/retry', methods=['POST'])
+@login_required
+def admin_retry_job(job_id):
+    """Vuelve a encolar un trabajo en dead-letter"""
+    if not jobs.retry_job(job_id):
+        return jsonify({'status': 'error', 'message': 'Job not found or not dead'}), 404
+    logger.info(f"🔁 Trabajo {job_id} reencolado por admin {session.get('admin_id')}")
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/admin/reconcile/mercadopago', methods=['POST'])
+@login_required
+def admin_reconcile_mercadopago():
+    """Concilia ya los pagos aprobados de MercadoPago (?hours= ventana hacia atrás)"""
+    if not MERCADOPAGO_ACCESS_TOKEN:
+        return jsonify({'status': 'error', 'message': 'MercadoPago not configured'}), 400
+    try:
+        hours = float(request.args.get('hours') or reconcile.MP_RECONCILE_LOOKBACK_HOURS)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid hours'}), 400
+    try:
+        result = reconcile.reconcile_payments(mercadopago_http, MERCADOPAGO_ACCESS_TOKEN, lookback_hours=hours)
+        logger.info(f"🧾 Conciliación manual por admin {session.get('admin_id')}: {result['enqueued']} encolados")
+        return jsonify({'status': 'ok', **result})
+    except Exception as e:
+        logger.error(f"Error conciliando MercadoPago: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 502
+
+
+# ==================== BANDEJA DE SALIDA DE EMAILS ====================
+mailer.set_transport(send_brevo_batch)
+
+
+@app.route('/admin/emails')
+@login_required
+def admin_emails():
+    """Emails por tipo y estado, y los últimos descartados"""
+    try:
+        return jsonify(mailer.get_email_stats())
+    except Exception as e:
+        logger.error(f"Error obteniendo emails: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/admin/emails/resend', methods=['POST'])
+@login_required
+def admin_resend_confirmations():
+    """
+    Reencola los emails de confirmación de las compras confirmadas entre
+    date_from y date_to (de una rifa). Las que ya tienen uno pendiente se omiten.
+    """
+    data = request.get_json(silent=True) or request.form
+    date_from, date_to = data.get('date_from'), data.get('date_to')
+    if not date_from or not date_to:
+        return jsonify({'status': 'error', 'message': 'date_from and date_to are required'}), 400
+    raffle_id = get_request_raffle_id(data.get('raffle_id'))
+    if raffle_id is None:
+        return jsonify({'error': 'Invalid raffle'}), 404
+    
+    try:
+        purchases = app_db.run_query("""
+            SELECT invoice_id, email, full_name, numbers, amount FROM purchases
+            WHERE status = 'confirmed' AND raffle_id = %s AND created_at >= %s AND created_at <= %s
+            ORDER BY created_at
+        """, params=(raffle_id, date_from, date_to), fetchall=True) or []
+        
+        queued = 0
+        for invoice_id, email, full_name, numbers, amount in purchases:
+            if send_purchase_confirmation_email(
+                customer_email=email, customer_name=full_name,
+                numbers=numbers.split(',') if numbers else [],
+                amount=float(amount), invoice_id=invoice_id, dedupe=True
+            ):
+                queued += 1
+        
+        app_db.log_audit(session.get('admin_id'), 'RESEND_EMAILS', 'purchases', None,
+                         new_values={'date_from': date_from, 'date_to': date_to, 'raffle_id': raffle_id, 'queued': queued})
+        logger.info(f"📧 {queued} confirmaciones reencoladas por admin {session.get('admin_id')}")
+        return jsonify({'status': 'ok', 'purchases': len(purchases), 'queued': queued})
+    except Exception as e:
+        logger.error(f"Error reencolando confirmaciones: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+# ==================== ARRANQUE ====================
+def start_background_workers():
+    """
+    Inicia los hilos de fondo de este proceso: barrido de reservas,
+    trabajos, conciliación y bandeja de salida. Lo llaman el hook
+    post_worker_init de gunicorn.conf.py y `python server.py`; importar
+    server (tests, scripts) no arranca nada que tome trabajos de la cola.
+    """
+    init_database()
+    app_db.start_reservation_sweeper()
+    if MERCADOPAGO_ACCESS_TOKEN:
+        try:
+            reconcile.schedule_next()
+        except Exception as e:
+            logger.error(f"❌ No se pudo programar la conciliación de MercadoPago: {e}")
+    jobs.start_job_workers()
+    mailer.start_email_sender()
+
+
 if __name__ == "__main__":
+    start_background_workers()
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 8080)), debug=False)
\ No newline at end of file
@@ -6,6 +6,10 @@
     // Configuración
     const CHECK_INTERVAL = 10000; // 10 segundos
 
+    // Último ETag y respuesta recibidos: permiten pedir con If-None-Match
+    let lastETag = null;
+    let lastData = null;
+
     // Elementos del DOM
     let ticket1 = null;
     let ticket2 = null;
@@ -59,7 +63,15 @@
      */
     async function updateBlessedNumbers() {
         try {
-            const response = await fetch('/api/blessed_numbers_status');
+            const response = await fetch('/api/blessed_numbers_status', {
+                cache: 'no-store',
+                headers: lastETag ? { 'If-None-Match': lastETag } : {}
+            });
+
+            if (response.status === 304 && lastData) {
+                // Sin cambios desde la última consulta
+                return;
+            }
             
             if (!response.ok) {
                 console.warn('⚠️ Error en respuesta API:', response.status);
@@ -70,6 +82,8 @@
             }
 
             const data = await response.json();
+            lastETag = response.headers.get('ETag');
+            lastData = data;
             console.log('📡 Estado de números benditos:', data);
 
             // Decidir qué mostrar
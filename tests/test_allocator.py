@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from app import db
+
+
+class AllocatorTestCase(unittest.TestCase):
+    """Asignación concurrente de números sobre SQLite temporal"""
+
+    def setUp(self):
+        self._old = (db.SQLITE_PATH, db.BITMAP_DIR, db._backend)
+        self.tmp = tempfile.mkdtemp()
+        db.SQLITE_PATH = os.path.join(self.tmp, 'rifa.db')
+        db.BITMAP_DIR = self.tmp
+        db._backend = 'sqlite'
+        db._raffles.clear()
+        db.init_db()
+
+    def tearDown(self):
+        db.SQLITE_PATH, db.BITMAP_DIR, db._backend = self._old
+        db._raffles.clear()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_concurrent_claims_have_no_duplicates(self):
+        claimed = []
+        errors = []
+        lock = threading.Lock()
+
+        def buyer(i):
+            try:
+                with db.transaction() as tx:
+                    numbers = db.claim_numbers(tx, 20, f"inv_{i}")
+                with lock:
+                    claimed.extend(numbers)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=buyer, args=(i,)) for i in range(40)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(claimed), 800)
+        self.assertEqual(len(set(claimed)), 800)
+        self.assertEqual(db.count_assigned_numbers(), 800)
+        self.assertTrue(db.check_number_bitmap()['consistent'])
+
+    def test_exhausted_pool_raises_and_rolls_back(self):
+        with db.transaction() as tx:
+            db.claim_numbers(tx, db.POOL_SIZE - 2, 'inv_big')
+        with self.assertRaises(db.NumbersUnavailable):
+            with db.transaction() as tx:
+                db.claim_numbers(tx, 3, 'inv_small')
+        row = db.run_query("SELECT COUNT(*) FROM number_pool WHERE invoice_id IS NULL", fetchone=True)
+        self.assertEqual(row[0], 2)
+
+    def test_release_returns_numbers_to_pool(self):
+        with db.transaction() as tx:
+            numbers = db.claim_numbers(tx, 4, 'inv_x')
+        with db.transaction() as tx:
+            db.release_numbers(tx, 'inv_x')
+        row = db.run_query("SELECT COUNT(*) FROM number_pool WHERE invoice_id IS NULL", fetchone=True)
+        self.assertEqual(row[0], db.POOL_SIZE)
+        self.assertEqual(len(numbers), 4)
+        self.assertEqual(db.get_number_bitmap().count(), 0)
+
+    def test_released_numbers_are_claimed_again_at_the_tail(self):
+        with db.transaction() as tx:
+            db.claim_numbers(tx, db.POOL_SIZE - 5, 'inv_big')
+        with db.transaction() as tx:
+            db.release_numbers(tx, 'inv_big')
+        with db.transaction() as tx:
+            numbers = db.claim_numbers(tx, db.POOL_SIZE, 'inv_all')
+        self.assertEqual(numbers, list(range(1, db.POOL_SIZE + 1)))
+
+    def test_raffles_have_independent_pools(self):
+        raffle_id = db.create_raffle('Rifa grande', 100000, 1000)
+        self.assertEqual(db.get_raffle(raffle_id)['pool_size'], 100000)
+        with db.transaction() as tx:
+            big = db.claim_numbers(tx, 50, 'inv_big', raffle_id)
+            small = db.claim_numbers(tx, 50, 'inv_small')
+        self.assertEqual(len(set(big)), 50)
+        self.assertTrue(all(1 <= n <= 100000 for n in big))
+        self.assertTrue(all(1 <= n <= db.POOL_SIZE for n in small))
+        self.assertEqual(db.count_assigned_numbers(raffle_id), 50)
+        self.assertEqual(db.count_assigned_numbers(), 50)
+        self.assertTrue(db.check_number_bitmap(raffle_id)['consistent'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from app.bitmap import NumberBitmap
+
+
+class NumberBitmapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'numbers.bitmap')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_set_clear_and_count(self):
+        bitmap = NumberBitmap(self.path, 2000)
+        bitmap.set_many([1, 8, 2000, 8])
+        self.assertEqual(bitmap.count(), 3)
+        self.assertTrue(bitmap.is_set(2000))
+        bitmap.clear_many([8, 9])
+        self.assertEqual(bitmap.count(), 2)
+        self.assertFalse(bitmap.is_set(8))
+        self.assertEqual(list(bitmap.taken()), [1, 2000])
+
+    def test_state_is_shared_between_instances(self):
+        first = NumberBitmap(self.path, 2000)
+        second = NumberBitmap(self.path, 2000)
+        first.set_many([5, 6])
+        self.assertTrue(second.is_set(5))
+        self.assertEqual(second.count(), 2)
+
+    def test_diff_and_load(self):
+        bitmap = NumberBitmap(self.path, 100)
+        bitmap.set_many([1, 2, 3])
+        self.assertEqual(bitmap.diff([2, 3, 4]), ([4], [1]))
+        bitmap.load([2, 3, 4])
+        self.assertEqual(bitmap.diff([2, 3, 4]), ([], []))
+        self.assertEqual(bitmap.count(), 3)
+
+
+    def test_reserved_counter_is_shared_and_bounded(self):
+        first = NumberBitmap(self.path, 100)
+        second = NumberBitmap(self.path, 100)
+        first.set_many([1, 2, 3])
+        first.add_reserved(2)
+        self.assertEqual(second.reserved_count(), 2)
+        second.add_reserved(-5)
+        self.assertEqual(first.reserved_count(), 0)
+        first.load([4, 5], reserved=1)
+        self.assertEqual((second.count(), second.reserved_count()), (2, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
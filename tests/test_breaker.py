@@ -0,0 +1,84 @@
+import unittest
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+import psycopg
+from psycopg_pool import PoolTimeout
+
+from app import db
+from app.breaker import CircuitBreaker
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure('boom')
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record_failure('boom')
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_allows_single_trial(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure('boom')
+        time.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+
+
+class FakePool:
+    """Pool de Postgres de mentira: presta `conn` o lanza `error` al pedirla"""
+
+    def __init__(self, error=None, size=1, max_size=2):
+        self.error = error
+        self.size = size
+        self.max_size = max_size
+
+    def get_stats(self):
+        return {'pool_size': self.size}
+
+    @contextmanager
+    def connection(self):
+        if self.error:
+            raise self.error
+        yield object()
+
+
+class ConnectionBreakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('postgres', failure_threshold=1, reset_timeout=60)
+        for target, value in (('_pg_breaker', self.breaker), ('get_backend', lambda: 'postgres'),
+                              ('_record_postgres_failure', self.breaker.record_failure)):
+            patcher = mock.patch.object(db, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _use(self, pool, body_error=None):
+        with mock.patch.object(db, 'get_pool', return_value=pool):
+            with self.assertRaises(Exception):
+                with db._connection():
+                    if body_error:
+                        raise body_error
+
+    def test_errors_inside_the_block_do_not_open_circuit(self):
+        self._use(FakePool(), psycopg.errors.DeadlockDetected('deadlock'))
+        self._use(FakePool(), psycopg.OperationalError('server closed the connection'))
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_saturated_pool_does_not_open_circuit(self):
+        self._use(FakePool(PoolTimeout('sin conexiones'), size=2, max_size=2))
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_failure_to_get_connection_opens_circuit(self):
+        self._use(FakePool(PoolTimeout('sin conexiones'), size=0, max_size=2))
+        self.assertEqual(self.breaker.state, 'open')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import threading
+import time
+import unittest
+
+from app.cache import TTLCache
+
+
+class TTLCacheTestCase(unittest.TestCase):
+
+    def test_concurrent_misses_run_loader_once(self):
+        cache = TTLCache('test', ttl=60)
+        calls = []
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.05)
+            return {'assigned': 10}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('p', loader))) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'assigned': 10}] * 20)
+        self.assertEqual(cache.snapshot()['misses'], 1)
+
+    def test_ttl_version_and_invalidate_force_reload(self):
+        cache = TTLCache('test', ttl=60)
+        counter = iter(range(100))
+        load = lambda: next(counter)
+
+        self.assertEqual(cache.get('p', load, version=1), 0)
+        self.assertEqual(cache.get('p', load, version=1), 0)
+        self.assertEqual(cache.get('p', load, version=2), 1)
+        cache.invalidate('p')
+        self.assertEqual(cache.get('p', load, version=2), 2)
+
+        cache.ttl = 0
+        cache.invalidate()
+        self.assertEqual(cache.get('p', load), 3)
+        self.assertEqual(cache.get('p', load), 4)
+
+    def test_invalidation_during_load_is_not_overwritten(self):
+        cache = TTLCache('test', ttl=60)
+
+        def stale_loader():
+            cache.invalidate('p')  # llega una compra mientras se consulta
+            return 'viejo'
+
+        self.assertEqual(cache.get('p', stale_loader), 'viejo')
+        self.assertEqual(cache.get('p', lambda: 'nuevo'), 'nuevo')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from flask import Flask, request
+
+from app.capture import CaptureLog, read_records, request_record
+
+
+class CaptureLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'webhooks.log.gz')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_appends_from_several_writers_are_read_in_order(self):
+        a, b = CaptureLog(self.path), CaptureLog(self.path)
+        a.append({'n': 1})
+        b.append({'n': 2, 'body': 'x_customer_name=Peña'})
+        a.append({'n': 3})
+
+        self.assertEqual([r['n'] for r in read_records(self.path)], [1, 2, 3])
+        self.assertEqual(list(read_records(self.path))[1]['body'], 'x_customer_name=Peña')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_truncated_tail_is_ignored(self):
+        log = CaptureLog(self.path)
+        log.append({'n': 1})
+        with open(self.path, 'ab') as f:
+            f.write(gzip.compress(b'{"n": 2}\n')[:12])
+
+        self.assertEqual([r['n'] for r in read_records(self.path)], [1])
+
+    def test_request_record_keeps_body_and_signature_headers(self):
+        app = Flask(__name__)
+        with app.test_request_context('/webhooks/mercadopago?data.id=7&type=payment', method='POST',
+                                      json={'type': 'payment'}, headers={'x-signature': 'ts=1,v1=abc'}):
+            record = request_record(request)
+
+        self.assertEqual(record['path'], '/webhooks/mercadopago')
+        self.assertEqual(record['query'], 'data.id=7&type=payment')
+        self.assertEqual(record['headers']['X-Signature'], 'ts=1,v1=abc')
+        self.assertEqual(record['body'], '{"type": "payment"}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import threading
+import unittest
+
+from app.events import EventHub
+
+
+class EventHubTestCase(unittest.TestCase):
+
+    def test_new_subscriber_gets_current_state_then_changes(self):
+        hub = EventHub(heartbeat=5)
+        hub.publish('progress:1', {'assigned': 4})
+        hub.publish('progress:2', {'assigned': 9})
+        stream = hub.stream({'progress:1', 'blessed'})
+
+        self.assertEqual(next(stream), "retry: 5000\n\n")
+        self.assertEqual(next(stream), 'id: 1\nevent: progress\ndata: {"assigned":4}\n\n')
+
+        # Publicar desde otro hilo despierta al suscriptor
+        threading.Timer(0.05, hub.publish, args=('blessed', {'visible': True})).start()
+        self.assertEqual(next(stream), 'id: 3\nevent: blessed\ndata: {"visible":true}\n\n')
+        self.assertEqual(hub.snapshot()['subscribers'], 1)
+        stream.close()
+        self.assertEqual(hub.snapshot()['subscribers'], 0)
+
+    def test_unchanged_payload_is_not_republished(self):
+        hub = EventHub()
+        self.assertTrue(hub.publish('blessed', {'visible': False}))
+        self.assertFalse(hub.publish('blessed', {'visible': False}))
+        self.assertEqual(hub.snapshot()['version'], 1)
+
+    def test_idle_stream_sends_heartbeat(self):
+        hub = EventHub(heartbeat=0.01)
+        stream = hub.stream({'blessed'})
+        next(stream)
+        self.assertEqual(next(stream), ": ping\n\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from app import db, idempotency
+
+
+class IdempotencyTestCase(unittest.TestCase):
+    """Reclamo atómico de eventos de pasarelas sobre SQLite temporal"""
+
+    def setUp(self):
+        self._old = (db.SQLITE_PATH, db.BITMAP_DIR, db._backend, idempotency.recent_events)
+        self.tmp = tempfile.mkdtemp()
+        db.SQLITE_PATH = os.path.join(self.tmp, 'rifa.db')
+        db.BITMAP_DIR = self.tmp
+        db._backend = 'sqlite'
+        db._raffles.clear()
+        db.init_db()
+        idempotency.recent_events = idempotency.RecentEvents(100, 60)
+
+    def tearDown(self):
+        db.SQLITE_PATH, db.BITMAP_DIR, db._backend, idempotency.recent_events = self._old
+        db._raffles.clear()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_concurrent_duplicates_process_once(self):
+        processed = []
+        barrier = threading.Barrier(10)
+
+        def notification():
+            barrier.wait()
+            try:
+                with idempotency.processing('mercadopago', '123') as claimed:
+                    if claimed:
+                        processed.append(1)
+            except idempotency.EventInFlight:
+                pass  # el trabajo se reintentaría y vería el evento terminado
+
+        threads = [threading.Thread(target=notification) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(processed, [1])
+        self.assertTrue(idempotency.is_processed('mercadopago', '123'))
+        self.assertFalse(idempotency.is_processed('epayco', '123'))
+
+    def test_failure_releases_claim_for_retry(self):
+        with self.assertRaises(RuntimeError):
+            with idempotency.processing('epayco', 'ref1') as claimed:
+                self.assertTrue(claimed)
+                raise RuntimeError('db caída')
+        self.assertFalse(idempotency.is_processed('epayco', 'ref1'))
+        self.assertEqual(idempotency.claim_event('epayco', 'ref1'), idempotency.CLAIMED)
+        # Reclamado por otro worker (sin vencer): no se puede tomar; vencido sí
+        self.assertEqual(idempotency.claim_event('epayco', 'ref1'), idempotency.IN_FLIGHT)
+        self.assertEqual(idempotency.claim_event('epayco', 'ref1', lease=-1), idempotency.CLAIMED)
+
+    def test_live_claim_of_another_worker_is_retried_not_skipped(self):
+        self.assertEqual(idempotency.claim_event('mercadopago', '77'), idempotency.CLAIMED)
+        # El worker que lo reclamó murió: el reintento del trabajo no debe darlo por hecho
+        with self.assertRaises(idempotency.EventInFlight):
+            with idempotency.processing('mercadopago', '77'):
+                self.fail('no debe procesarse con el reclamo vivo')
+        self.assertFalse(idempotency.is_processed('mercadopago', '77'))
+
+        idempotency.complete_event('mercadopago', '77')
+        idempotency.recent_events = idempotency.RecentEvents(100, 60)
+        self.assertEqual(idempotency.claim_event('mercadopago', '77'), idempotency.DONE)
+        with idempotency.processing('mercadopago', '77') as claimed:
+            self.assertFalse(claimed)
+
+    def test_hot_cache_answers_without_database(self):
+        idempotency.complete_event('mercadopago', '9')
+        db._backend = 'postgres'  # cualquier consulta fallaría
+        try:
+            self.assertTrue(idempotency.is_processed('mercadopago', '9'))
+        finally:
+            db._backend = 'sqlite'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from app import db, jobs
+
+
+class JobQueueTestCase(unittest.TestCase):
+    """Cola de trabajos durable sobre SQLite temporal"""
+
+    def setUp(self):
+        self._old = (db.SQLITE_PATH, db.BITMAP_DIR, db._backend, dict(jobs._handlers), jobs.JOB_BACKOFF_BASE)
+        self.tmp = tempfile.mkdtemp()
+        db.SQLITE_PATH = os.path.join(self.tmp, 'rifa.db')
+        db.BITMAP_DIR = self.tmp
+        db._backend = 'sqlite'
+        db._raffles.clear()
+        db.init_db()
+        jobs.JOB_BACKOFF_BASE = 0
+
+    def tearDown(self):
+        db.SQLITE_PATH, db.BITMAP_DIR, db._backend, handlers, jobs.JOB_BACKOFF_BASE = self._old
+        jobs._handlers.clear()
+        jobs._handlers.update(handlers)
+        db._raffles.clear()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _status(self, job_id):
+        return db.run_query("SELECT status, attempts, last_error FROM jobs WHERE id = %s",
+                            params=(job_id,), fetchone=True)
+
+    def test_pending_duplicate_is_absorbed_and_job_runs_once(self):
+        seen = []
+        jobs.register('test', seen.append)
+        job_id = jobs.enqueue('test', {'payment_id': 1}, dedupe_key='mp:1')
+        self.assertIsNone(jobs.enqueue('test', {'payment_id': 1}, dedupe_key='mp:1'))
+
+        self.assertEqual(jobs.run_pending('test'), 1)
+        self.assertEqual(seen, [{'payment_id': 1}])
+        self.assertEqual(self._status(job_id)[0], 'done')
+        # Terminado el anterior, una notificación nueva vuelve a encolarse
+        self.assertIsNotNone(jobs.enqueue('test', {'payment_id': 1}, dedupe_key='mp:1'))
+
+    def test_concurrent_duplicates_insert_one_job(self):
+        barrier = threading.Barrier(8)
+        ids = []
+
+        def notification():
+            barrier.wait()
+            ids.append(jobs.enqueue('test', {'payment_id': 2}, dedupe_key='mp:2'))
+
+        threads = [threading.Thread(target=notification) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len([job_id for job_id in ids if job_id is not None]), 1)
+        # La base misma rechaza un segundo trabajo activo con la misma clave
+        with self.assertRaises(sqlite3.IntegrityError):
+            db.run_query("INSERT INTO jobs (kind, payload, dedupe_key) VALUES ('test', '{}', 'mp:2')", commit=True)
+
+    def test_failures_retry_then_dead_letter(self):
+        calls = []
+
+        def flaky(payload):
+            calls.append(payload)
+            raise RuntimeError('gateway caído')
+
+        jobs.register('test', flaky, max_attempts=3)
+        job_id = jobs.enqueue('test', {})
+        for _ in range(5):
+            jobs.run_pending('test')
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self._status(job_id), ('dead', 3, 'gateway caído'))
+        self.assertEqual(jobs.get_job_stats()['counts'], {'test': {'dead': 1}})
+
+        self.assertTrue(jobs.retry_job(job_id))
+        self.assertEqual(self._status(job_id)[0], 'pending')
+
+    def test_permanent_error_skips_retries(self):
+        def invalid(payload):
+            raise jobs.PermanentJobError('rifa inválida')
+
+        jobs.register('test', invalid)
+        job_id = jobs.enqueue('test', {})
+        jobs.run_pending('test')
+        self.assertEqual(self._status(job_id)[:2], ('dead', 1))
+
+    def test_concurrent_claims_and_expired_lease(self):
+        jobs.register('test', lambda payload: None)
+        for i in range(30):
+            jobs.enqueue('test', {'i': i})
+
+        claimed = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                batch = jobs.claim_jobs('test', 2)
+                if not batch:
+                    return
+                with lock:
+                    claimed.extend(job['id'] for job in batch)
+
+        threads = [threading.Thread(target=worker) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(claimed), 30)
+        self.assertEqual(len(set(claimed)), 30)
+
+        # Un worker que murió sin terminar: al vencer el lease otro lo retoma
+        db.run_query("UPDATE jobs SET locked_until = %s WHERE id = %s",
+                     params=(datetime.now() - timedelta(seconds=1), claimed[0]), commit=True)
+        retaken = jobs.claim_jobs('test', 5)
+        self.assertEqual([job['id'] for job in retaken], [claimed[0]])
+        self.assertEqual(retaken[0]['attempts'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
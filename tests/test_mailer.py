@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from app import db, mailer
+
+
+class MailerTestCase(unittest.TestCase):
+    """Bandeja de salida de emails sobre SQLite temporal"""
+
+    def setUp(self):
+        self._old = (db.SQLITE_PATH, db.BITMAP_DIR, db._backend, mailer._transport, mailer.send_bucket)
+        self.tmp = tempfile.mkdtemp()
+        db.SQLITE_PATH = os.path.join(self.tmp, 'rifa.db')
+        db.BITMAP_DIR = self.tmp
+        db._backend = 'sqlite'
+        db._raffles.clear()
+        db.init_db()
+        mailer.send_bucket = mailer.TokenBucket(1000, 1000)
+        self.batches = []
+
+    def tearDown(self):
+        db.SQLITE_PATH, db.BITMAP_DIR, db._backend, mailer._transport, mailer.send_bucket = self._old
+        db._raffles.clear()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _rows(self):
+        return db.run_query("SELECT to_email, status, attempts, message_id FROM email_outbox ORDER BY id",
+                            fetchall=True)
+
+    def _enqueue(self, *emails):
+        return [mailer.enqueue_email(email, 'Asunto', '<p>Hola</p>', kind='test', ref=email) for email in emails]
+
+    def test_pending_emails_go_out_in_one_batch_with_message_ids(self):
+        def transport(emails):
+            self.batches.append([e['to_email'] for e in emails])
+            return [f"<id-{e['id']}>" for e in emails]
+
+        mailer.set_transport(transport)
+        ids = self._enqueue('a@x.co', 'b@x.co', 'c@x.co')
+
+        self.assertEqual(mailer.run_pending(), 3)
+        self.assertEqual(self.batches, [['a@x.co', 'b@x.co', 'c@x.co']])
+        self.assertEqual(self._rows(), [
+            ('a@x.co', 'sent', 1, f'<id-{ids[0]}>'),
+            ('b@x.co', 'sent', 1, f'<id-{ids[1]}>'),
+            ('c@x.co', 'sent', 1, f'<id-{ids[2]}>'),
+        ])
+
+    def test_transient_failure_is_rescheduled(self):
+        def down(emails):
+            raise mailer.TransientEmailError('Brevo 503')
+
+        mailer.set_transport(down)
+        self._enqueue('a@x.co')
+
+        self.assertEqual(mailer.run_pending(), 0)
+        self.assertEqual(self._rows()[0][:3], ('a@x.co', 'pending', 1))
+        # Con backoff no vuelve a estar listo de inmediato
+        self.assertEqual(mailer.claim_emails(), [])
+
+    def test_rejected_batch_is_split_so_only_bad_address_dies(self):
+        def transport(emails):
+            self.batches.append(len(emails))
+            if any(e['to_email'] == 'bad' for e in emails):
+                raise mailer.PermanentEmailError('Brevo 400: invalid email')
+            return ['<ok>'] * len(emails)
+
+        mailer.set_transport(transport)
+        self._enqueue('a@x.co', 'bad', 'c@x.co')
+
+        self.assertEqual(mailer.run_pending(), 2)
+        self.assertEqual(self.batches, [3, 1, 1, 1])
+        self.assertEqual([row[1] for row in self._rows()], ['sent', 'dead', 'sent'])
+
+    def test_dedupe_skips_email_still_pending(self):
+        self.assertIsNotNone(mailer.enqueue_email('a@x.co', 'S', '<p/>', kind='purchase_confirmation', ref='inv-1'))
+        self.assertIsNone(mailer.enqueue_email('a@x.co', 'S', '<p/>', kind='purchase_confirmation', ref='inv-1',
+                                               dedupe=True))
+        self.assertEqual(len(self._rows()), 1)
+
+    def test_token_bucket_waits_when_empty(self):
+        bucket = mailer.TokenBucket(rate=10, capacity=2)
+        with mock.patch.object(mailer.time, 'sleep') as sleep:
+            bucket.acquire(2)
+            sleep.assert_not_called()
+            sleep.side_effect = lambda seconds: setattr(bucket, '_tokens', bucket.capacity)
+            bucket.acquire(1)
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.1, places=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from app import outbound
+from app.breaker import CircuitBreaker, CircuitOpenError
+from app.outbound import MercadoPagoHttpClient, OutboundClient, endpoint_name
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Responde con la siguiente respuesta programada en server.responses"""
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.server.requests.append((self.command, self.path))
+        status, body = self.server.responses.pop(0) if self.server.responses else (200, {'ok': True})
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class OutboundClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.responses = []
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        # Sin esperas reales entre reintentos
+        patcher = mock.patch.object(outbound.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_retries_server_errors_and_records_stats(self):
+        client = OutboundClient('stub', base_url=self.base_url, retries=2)
+        self.server.responses = [(503, {}), (502, {}), (200, {'id': 7})]
+
+        response = client.request('GET', '/v1/payments/7')
+
+        self.assertEqual(response.json(), {'id': 7})
+        self.assertEqual(len(self.server.requests), 3)
+        stats = client.snapshot()['endpoints']['GET /v1/payments/:id']
+        self.assertEqual((stats['calls'], stats['errors'], stats['retries']), (3, 2, 2))
+        self.assertEqual(stats['statuses'], {503: 1, 502: 1, 200: 1})
+
+    def test_post_is_not_retried_after_reaching_server(self):
+        client = OutboundClient('stub', base_url=self.base_url, retries=2)
+        self.server.responses = [(500, {})]
+
+        response = client.request('POST', '/smtp/email', json={'to': []})
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_open_circuit_fails_fast(self):
+        breaker = CircuitBreaker('stub', failure_threshold=2, reset_timeout=60)
+        client = OutboundClient('stub', base_url=self.base_url, retries=0, breaker=breaker)
+        self.server.responses = [(500, {}), (500, {})]
+        client.request('GET', '/a')
+        client.request('GET', '/a')
+
+        with self.assertRaises(CircuitOpenError):
+            client.request('GET', '/a')
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(client.snapshot()['breaker']['state'], 'open')
+
+    def test_connection_refused_is_retried_then_raised(self):
+        client = OutboundClient('stub', base_url='http://127.0.0.1:1', retries=1)
+        with self.assertRaises(outbound.requests.ConnectionError):
+            client.request('POST', '/smtp/email', json={})
+        stats = client.snapshot()['endpoints']['POST /smtp/email']
+        self.assertEqual((stats['calls'], stats['errors'], stats['retries']), (2, 2, 1))
+
+    def test_mercadopago_adapter_returns_sdk_shape(self):
+        adapter = MercadoPagoHttpClient(OutboundClient('stub', base_url=self.base_url))
+        self.server.responses = [(201, {'id': 'pref-1'})]
+
+        result = adapter.post(self.base_url + '/checkout/preferences', headers={}, data='{}', timeout=60.0, maxretries=3)
+
+        self.assertEqual(result, {'status': 201, 'response': {'id': 'pref-1'}})
+
+    def test_endpoint_name_groups_ids(self):
+        self.assertEqual(endpoint_name('GET', 'https://api.mercadopago.com/v1/payments/123?x=1'), 'GET /v1/payments/:id')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,30 @@
+import os
+import shutil
+import tempfile
 import unittest
+
+import server
+from app import db
 from server import app
 
 
 class ProgressTestCase(unittest.TestCase):
     def setUp(self):
+        self._old = (db.SQLITE_PATH, db.BITMAP_DIR, db._backend, server._db_initialized)
+        self.tmp = tempfile.mkdtemp()
+        db.SQLITE_PATH = os.path.join(self.tmp, 'rifa.db')
+        db.BITMAP_DIR = self.tmp
+        db._backend = 'sqlite'
+        db._raffles.clear()
+        server._db_initialized = False
+        server.progress_cache.invalidate()
         self.client = app.test_client()
 
+    def tearDown(self):
+        db.SQLITE_PATH, db.BITMAP_DIR, db._backend, server._db_initialized = self._old
+        db._raffles.clear()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
     def test_progress_endpoint(self):
         resp = self.client.get('/progress')
         self.assertEqual(resp.status_code, 200)
@@ -27,36 +46,23 @@ class ProgressTestCase(unittest.TestCase):
         self.assertTrue('invoice_id' in data)
         self.assertTrue('numbers' in data)
 
+    def test_purchase_and_its_email_commit_together(self):
+        server.init_database()
+        db.reserve_numbers(0, 'rifa_ch_under', numbers=[1, 2, 3])
+        with self.assertRaises(db.ReservationUnderpaid):
+            server.save_purchase('rifa_ch_under', 1000, 'b@demo.com', full_name='Beto')
 
-if __name__ == '__main__':
-    unittest.main()
-import unittest
-from server import app
+        numbers = server.save_purchase('sim_email', 25000, 'a@demo.com', quantity=4, full_name='Ana')
+        self.assertEqual(len(numbers), 4)
+        # El pago insuficiente no dejó compra ni email; la compra confirmada, exactamente uno
+        rows = db.run_query("SELECT ref, to_email FROM email_outbox ORDER BY id", fetchall=True)
+        self.assertEqual(rows, [('sim_email', 'a@demo.com')])
 
-class ProgressTestCase(unittest.TestCase):
-    def setUp(self):
-        self.client = app.test_client()
+    def test_import_does_not_start_background_workers(self):
+        from app import jobs, mailer
+        self.assertNotEqual(jobs._workers_pid, os.getpid())
+        self.assertNotEqual(mailer._sender_pid, os.getpid())
 
-    def test_progress_endpoint(self):
-        resp = self.client.get('/progress')
-        self.assertEqual(resp.status_code, 200)
-        data = resp.get_json()
-        self.assertIn('assigned', data)
-        self.assertIn('total', data)
-        self.assertIn('percentage', data)
-
-    def test_simulate_purchase(self):
-        # Simula una compra admin
-        resp = self.client.post('/admin/simulate_purchase', data={
-            'key': 'CLAVEADMIN',
-            'amount': 4,
-            'email': 'test@demo.com'
-        })
-        self.assertEqual(resp.status_code, 200)
-        data = resp.get_json()
-        self.assertEqual(data['status'], 'ok')
-        self.assertTrue('invoice_id' in data)
-        self.assertTrue('numbers' in data)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,151 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from app import db, jobs, reconcile
+from app.outbound import OutboundClient
+
+
+class PaymentsSearchStub(BaseHTTPRequestHandler):
+    """Imita GET /v1/payments/search de MercadoPago con paginación limit/offset"""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.server.requests.append(query)
+        if url.path != '/v1/payments/search' or self.headers.get('Authorization') != 'Bearer TEST-token':
+            self.send_response(401)
+            self.end_headers()
+            return
+        payments = [p for p in self.server.payments if p['status'] == query.get('status', p['status'])]
+        offset, limit = int(query['offset']), int(query['limit'])
+        body = json.dumps({
+            'paging': {'total': len(payments), 'limit': limit, 'offset': offset},
+            'results': payments[offset:offset + limit],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReconcileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._old = (db.SQLITE_PATH, db.BITMAP_DIR, db._backend, reconcile.MP_RECONCILE_PAGE_SIZE)
+        self._handlers = dict(jobs._handlers)
+        self.tmp = tempfile.mkdtemp()
+        db.SQLITE_PATH = os.path.join(self.tmp, 'rifa.db')
+        db.BITMAP_DIR = self.tmp
+        db._backend = 'sqlite'
+        db._raffles.clear()
+        db.init_db()
+        reconcile.MP_RECONCILE_PAGE_SIZE = 2
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PaymentsSearchStub)
+        self.server.requests = []
+        self.server.payments = [
+            {'id': 101, 'status': 'approved', 'external_reference': 'rifa_mp_aaa'},
+            {'id': 102, 'status': 'approved', 'external_reference': 'rifa_mp_bbb'},
+            {'id': 103, 'status': 'rejected', 'external_reference': 'rifa_mp_ccc'},
+            {'id': 104, 'status': 'approved', 'external_reference': 'otra_app_1'},
+            {'id': 105, 'status': 'approved', 'external_reference': 'rifa_mp_ddd'},
+            {'id': 106, 'status': 'approved', 'external_reference': 'rifa_mp_eee'},
+        ]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = OutboundClient('mp-stub', base_url=f'http://127.0.0.1:{self.server.server_address[1]}')
+
+        # rifa_mp_aaa llegó por webhook; rifa_mp_ddd la eliminó un admin
+        db.run_query(
+            "INSERT INTO purchases (invoice_id, amount, email, numbers, status) VALUES (%s, 25000, 'a@x.co', '1', 'confirmed')",
+            params=('rifa_mp_aaa',), commit=True
+        )
+        db.run_query(
+            "INSERT INTO purchases (invoice_id, amount, email, numbers, status) VALUES (%s, 25000, 'd@x.co', '2', 'deleted')",
+            params=('rifa_mp_ddd',), commit=True
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        db.SQLITE_PATH, db.BITMAP_DIR, db._backend, reconcile.MP_RECONCILE_PAGE_SIZE = self._old
+        jobs._handlers.clear()
+        jobs._handlers.update(self._handlers)
+        db._raffles.clear()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _queued(self):
+        rows = db.run_query("SELECT payload, dedupe_key FROM jobs WHERE kind = 'mercadopago_payment' ORDER BY id",
+                            fetchall=True) or []
+        return [(json.loads(payload)['payment_id'], key) for payload, key in rows]
+
+    def test_only_missing_approved_payments_are_enqueued(self):
+        result = reconcile.reconcile_payments(self.client, 'TEST-token', now=datetime.now(timezone.utc))
+
+        self.assertEqual(result['missing'], ['rifa_mp_bbb', 'rifa_mp_eee'])
+        self.assertEqual(self._queued(), [(102, 'mercadopago:102'), (106, 'mercadopago:106')])
+        # 5 aprobados en páginas de 2: tres llamadas, ninguna por compra
+        self.assertEqual([int(q['offset']) for q in self.server.requests], [0, 2, 4])
+
+    def test_chosen_number_payments_are_reconciled(self):
+        self.server.payments.append({'id': 107, 'status': 'approved', 'external_reference': 'rifa_ch_fff'})
+        result = reconcile.reconcile_payments(self.client, 'TEST-token')
+
+        self.assertEqual(result['missing'], ['rifa_mp_bbb', 'rifa_mp_eee', 'rifa_ch_fff'])
+        self.assertIn((107, 'mercadopago:107'), self._queued())
+
+    def test_second_run_does_not_duplicate_pending_jobs(self):
+        reconcile.reconcile_payments(self.client, 'TEST-token')
+        result = reconcile.reconcile_payments(self.client, 'TEST-token')
+
+        self.assertEqual(result['enqueued'], 0)
+        self.assertEqual(len(self._queued()), 2)
+
+    def test_dead_lettered_payment_is_not_requeued(self):
+        jobs.register('mercadopago_payment', self._fail_permanently)
+        reconcile.reconcile_payments(self.client, 'TEST-token')
+        self.assertEqual(jobs.run_pending('mercadopago_payment'), 2)
+
+        for _ in range(2):
+            result = reconcile.reconcile_payments(self.client, 'TEST-token')
+            self.assertEqual(result['missing'], ['rifa_mp_bbb', 'rifa_mp_eee'])
+            self.assertEqual(result['skipped'], ['rifa_mp_bbb', 'rifa_mp_eee'])
+            self.assertEqual(result['enqueued'], 0)
+        self.assertEqual(jobs.claim_jobs('mercadopago_payment'), [])
+
+    def test_processed_event_is_not_requeued(self):
+        db.run_query(
+            "INSERT INTO processed_events (gateway, event_id, status, claimed_at) VALUES ('mercadopago', '102', 'done', %s)",
+            params=(datetime.now(),), commit=True
+        )
+        result = reconcile.reconcile_payments(self.client, 'TEST-token')
+        self.assertEqual(result['skipped'], ['rifa_mp_bbb'])
+        self.assertEqual(self._queued(), [(106, 'mercadopago:106')])
+
+    @staticmethod
+    def _fail_permanently(payload):
+        raise jobs.PermanentJobError('números agotados')
+
+    def test_search_error_raises_so_the_job_retries(self):
+        with self.assertRaises(RuntimeError):
+            reconcile.reconcile_payments(self.client, 'wrong-token')
+        self.assertEqual(self._queued(), [])
+
+    def test_schedule_next_is_deduplicated_per_interval(self):
+        self.assertIsNotNone(reconcile.schedule_next(interval=3600))
+        self.assertIsNone(reconcile.schedule_next(interval=3600))
+        self.assertEqual(jobs.claim_jobs(reconcile.RECONCILE_KIND), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
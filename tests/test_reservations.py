@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import db
+
+
+class ReservationsTestCase(unittest.TestCase):
+    """Reservas de checkout con vencimiento sobre SQLite temporal"""
+
+    def setUp(self):
+        self._old = (db.SQLITE_PATH, db.BITMAP_DIR, db._backend)
+        self.tmp = tempfile.mkdtemp()
+        db.SQLITE_PATH = os.path.join(self.tmp, 'rifa.db')
+        db.BITMAP_DIR = self.tmp
+        db._backend = 'sqlite'
+        db._raffles.clear()
+        db.init_db()
+
+    def tearDown(self):
+        db.SQLITE_PATH, db.BITMAP_DIR, db._backend = self._old
+        db._raffles.clear()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_reserved_numbers_are_counted_apart_from_confirmed(self):
+        numbers, _ = db.reserve_numbers(4, 'inv_r')
+        self.assertEqual(len(numbers), 4)
+        self.assertEqual(db.count_reserved_numbers(), 4)
+        self.assertEqual(db.count_assigned_numbers(), 0)
+        self.assertEqual(db.get_number_bitmap().count(), 4)
+        self.assertEqual(db.get_number_bitmap().reserved_count(), 4)
+
+    def test_confirm_turns_reservation_into_assignment(self):
+        numbers, _ = db.reserve_numbers(3, 'inv_r')
+        with db.transaction() as tx:
+            confirmed = db.confirm_reservation(tx, 'inv_r', 'ref_payco_1')
+        self.assertEqual(confirmed, sorted(numbers))
+        self.assertEqual(db.count_reserved_numbers(), 0)
+        self.assertEqual(db.get_number_bitmap().reserved_count(), 0)
+        self.assertEqual(db.count_assigned_numbers(), 3)
+        row = db.run_query("SELECT COUNT(*) FROM number_pool WHERE invoice_id = %s",
+                           params=('ref_payco_1',), fetchone=True)
+        self.assertEqual(row[0], 3)
+        # Ya no hay reserva que confirmar
+        with db.transaction() as tx:
+            self.assertEqual(db.confirm_reservation(tx, 'inv_r'), [])
+
+    def test_confirm_keeps_only_what_the_payment_covers(self):
+        numbers, _ = db.reserve_numbers(20, 'inv_big')
+        with db.transaction() as tx:
+            confirmed = db.confirm_reservation(tx, 'inv_big', 'ref_1', max_count=1)
+        self.assertEqual(confirmed, sorted(numbers)[:1])
+        self.assertEqual(db.count_reserved_numbers(), 0)
+        self.assertEqual(db.get_number_bitmap().count(), 1)
+        row = db.run_query("SELECT COUNT(*) FROM number_pool WHERE invoice_id IS NULL", fetchone=True)
+        self.assertEqual(row[0], db.POOL_SIZE - 1)
+        self.assertTrue(db.check_number_bitmap()['consistent'])
+
+    def test_sweeper_releases_only_expired_holds(self):
+        db.reserve_numbers(5, 'inv_old', minutes=-1)
+        db.reserve_numbers(2, 'inv_new')
+        self.assertEqual(db.release_expired_reservations(batch=2), 5)
+        self.assertEqual(db.count_reserved_numbers(), 2)
+        self.assertEqual(db.get_number_bitmap().reserved_count(), 2)
+        self.assertEqual(db.get_number_bitmap().count(), 2)
+        self.assertTrue(db.check_number_bitmap()['consistent'])
+
+    def test_holds_per_client_are_capped(self):
+        self.addCleanup(setattr, db, 'MAX_HOLDS_PER_CLIENT', db.MAX_HOLDS_PER_CLIENT)
+        db.MAX_HOLDS_PER_CLIENT = 10
+        db.reserve_numbers(6, 'inv_a', held_by='ip:1.2.3.4')
+        with self.assertRaises(db.TooManyHolds):
+            db.reserve_numbers(5, 'inv_b', held_by='ip:1.2.3.4')
+        with self.assertRaises(db.TooManyHolds):
+            db.reserve_numbers(0, 'inv_c', held_by='ip:1.2.3.4', numbers=[1, 2, 3, 4, 5])
+        self.assertEqual(db.count_reserved_numbers(), 6)
+        # Otro cliente no se ve afectado
+        db.reserve_numbers(10, 'inv_d', held_by='ip:5.6.7.8')
+
+        # Lo confirmado o vencido ya no cuenta como apartado
+        with db.transaction() as tx:
+            db.confirm_reservation(tx, 'inv_a')
+        db.reserve_numbers(4, 'inv_e', held_by='ip:1.2.3.4', minutes=-1)
+        db.reserve_numbers(10, 'inv_f', held_by='ip:1.2.3.4')
+
+    def test_cancel_reservation_returns_numbers(self):
+        db.reserve_numbers(6, 'inv_c')
+        self.assertEqual(db.cancel_reservation('inv_c'), 6)
+        row = db.run_query("SELECT COUNT(*) FROM number_pool WHERE invoice_id IS NULL", fetchone=True)
+        self.assertEqual(row[0], db.POOL_SIZE)
+
+    def test_chosen_numbers_conflict_reports_taken(self):
+        numbers, _ = db.reserve_numbers(3, 'inv_a', numbers=[7, 8, 9])
+        self.assertEqual(numbers, [7, 8, 9])
+        with self.assertRaises(db.NumbersTaken) as ctx:
+            db.reserve_numbers(2, 'inv_b', numbers=[9, 10])
+        self.assertEqual(ctx.exception.numbers, [9])
+        # El asignador al azar nunca entrega un número elegido
+        with db.transaction() as tx:
+            random_numbers = db.claim_numbers(tx, db.POOL_SIZE - 3, 'inv_rest')
+        self.assertFalse({7, 8, 9} & set(random_numbers))
+        self.assertEqual(db.get_reservation('inv_a')['numbers'], [7, 8, 9])
+
+    def test_chosen_numbers_conflict_is_checked_in_the_database(self):
+        db.reserve_numbers(1, 'inv_a', numbers=[42])
+        db.get_number_bitmap().clear_many([42])  # bitmap desactualizado
+        with self.assertRaises(db.NumbersTaken):
+            db.reserve_numbers(1, 'inv_b', numbers=[42])
+
+
+if __name__ == '__main__':
+    unittest.main()
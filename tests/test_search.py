@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import db, search
+
+
+class SearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._old = (db.SQLITE_PATH, db.BITMAP_DIR, db._backend)
+        self.tmp = tempfile.mkdtemp()
+        db.SQLITE_PATH = os.path.join(self.tmp, 'rifa.db')
+        db.BITMAP_DIR = self.tmp
+        db._backend = 'sqlite'
+        db._raffles.clear()
+        search._support.clear()
+        db.init_db()
+
+        self._add('inv-1', 'Ana María Pérez', 'ana@correo.co', '3001112233', '1020304050', '12, 450')
+        self._add('inv-2', 'Carlos Ruiz', 'carlos@correo.co', '3104445566', '7788990011', '123, 7')
+        self._add('inv-3', 'Mariana Gómez', 'mgomez@otro.com', '3207778899', '5566778899', '99')
+
+    def tearDown(self):
+        db.SQLITE_PATH, db.BITMAP_DIR, db._backend = self._old
+        db._raffles.clear()
+        search._support.clear()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _add(self, invoice_id, full_name, email, phone, document_number, numbers, status='confirmed'):
+        with db.transaction() as tx:
+            tx.execute(
+                "INSERT INTO purchases (invoice_id, amount, email, numbers, status, full_name, phone, document_number) "
+                "VALUES (%s, 25000, %s, %s, %s, %s, %s, %s)",
+                params=(invoice_id, email, numbers, status, full_name, phone, document_number)
+            )
+            tx.executemany(
+                "INSERT INTO assigned_numbers (raffle_id, number, invoice_id, is_confirmed) VALUES (1, %s, %s, TRUE)",
+                [(int(n), invoice_id) for n in numbers.split(',')]
+            )
+
+    def _invoices(self, q, **filters):
+        return [row[1] for row in search.search_purchases(q, **filters)['rows']]
+
+    def test_uses_fts_index_and_matches_substrings(self):
+        self.assertTrue(search.index_support())
+        self.assertEqual(self._invoices('correo.co'), ['inv-2', 'inv-1'])
+        self.assertEqual(self._invoices('RUIZ'), ['inv-2'])
+        self.assertEqual(self._invoices('4445'), ['inv-2'])
+
+    def test_number_lookup_is_exact(self):
+        self.assertEqual(search.number_owner(12), 'inv-1')
+        self.assertIsNone(search.number_owner(12, raffle_id=2))
+        self.assertEqual(self._invoices('012'), ['inv-1'])
+        self.assertEqual(self._invoices('123'), ['inv-2'])
+        self.assertEqual(self._invoices('450'), ['inv-1'])
+        self.assertEqual(self._invoices('451'), [])
+
+    def test_number_hit_ranks_before_text_matches(self):
+        # 778 es número de inv-3 y también aparece en teléfonos/documentos
+        self._add('inv-4', 'Luis Mora', 'luis@correo.co', '3150000000', '9990000000', '778')
+        self.assertEqual(self._invoices('778')[0], 'inv-4')
+        self.assertEqual(sorted(self._invoices('778')), ['inv-2', 'inv-3', 'inv-4'])
+
+    def test_renamed_invoice_keeps_its_numbers(self):
+        purchase_id = db.run_query("SELECT id FROM purchases WHERE invoice_id = 'inv-2'", fetchone=True)[0]
+        self.assertTrue(db.update_purchase(purchase_id, 'inv-2b', 25000, 'carlos@correo.co', '123, 7', 'confirmed',
+                                           full_name='Carlos Ruiz'))
+        self.assertEqual(search.number_owner(123), 'inv-2b')
+        self.assertEqual(self._invoices('123'), ['inv-2b'])
+        self.assertEqual(self._invoices('ruiz'), ['inv-2b'])
+
+    def test_index_follows_updates_and_deletes(self):
+        db.run_query("UPDATE purchases SET full_name = 'Ana Torres' WHERE invoice_id = 'inv-1'", commit=True)
+        self.assertEqual(self._invoices('pérez'), [])
+        self.assertEqual(self._invoices('torres'), ['inv-1'])
+
+        db.run_query("DELETE FROM purchases WHERE invoice_id = 'inv-3'", commit=True)
+        self.assertEqual(self._invoices('mgomez'), [])
+
+    def test_better_match_ranks_first(self):
+        self._add('inv-4', 'Pedro Mariana', 'mariana.mariana@correo.co', '3000000000', '1111111111', '5')
+        self.assertEqual(self._invoices('mariana')[0], 'inv-4')
+        self.assertEqual(sorted(self._invoices('mariana')), ['inv-3', 'inv-4'])
+
+    def test_short_number_is_only_a_ticket_lookup(self):
+        # '7' es el número de inv-2; que aparezca en el teléfono de inv-3 no cuenta
+        self.assertEqual(self._invoices('7'), ['inv-2'])
+        self.assertEqual(self._invoices('07'), ['inv-2'])
+        self.assertEqual(search.search_purchases('8')['total'], 0)
+        self.assertEqual(self._invoices('7', status='pending'), [])
+
+    def test_short_query_and_filters_fall_back_to_like(self):
+        self.assertEqual(self._invoices('ru'), ['inv-2'])
+        self.assertEqual(self._invoices('%'), [])
+        self.assertEqual(self._invoices('co', status='pending'), [])
+
+        db.run_query("UPDATE purchases SET status = 'deleted' WHERE invoice_id = 'inv-2'", commit=True)
+        self.assertEqual(self._invoices('carlos'), [])
+
+
+    def test_keyset_pages_cover_every_purchase_once(self):
+        for i in range(4, 12):
+            self._add(f'inv-{i}', f'Comprador {i}', f'c{i}@x.co', '3000000000', '1', str(100 + i))
+        # Misma marca de tiempo para varias filas: el id desempata
+        db.run_query("UPDATE purchases SET created_at = '2000-01-01 10:00:00' WHERE id <= 6", commit=True)
+
+        seen, cursor = [], None
+        while True:
+            page = search.search_purchases(limit=3, cursor=cursor)
+            self.assertEqual((page['total'], page['total_exact'], page['ranked']), (11, True, False))
+            seen.extend(row[0] for row in page['rows'])
+            cursor = page['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, sorted(seen, key=lambda pid: (pid > 6, pid), reverse=True))
+        self.assertEqual(len(seen), 11)
+
+    def test_search_results_are_not_paginated_and_bad_cursor_restarts(self):
+        page = search.search_purchases('correo.co', limit=1, cursor='basura')
+        self.assertEqual((len(page['rows']), page['total'], page['next_cursor']), (1, 2, None))
+
+        first = search.search_purchases(limit=2)
+        self.assertEqual(search.search_purchases(limit=2, cursor='!!no-es-un-cursor')['rows'], first['rows'])
+        self.assertEqual(search.page_size('9999'), search.MAX_PAGE_SIZE)
+        self.assertEqual(search.page_size('x'), search.PAGE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
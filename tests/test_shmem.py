@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+
+from app.shmem import MappedFile
+
+
+class MappedFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'shared.bin')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_init_sees_previous_size_and_writes_are_shared(self):
+        sizes = []
+
+        def init(mm, previous_size):
+            sizes.append(previous_size)
+            if previous_size < len(mm):
+                mm[:4] = b'RIFA'
+
+        a = MappedFile(self.path, 16, init=init)
+        b = MappedFile(self.path, 16, init=init)
+        self.assertEqual(sizes, [0, 16])
+        self.assertEqual(os.path.getsize(self.path), 16)
+
+        with a.lock():
+            a.mm[4] = 7
+        self.assertEqual(bytes(b.mm[:5]), b'RIFA\x07')
+        a.close()
+        b.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import db
+
+
+class RaffleStatsTestCase(unittest.TestCase):
+    """Agregados de raffle_stats sobre SQLite temporal"""
+
+    def setUp(self):
+        self._old = (db.SQLITE_PATH, db.BITMAP_DIR, db._backend)
+        self.tmp = tempfile.mkdtemp()
+        db.SQLITE_PATH = os.path.join(self.tmp, 'rifa.db')
+        db.BITMAP_DIR = self.tmp
+        db._backend = 'sqlite'
+        db._raffles.clear()
+        db.init_db()
+
+    def tearDown(self):
+        db.SQLITE_PATH, db.BITMAP_DIR, db._backend = self._old
+        db._raffles.clear()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _confirm(self, invoice_id, amount, count):
+        with db.transaction() as tx:
+            numbers = db.claim_numbers(tx, count, invoice_id)
+            tx.execute(
+                "INSERT INTO purchases (invoice_id, raffle_id, amount, email, numbers, status) VALUES (%s, 1, %s, %s, %s, 'confirmed')",
+                params=(invoice_id, amount, 'a@b.co', ','.join(map(str, numbers)))
+            )
+            db.add_purchase_stats(tx, invoice_id)
+
+    def test_confirm_and_delete_keep_stats_in_sync(self):
+        self._confirm('inv_1', 25000, 4)
+        self._confirm('inv_2', 25000, 4)
+        self._confirm('inv_3', 53000, 8)
+
+        stats = db.get_raffle_stats()
+        self.assertEqual(stats['confirmed_numbers'], 16)
+        self.assertEqual(stats['confirmed_purchases'], 3)
+        self.assertEqual(stats['revenue'], 103000)
+        self.assertEqual(stats['packages'], {25000.0: 2, 53000.0: 1})
+
+        purchase_id = db.run_query("SELECT id FROM purchases WHERE invoice_id = 'inv_3'", fetchone=True)[0]
+        self.assertTrue(db.delete_purchase(purchase_id))
+        self.assertTrue(db.delete_purchase(purchase_id))  # borrar dos veces no descuenta dos veces
+
+        stats = db.get_raffle_stats()
+        self.assertEqual(stats['confirmed_numbers'], 8)
+        self.assertEqual(stats['packages'], {25000.0: 2})
+        self.assertTrue(db.check_raffle_stats()['consistent'])
+
+    def test_failed_transaction_does_not_count(self):
+        with self.assertRaises(RuntimeError):
+            with db.transaction() as tx:
+                tx.execute(
+                    "INSERT INTO purchases (invoice_id, amount, email, numbers, status) VALUES ('inv_x', 5000, 'a@b.co', '7', 'confirmed')"
+                )
+                db.add_purchase_stats(tx, 'inv_x')
+                raise RuntimeError("falla el pago")
+        self.assertEqual(db.get_raffle_stats()['confirmed_purchases'], 0)
+
+    def test_repair_recomputes_from_purchases(self):
+        self._confirm('inv_1', 15000, 4)
+        db.run_query("UPDATE raffle_stats SET confirmed_purchases = 99, revenue = 0", commit=True)
+
+        result = db.check_raffle_stats(repair=True)
+        self.assertFalse(result['consistent'])
+        self.assertTrue(result['repaired'])
+        stats = db.get_raffle_stats()
+        self.assertEqual((stats['confirmed_purchases'], stats['revenue'], stats['confirmed_numbers']), (1, 15000, 4))
+
+
+    def test_dashboard_is_one_query_and_works_on_sqlite(self):
+        self._confirm('inv_1', 25000, 4)
+        self._confirm('inv_2', 25000, 4)
+        self._confirm('inv_3', 53000, 8)
+        db.run_query("UPDATE purchases SET created_at = '2000-01-05 12:00:00' WHERE invoice_id = 'inv_3'", commit=True)
+
+        calls = []
+        original = db.run_query
+        db.run_query = lambda *args, **kwargs: calls.append(args) or original(*args, **kwargs)
+        try:
+            dashboard = db.get_raffle_dashboard(1, date_from='2000-01-01', date_to='2000-01-31')
+        finally:
+            db.run_query = original
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(dashboard['stats']['confirmed_purchases'], 3)
+        self.assertEqual(dashboard['packages'], {25000.0: 2, 53000.0: 1})
+        self.assertEqual(dashboard['range'], {'purchases': 1, 'revenue': 53000.0})
+        # Las compras viejas no entran en la serie de los últimos 7 días
+        self.assertEqual([(day['count'], day['revenue']) for day in dashboard['daily_sales']], [(2, 50000.0)])
+        self.assertIsNone(db.get_raffle_dashboard(1)['range'])
+        self.assertIsNone(db.get_raffle_dashboard(2))
+
+
+if __name__ == '__main__':
+    unittest.main()
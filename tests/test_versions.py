@@ -0,0 +1,40 @@
+import os
+import tempfile
+import unittest
+
+from app.versions import SharedVersions
+
+
+class SharedVersionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'versions.bin')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_bump_is_seen_by_other_instances(self):
+        a = SharedVersions(self.path, ('progress', 'blessed'))
+        b = SharedVersions(self.path, ('progress', 'blessed'))
+        start = b.get('progress')
+        blessed = b.get('blessed')
+
+        self.assertEqual(a.bump('progress'), (start + 1) & 0xFFFFFFFF)
+        self.assertEqual(b.get('progress'), (start + 1) & 0xFFFFFFFF)
+        self.assertEqual(b.get('blessed'), blessed)
+        a.close()
+        b.close()
+
+    def test_existing_file_keeps_its_values(self):
+        a = SharedVersions(self.path, ('progress',))
+        value = a.bump('progress')
+        a.close()
+
+        b = SharedVersions(self.path, ('progress',))
+        self.assertEqual(b.get('progress'), value)
+        b.close()
+
+
+if __name__ == '__main__':
+    unittest.main()